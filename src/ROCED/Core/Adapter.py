@@ -23,8 +23,11 @@ from __future__ import print_function, unicode_literals, absolute_import
 import abc
 import json
 import logging
+import time
+from multiprocessing.pool import ThreadPool
 
 from .MachineRegistry import MachineRegistry
+from Util.Profiling import CycleProfiler
 
 import xmlrpc.server
 
@@ -50,6 +53,9 @@ class AdapterBase(object):
     site_states = frozenset((MachineRegistry.statusBooting, MachineRegistry.statusDisintegrated,
                              MachineRegistry.statusDown))
 
+    # name of the adapter's section in the configuration, set when the adapter is created from it (ObjectFactory)
+    configSection = None
+
     @property
     def optionalConfigKeys(self):
         return self.configKeysToLoadOptional
@@ -108,6 +114,10 @@ class AdapterBase(object):
     def terminate(self):
         pass
 
+    def shutdown(self):
+        """Called once when ROCED stops (ScaleCore.shutdown): finish background work, release resources."""
+        pass
+
     @property
     @abc.abstractmethod
     def description(self):
@@ -173,6 +183,9 @@ class AdapterBoxBase(object):
         self._adapterList = []
         self._rpcServer = None
         # self.rpcServer = "https://localhost:8000"
+        self._threadPool = None
+        self._timeout = None
+        self._pendingCalls = dict()
 
     def addAdapter(self, a):
         # type: (AdapterBase) -> None
@@ -182,5 +195,98 @@ class AdapterBoxBase(object):
         # type: (List(AdapterBase)) -> None
         self._adapterList += alist
 
+    def shutdown(self):
+        """Call AdapterBase.shutdown of all adapters, errors are logged."""
+        for adapter in self._adapterList:
+            try:
+                adapter.shutdown()
+            except Exception:
+                logging.exception("Shutdown of %s failed." % adapter.description)
+
+    def setConcurrency(self, maxWorkers, timeout=None):
+        # type: (int, Union[int, None]) -> None
+        """Run the adapters of this box in parallel, using a pool of maxWorkers threads.
+
+        maxWorkers <= 0 restores the (default) serial execution.
+        timeout is the maximum time (seconds) to wait for the adapters of a single call. Threads can't be killed, so
+        an adapter which did not finish in time keeps on running and is skipped until its previous call returned.
+        """
+        if self._threadPool is not None:
+            self._threadPool.close()
+            self._threadPool = None
+        if maxWorkers > 0:
+            self._threadPool = ThreadPool(processes=maxWorkers)
+        self._timeout = timeout
+
+    @property
+    def isConcurrent(self):
+        return self._threadPool is not None
+
+    def callAdapters(self, function, default=None, phase=None):
+        # type: (Callable[[AdapterBase], Any], Any, str) -> list
+        """Call function(adapter) for every adapter and return the results (same order as the adapter list).
+
+        Adapters are called one after another by default. In concurrent mode, all calls are submitted to the thread
+        pool and awaited together. A call exceeding the timeout (or still running from a previous cycle) results in
+        "default". Exceptions are re-raised, just like in serial mode.
+        If phase is set, the duration of each call is recorded by the CycleProfiler as "<phase>:<adapter name>", the
+        name of its configuration section (class name if it wasn't configured).
+        With event batching enabled (MachineRegistry.batchingEnabled), the events of each call are delivered when it
+        returns.
+        """
+        if MachineRegistry().batchingEnabled is True:
+            function = self.__batched(function)
+        if phase is not None and CycleProfiler.enabled is True:
+            function = self.__profiled(function, phase)
+
+        if self._threadPool is None:
+            return [function(adapter) for adapter in self._adapterList]
+
+        calls = []
+        for adapter in self._adapterList:
+            previousCall = self._pendingCalls.get(adapter)
+            if previousCall is not None and not previousCall.ready():
+                logging.warning("%s is still busy with its previous call. Skipping it." % adapter.description)
+                calls.append(None)
+            else:
+                self._pendingCalls[adapter] = self._threadPool.apply_async(function, (adapter,))
+                calls.append(self._pendingCalls[adapter])
+
+        if self._timeout is not None:
+            deadline = time.time() + self._timeout
+
+        results = []
+        for adapter, call in zip(self._adapterList, calls):
+            if call is None:
+                results.append(default)
+                continue
+            if self._timeout is None:
+                call.wait()
+            else:
+                call.wait(max(0, deadline - time.time()))
+            if call.ready():
+                results.append(call.get())
+            else:
+                logging.warning("%s did not finish within %s seconds." % (adapter.description, self._timeout))
+                results.append(default)
+        return results
+
+    @staticmethod
+    def __batched(function):
+        def batchedFunction(adapter):
+            with MachineRegistry().batch():
+                return function(adapter)
+
+        return batchedFunction
+
+    @staticmethod
+    def __profiled(function, phase):
+        def profiledFunction(adapter):
+            name = adapter.configSection if adapter.configSection is not None else type(adapter).__name__
+            with CycleProfiler.phase("%s:%s" % (phase, name)):
+                return function(adapter)
+
+        return profiledFunction
+
     def manage(self):
-        [adapter.manage() for adapter in self._adapterList]
+        self.callAdapters(lambda adapter: adapter.manage(), phase="manage")
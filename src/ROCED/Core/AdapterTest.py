@@ -21,6 +21,7 @@
 from __future__ import unicode_literals, absolute_import
 
 import logging
+import time
 
 import configparser
 
@@ -61,6 +62,27 @@ class AdapterBoxTest(ScaleTest.ScaleTestBase):
         con = box.adapterList
         self.assertEqual(len(con), 2)
 
+    def test_callAdaptersConcurrently(self):
+        logging.debug("=======Testing concurrent AdapterBox=======")
+        box = AdapterBoxBase()
+        box.addAdapterList([IntegrationAdapterTest(), IntegrationAdapterTest(), IntegrationAdapterTest()])
+        box.addAdapter(IntegrationAdapterTest())
+        box.adapterList[-1].manage = lambda: time.sleep(1)
+
+        # serial mode
+        self.assertEqual(box.callAdapters(lambda adapter: box.adapterList.index(adapter)), [0, 1, 2, 3])
+
+        box.setConcurrency(maxWorkers=4, timeout=0.5)
+        self.assertTrue(box.isConcurrent)
+        self.assertEqual(box.callAdapters(lambda adapter: box.adapterList.index(adapter)), [0, 1, 2, 3])
+        # last adapter times out and is skipped, as long as its previous call is still running
+        self.assertEqual(box.callAdapters(lambda adapter: adapter.manage(), default="timeout"),
+                         [None, None, None, "timeout"])
+        self.assertEqual(box.callAdapters(lambda adapter: "done", default="busy"), ["done", "done", "done", "busy"])
+
+        box.setConcurrency(maxWorkers=0)
+        self.assertFalse(box.isConcurrent)
+
 
 class AdapterBaseTest(ScaleTest.ScaleTestBase):
     def test_addOptionalConfigKeys(self):
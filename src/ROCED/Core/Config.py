@@ -25,6 +25,31 @@ GeneralSection = "general"
 
 GeneralLogFolder = "logfolder"
 GeneralManagementInterval = "management_interval"
+GeneralCycleOverrunPolicy = "cycle_overrun_policy"
+GeneralCycleMaxCatchUp = "cycle_max_catch_up"
+GeneralEarlyCycles = "early_cycles"
+GeneralEarlyCycleProbeInterval = "early_cycle_probe_interval"
+GeneralEarlyCycleThreshold = "early_cycle_threshold"
+GeneralEarlyCycleMinGap = "early_cycle_min_gap"
+GeneralConcurrentAdapters = "concurrent_adapters"
+GeneralAdapterTimeout = "adapter_timeout"
+GeneralRegistryJournal = "registry_journal"
+GeneralRegistrySnapshotInterval = "registry_snapshot_interval"
+GeneralStatusHistoryLength = "status_history_length"
+GeneralStatusHistoryFormat = "status_history_format"
+GeneralMachineRecords = "machine_records"
+GeneralEventBatching = "event_batching"
+GeneralCacheBackgroundRefresh = "cache_background_refresh"
+GeneralMonitoringLogFormat = "monitoring_log_format"
+GeneralMonitoringLogMaxBytes = "monitoring_log_max_bytes"
+GeneralStatsFormat = "stats_format"
+GeneralStatsBufferSize = "stats_buffer_size"
+GeneralStatsFlushInterval = "stats_flush_interval"
+GeneralSshMultiplexing = "ssh_multiplexing"
+GeneralSshIdleTimeout = "ssh_idle_timeout"
+GeneralProfiling = "profiling"
+GeneralProfilingWindow = "profiling_window"
+GeneralProfilingDumpInterval = "profiling_dump_interval"
 
 GeneralBroker = "broker"
 
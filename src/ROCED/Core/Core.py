@@ -30,16 +30,19 @@ import importlib
 import logging
 
 from datetime import datetime
-from threading import Timer
 
 from . import Broker
 from . import Config
 from . import MachineRegistry
+from .Scheduler import CycleScheduler
+from .Watcher import RequirementWatcher
 from IntegrationAdapter.Integration import IntegrationBox
 from RequirementAdapter.Requirement import RequirementBox
 from SiteAdapter.Site import SiteBox
-from Util.Logging import JsonLog, MachineRegistryLogger
-from Util.PythonTools import summarize_dicts
+from Util.Logging import CsvStats, JsonLog, MachineRegistryLogger
+from Util.Profiling import CycleProfiler
+from Util.PythonTools import Caching, summarize_dicts
+from Util.ScaleTools import SshConnectionPool
 
 logger = logging.getLogger("Core")
 
@@ -79,7 +82,19 @@ class ScaleCore(object):
         # will count the number of iterations that have been executed
         self.manageIterations = 0
         self.maximumManageIterations = maximumManageIterations
+        # what to do with cycles missed because the previous cycle took longer than manageInterval
+        self.cycleOverrunPolicy = CycleScheduler.policySkip
+        self.cycleMaxCatchUp = 1
+        self.scheduler = None
+        self.watcher = None
+        # probe the requirement adapters every n seconds to trigger early cycles (0: disabled)
+        self.earlyCycleProbeInterval = 0
+        self.earlyCycleThreshold = 10
+        self.earlyCycleMinGap = 30
         self.mr = MachineRegistry.MachineRegistry()
+        # persist machine registry changes in a journal, with a compacted snapshot every n cycles
+        self.registryJournal = False
+        self.registrySnapshotInterval = 60
         self._rpcServer = rpcServer
         # self._rpcServer.register_function(self.getDescription,"ScaleCore_getDescription" )
 
@@ -110,18 +125,82 @@ class ScaleCore(object):
 
         self.intBox.addAdapterList(intAdapterList)
 
+    def setConcurrency(self, maxWorkers, timeout=None):
+        # type: (int, Union[int, None]) -> None
+        """Manage the adapters of each box in parallel (thread pool per box). maxWorkers <= 0: serial management.
+
+        The phase order (requirement -> site -> integration -> broker -> apply decision) is kept, each phase waits
+        for all of its adapters (at most "timeout" seconds) before the next one starts.
+        """
+        for box in (self.reqBox, self.siteBox, self.intBox):
+            box.setConcurrency(maxWorkers, timeout)
+
     def init(self):
         # self.exportMethod(self.setMachineTypeMaxInstances, "setMachineTypeMaxInstances")
-        self.mr.machines = MachineRegistryLogger.load()
+        if self.registryJournal is True:
+            journal = MachineRegistryLogger.enableJournal(self.registrySnapshotInterval)
+            self.mr.machines = MachineRegistryLogger.load()
+            self.mr.journal = journal
+        else:
+            self.mr.machines = MachineRegistryLogger.load()
+
+    def run(self):
+        """Run management cycles every manageInterval seconds (only one if autoRun is False) until stop() is called.
 
-    def startManagementTimer(self):
-        t = Timer(self.manageInterval, self.startManage)
-        t.start()
+        The adapters are shut down afterwards, see shutdown().
+        """
+        try:
+            self.__runCycles()
+        finally:
+            self.shutdown()
+
+    def __runCycles(self):
+        if self.autoRun is False:
+            self.startManage()
+            return
+        self.scheduler = CycleScheduler(self.startManage, self.manageInterval,
+                                        policy=self.cycleOverrunPolicy,
+                                        maxCatchUp=self.cycleMaxCatchUp,
+                                        maxIterations=self.maximumManageIterations)
+        if self.earlyCycleProbeInterval <= 0:
+            self.scheduler.run()
+            return
+
+        self.scheduler.minTriggerGap = self.earlyCycleMinGap
+        self.watcher = RequirementWatcher(self.reqBox, self.scheduler, self.earlyCycleProbeInterval,
+                                          self.earlyCycleThreshold)
+        self.watcher.start()
+        try:
+            self.scheduler.run()
+        finally:
+            self.watcher.stop()
+            self.watcher = None
+
+    def stop(self):
+        """Stop after the current management cycle."""
+        if self.scheduler is not None:
+            self.scheduler.stop()
+
+    def shutdown(self):
+        """Shut down all adapters (AdapterBase.shutdown) and close pooled SSH connections, called when run()
+        returns."""
+        for box in (self.reqBox, self.siteBox, self.intBox):
+            box.shutdown()
+        SshConnectionPool.closeAll()
 
     def startManage(self):
         logger.info("----------------------------------")
         logger.info("Management cycle triggered")
         logger.info("Time: %s" % datetime.today().strftime("%Y-%m-%d %H:%M:%S"))
+        CycleProfiler.startCycle()
+        if self.scheduler is not None:
+            with JsonLog() as jsonLog:
+                jsonLog.addItem("scheduler", "cycle_lag", self.scheduler.cycleLag)
+                jsonLog.addItem("scheduler", "skipped_cycles", self.scheduler.skippedCycles)
+
+        if self.scheduler is not None and self.scheduler.cycleTriggered is True:
+            # a cached (background refreshed) requirement would still be the one before the queue changed
+            self.reqBox.invalidateRequirement()
 
         # regular management
         self.reqBox.manage()
@@ -131,6 +210,9 @@ class ScaleCore(object):
         # scaling
         mReq = self.reqBox.getMachineTypeRequirement()
         logger.info("Current requirement: %s" % mReq)
+        if self.watcher is not None:
+            # later queue changes are compared to the queue this cycle is based on
+            self.watcher.setBaseline()
 
         siteInfo = self.siteBox.siteInformation
         runningBySite = self.siteBox.runningMachinesCount
@@ -146,10 +228,12 @@ class ScaleCore(object):
             if not key_ in machStat:
                 machStat[key_] = MachineStatus(mReq.get(key_, 0), 0)
 
-        decision = self.broker.decide(machStat, siteInfo.values())
+        with CycleProfiler.phase("broker.decide"):
+            decision = self.broker.decide(machStat, siteInfo.values())
 
         # Service machines may modify site decision(s).
-        decision = self.siteBox.modServiceMachineDecision(decision)
+        with CycleProfiler.phase("modServiceMachineDecision"):
+            decision = self.siteBox.modServiceMachineDecision(decision)
 
         logger.info("Decision: %s" % decision)
         logger.debug(runningBySite)
@@ -165,19 +249,30 @@ class ScaleCore(object):
 
         logger.info(self.mr.getMachineOverview())
 
-        MachineRegistryLogger.dump(self.mr.machines)
+        # Timed out adapters may still be running (concurrent mode).
+        with CycleProfiler.phase("MachineRegistryLogger.dump"), self.mr.lock:
+            MachineRegistryLogger.dump(self.mr.machines)
 
-        log = JsonLog()
-        log.writeLog()
+        # End the cycle before writing the logs, so its profiling summary is part of this cycle's JSON log entry.
+        # Writing the logs is recorded as a phase of the next cycle.
+        CycleProfiler.endCycle()
+        with CycleProfiler.phase("JsonLog.writeLog"):
+            log = JsonLog()
+            log.writeLog()
+        with CycleProfiler.phase("CsvStats.write_stats"):
+            CsvStats.write_stats()
 
         self.manageIterations += 1
 
-        lastIteration = False
-        if self.maximumManageIterations is not None:
-            lastIteration = self.maximumManageIterations <= self.manageIterations
+    @property
+    def eventBatching(self):
+        # type: () -> bool
+        """Deliver machine events at the end of each adapter call (manage, apply decision), see AdapterBoxBase."""
+        return self.mr.batchingEnabled
 
-        if self.autoRun is True and lastIteration is False:
-            self.startManagementTimer()
+    @eventBatching.setter
+    def eventBatching(self, value):
+        self.mr.batchingEnabled = value
 
     @property
     def description(self):
@@ -231,6 +326,70 @@ class ScaleCoreFactory(object):
                        maximumManageIterations=maximumInterval)
 
         sc.manageInterval = interval
+        if configuration.has_option(Config.GeneralSection, Config.GeneralCycleOverrunPolicy):
+            sc.cycleOverrunPolicy = configuration.get(Config.GeneralSection, Config.GeneralCycleOverrunPolicy)
+            if sc.cycleOverrunPolicy not in (CycleScheduler.policySkip, CycleScheduler.policyCatchUp):
+                raise ValueError("%s must be \"%s\" or \"%s\"." % (Config.GeneralCycleOverrunPolicy,
+                                                                   CycleScheduler.policySkip,
+                                                                   CycleScheduler.policyCatchUp))
+        if configuration.has_option(Config.GeneralSection, Config.GeneralCycleMaxCatchUp):
+            sc.cycleMaxCatchUp = configuration.getint(Config.GeneralSection, Config.GeneralCycleMaxCatchUp)
+        if configuration.has_option(Config.GeneralSection, Config.GeneralEarlyCycles) and \
+                configuration.getboolean(Config.GeneralSection, Config.GeneralEarlyCycles):
+            sc.earlyCycleProbeInterval = 10
+            if configuration.has_option(Config.GeneralSection, Config.GeneralEarlyCycleProbeInterval):
+                sc.earlyCycleProbeInterval = configuration.getint(Config.GeneralSection,
+                                                                  Config.GeneralEarlyCycleProbeInterval)
+            if configuration.has_option(Config.GeneralSection, Config.GeneralEarlyCycleThreshold):
+                sc.earlyCycleThreshold = configuration.getint(Config.GeneralSection,
+                                                              Config.GeneralEarlyCycleThreshold)
+            if configuration.has_option(Config.GeneralSection, Config.GeneralEarlyCycleMinGap):
+                sc.earlyCycleMinGap = configuration.getint(Config.GeneralSection, Config.GeneralEarlyCycleMinGap)
+
+        if configuration.has_option(Config.GeneralSection, Config.GeneralRegistryJournal):
+            sc.registryJournal = configuration.getboolean(Config.GeneralSection, Config.GeneralRegistryJournal)
+        if configuration.has_option(Config.GeneralSection, Config.GeneralRegistrySnapshotInterval):
+            sc.registrySnapshotInterval = configuration.getint(Config.GeneralSection,
+                                                               Config.GeneralRegistrySnapshotInterval)
+
+        if configuration.has_option(Config.GeneralSection, Config.GeneralMachineRecords):
+            records = configuration.get(Config.GeneralSection, Config.GeneralMachineRecords)
+            if records not in ("dict", "compact"):
+                raise ValueError("%s must be \"dict\" or \"compact\"." % Config.GeneralMachineRecords)
+            MachineRegistry.MachineRegistry.compactRecords = records == "compact"
+        if configuration.has_option(Config.GeneralSection, Config.GeneralStatusHistoryLength):
+            MachineRegistry.MachineRegistry.statusHistoryLength = configuration.getint(
+                Config.GeneralSection, Config.GeneralStatusHistoryLength)
+
+        if configuration.has_option(Config.GeneralSection, Config.GeneralEventBatching):
+            sc.eventBatching = configuration.getboolean(Config.GeneralSection, Config.GeneralEventBatching)
+
+        if configuration.has_option(Config.GeneralSection, Config.GeneralConcurrentAdapters):
+            timeout = None
+            if configuration.has_option(Config.GeneralSection, Config.GeneralAdapterTimeout):
+                timeout = configuration.getint(Config.GeneralSection, Config.GeneralAdapterTimeout)
+            sc.setConcurrency(configuration.getint(Config.GeneralSection, Config.GeneralConcurrentAdapters), timeout)
+
+        if configuration.has_option(Config.GeneralSection, Config.GeneralCacheBackgroundRefresh):
+            Caching.backgroundRefresh = configuration.getboolean(Config.GeneralSection,
+                                                                 Config.GeneralCacheBackgroundRefresh)
+
+        if configuration.has_option(Config.GeneralSection, Config.GeneralSshMultiplexing) and \
+                configuration.getboolean(Config.GeneralSection, Config.GeneralSshMultiplexing):
+            idleTimeout = 300
+            if configuration.has_option(Config.GeneralSection, Config.GeneralSshIdleTimeout):
+                idleTimeout = configuration.getint(Config.GeneralSection, Config.GeneralSshIdleTimeout)
+            SshConnectionPool.enable(idleTimeout=idleTimeout)
+
+        if configuration.has_option(Config.GeneralSection, Config.GeneralProfiling) and \
+                configuration.getboolean(Config.GeneralSection, Config.GeneralProfiling):
+            window = 100
+            if configuration.has_option(Config.GeneralSection, Config.GeneralProfilingWindow):
+                window = configuration.getint(Config.GeneralSection, Config.GeneralProfilingWindow)
+            dumpInterval = 0
+            if configuration.has_option(Config.GeneralSection, Config.GeneralProfilingDumpInterval):
+                dumpInterval = configuration.getint(Config.GeneralSection, Config.GeneralProfilingDumpInterval)
+            CycleProfiler.enable(window=window, dumpInterval=dumpInterval)
 
         return sc
 
@@ -271,6 +430,7 @@ class ScaleCoreFactory(object):
                 obj = None
             if obj is None:
                 raise Exception("Adapter type %s not found" % site_type)
+            obj.configSection = adapter
 
             # transfer compulsory config
             obj.loadConfigValue(obj.compulsoryConfigKeys, configuration, False, adapter, obj)
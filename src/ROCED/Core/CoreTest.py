@@ -21,15 +21,27 @@
 from __future__ import unicode_literals, absolute_import
 
 import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
 
 import configparser
 
 from RequirementAdapter.RequirementTest import RequirementAdapterTest
-from SiteAdapter.Site import SiteAdapterBase, SiteInformation
+from RequirementAdapter.Requirement import RequirementBox
+from SiteAdapter.Site import SiteAdapterBase, SiteBox, SiteInformation
 from . import Config
 from . import ScaleTest
 from .Broker import StupidBroker, SiteBrokerBase
 from .Core import MachineStatus, ScaleCore, ScaleCoreFactory
+from .MachineRegistry import MachineRecord, MachineRegistry, StatusHistory
+from .Scheduler import CycleScheduler
+from .Watcher import RequirementWatcher
+from Util.Logging import CsvStats, MachineRegistryLogger, MemoryStatsSink
+from Util.Profiling import CycleProfiler
+from Util.PythonTools import Caching
 
 
 class SiteBrokerTest(SiteBrokerBase):
@@ -147,6 +159,205 @@ class ScaleCoreTest(ScaleCoreTestBase):
 
         sc = ScaleCore(broker, None, [req, req], [site1, site2], [], False)
 
+    def test_machineCounts(self):
+        logging.debug("=======Testing Site Machine Counts=======")
+        mr = MachineRegistry()
+        mr.clear()
+        site = SiteAdapterTest()
+        site.siteName = "site1"
+        site.setConfig(site.ConfigMachines, {"machine1": None, "machine2": None})
+        try:
+            for siteName, machineType, status in (("site1", "machine1", mr.statusBooting),
+                                                  ("site1", "machine1", mr.statusWorking),
+                                                  ("site1", "machine2", mr.statusDisintegrated),
+                                                  ("site1", "machine2", mr.statusDown),
+                                                  ("site2", "machine1", mr.statusWorking)):
+                mid = mr.newMachine()
+                mr.machines[mid][mr.regSite] = siteName
+                mr.machines[mid][mr.regMachineType] = machineType
+                mr.updateMachineStatus(mid, status)
+
+            self.assertEqual(site.runningMachinesCount, {"machine1": 2, "machine2": 0})
+            self.assertEqual(site.runningMachinesCount,
+                             {machineType: len(mids) for machineType, mids in site.runningMachines.items()})
+            self.assertEqual(site.cloudOccupyingMachinesCount, 3)
+        finally:
+            mr.clear()
+
+    def test_shutdown(self):
+        logging.debug("=======Testing Shutdown=======")
+        shutdowns = []
+
+        def failingShutdown():
+            raise RuntimeError("shutdown failed")
+
+        site1 = SiteAdapterTest()
+        site1.shutdown = failingShutdown
+        site2 = SiteAdapterTest()
+        site2.shutdown = lambda: shutdowns.append("site2")
+        req = RequirementAdapterTest()
+        req.shutdown = lambda: shutdowns.append("req")
+
+        sc = ScaleCore(SiteBrokerTest(), None, [req], [site1, site2], [], False)
+        sc.shutdown()
+        # errors of one adapter don't prevent the shutdown of the others
+        self.assertEqual(shutdowns, ["req", "site2"])
+
+
+class CycleProfilerTest(ScaleTest.ScaleTestBase):
+    def tearDown(self):
+        CycleProfiler.disable()
+
+    def test_profiler(self):
+        logging.debug("=======Testing Cycle Profiler=======")
+        CycleProfiler.enable(window=10)
+        box = SiteBox()
+        box.addAdapterList([SiteAdapterTest(), SiteAdapterTest(), SiteAdapterTest()])
+        box.adapterList[0].configSection = "site1"
+        box.adapterList[1].configSection = "site2"
+        for cycle in range(3):
+            CycleProfiler.startCycle()
+            box.manage()
+            with CycleProfiler.phase("broker.decide"):
+                CycleProfiler.countSsh(100)
+            summary = CycleProfiler.endCycle()
+            # between cycles -> next cycle
+            with CycleProfiler.phase("JsonLog.writeLog"):
+                pass
+
+        self.assertEqual(summary["ssh_calls"], 1)
+        self.assertEqual(summary["ssh_bytes"], 100)
+        # adapters of the same class are recorded separately
+        self.assertIn("manage:site1", summary)
+        self.assertIn("manage:site2", summary)
+        self.assertIn("manage:SiteAdapterTest", summary)
+        self.assertIn("broker.decide", summary)
+        self.assertIn("JsonLog.writeLog", summary)
+        self.assertEqual(len(CycleProfiler.getPercentiles("JsonLog.writeLog")), len(CycleProfiler.percentiles))
+        self.assertEqual(set(CycleProfiler.getPercentiles("cycle")), set(CycleProfiler.percentiles))
+        self.assertEqual(CycleProfiler.getPercentiles("ssh_calls")[50], 1)
+
+
+class CycleSchedulerTest(ScaleTest.ScaleTestBase):
+    def test_schedule(self):
+        logging.debug("=======Testing Cycle Scheduler=======")
+        starts = []
+        scheduler = CycleScheduler(lambda: starts.append(time.time()), 0.05, maxIterations=4)
+        scheduler.run()
+        self.assertEqual(len(starts), 4)
+        # start times don't drift with the cycle duration
+        self.assertAlmostEqual(starts[3] - starts[0], 0.15, delta=0.04)
+        self.assertEqual(scheduler.skippedCycles, 0)
+        self.assertIsNone(scheduler.nextCycleAt)
+
+    def test_overrun(self):
+        logging.debug("=======Testing Cycle Scheduler Overrun=======")
+        scheduler = CycleScheduler(lambda: time.sleep(0.12), 0.05, maxIterations=2)
+        scheduler.run()
+        self.assertEqual(scheduler.skippedCycles, 2)
+
+        scheduler = CycleScheduler(lambda: time.sleep(0.12), 0.05, policy=CycleScheduler.policyCatchUp,
+                                   maxCatchUp=1, maxIterations=2)
+        scheduler.run()
+        self.assertEqual(scheduler.skippedCycles, 1)
+        self.assertGreater(scheduler.cycleLag, 0)
+
+    def test_stop(self):
+        logging.debug("=======Testing Cycle Scheduler Stop=======")
+        cycleStarted = threading.Event()
+        scheduler = CycleScheduler(cycleStarted.set, 60)
+        scheduler.start()
+        self.assertTrue(cycleStarted.wait(5))
+        scheduler.stop(wait=True, timeout=5)
+        self.assertEqual(scheduler.iterations, 1)
+        self.assertFalse(scheduler.isRunning)
+
+        # stop before the thread runs is not lost
+        scheduler = CycleScheduler(lambda: None, 60)
+        scheduler.stop()
+        scheduler.run()
+        self.assertEqual(scheduler.iterations, 0)
+
+    def test_trigger(self):
+        starts = []
+        triggered = []
+
+        def cycle():
+            starts.append(time.time())
+            triggered.append(scheduler.cycleTriggered)
+            # triggered while running: starts after this cycle
+            scheduler.trigger("test")
+
+        scheduler = CycleScheduler(cycle, 60, maxIterations=2)
+        scheduler.minTriggerGap = 0.05
+        scheduler.run()
+        self.assertEqual(scheduler.iterations, 2)
+        self.assertEqual(scheduler.triggeredCycles, 1)
+        self.assertEqual(triggered, [False, True])
+        self.assertGreaterEqual(starts[1] - starts[0], 0.05)
+
+
+class RequirementWatcherTest(ScaleTest.ScaleTestBase):
+    def test_check(self):
+        logging.debug("=======Testing Requirement Watcher=======")
+        req = RequirementAdapterTest()
+        req.probeRequirement = lambda: req.requirement
+        box = RequirementBox()
+        box.addAdapterList([req, RequirementAdapterTest()])
+        scheduler = CycleScheduler(lambda: None, 60)
+        triggers = []
+        scheduler.trigger = triggers.append
+        watcher = RequirementWatcher(box, scheduler, threshold=10)
+
+        # no baseline before the first cycle
+        req.requirement = 20
+        self.assertFalse(watcher.check())
+        # baseline taken by the cycle
+        req.requirement = 0
+        watcher.setBaseline()
+        req.requirement = 9
+        self.assertFalse(watcher.check())
+        req.requirement = 10
+        self.assertTrue(watcher.check())
+        # new baseline with the next cycle
+        watcher.setBaseline()
+        self.assertFalse(watcher.check())
+        self.assertFalse(watcher.check())
+        self.assertEqual(len(triggers), 1)
+
+        # queue changed between the cycle and the first probe
+        req.requirement = 30
+        self.assertTrue(watcher.check())
+        self.assertEqual(len(triggers), 2)
+
+        # requirement set via RPC
+        box.getMachineTypeRequirement()
+        box.setRequirementListener(watcher.requirementSet)
+        req._setRequirement(45)
+        self.assertEqual(len(triggers), 3)
+
+    def test_invalidateRequirement(self):
+        logging.debug("=======Testing Requirement Invalidation=======")
+        queue = [10]
+
+        class CachedRequirementAdapter(RequirementAdapterTest):
+            @property
+            @Caching(validityPeriod=-1, redundancyPeriod=0, refreshInBackground=True)
+            def requirement(self):
+                return queue[0]
+
+        box = RequirementBox()
+        box.addAdapterList([CachedRequirementAdapter(), RequirementAdapterTest()])
+        Caching.backgroundRefresh = True
+        try:
+            self.assertEqual(box.getMachineTypeRequirement()["default"], 10)
+            queue[0] = 50
+            # a triggered cycle must not get the cached value before the queue changed
+            box.invalidateRequirement()
+            self.assertEqual(box.getMachineTypeRequirement()["default"], 50)
+        finally:
+            Caching.backgroundRefresh = False
+
 
 class StupidBrokerTest(ScaleCoreTestBase):
     def test_decide(self):
@@ -173,3 +384,155 @@ class StupidBrokerTest(ScaleCoreTestBase):
         self.assertTrue("machine2" not in orders["site1"])
         self.assertTrue("machine3" not in orders["site1"])
         self.assertTrue("machine3" not in orders["site2"])
+
+
+class MachineRegistryTest(ScaleTest.ScaleTestBase):
+    def setUp(self):
+        super(MachineRegistryTest, self).setUp()
+        self.mr = MachineRegistry()
+        self.mr.clear()
+
+    def tearDown(self):
+        self.mr.clear()
+
+    def newMachine(self, site, machineType, status):
+        mid = self.mr.newMachine()
+        self.mr.machines[mid][self.mr.regSite] = site
+        self.mr.machines[mid][self.mr.regMachineType] = machineType
+        self.mr.updateMachineStatus(mid, status)
+        return mid
+
+    def test_indexes(self):
+        logging.debug("=======Testing Machine Registry Indexes=======")
+        id1 = self.newMachine("site1", "machine1", self.mr.statusBooting)
+        id2 = self.newMachine("site1", "machine2", self.mr.statusBooting)
+        id3 = self.newMachine("site2", "machine1", self.mr.statusWorking)
+
+        self.assertEqual(set(self.mr.getMachines(site="site1")), {id1, id2})
+        self.assertEqual(set(self.mr.getMachines(status=self.mr.statusBooting)), {id1, id2})
+        self.assertEqual(set(self.mr.getMachines(site="site1", machineType="machine1")), {id1})
+        self.assertEqual(set(self.mr.getMachines(machineType="machine1")), {id1, id3})
+        self.assertEqual(self.mr.countMachines(site="site1", status=self.mr.statusBooting), 2)
+
+        self.mr.updateMachineStatus(id1, self.mr.statusUp)
+        self.mr.machines[id2][self.mr.regSite] = "site2"
+        self.assertEqual(set(self.mr.getMachines(site="site1")), {id1})
+        self.assertEqual(set(self.mr.getMachines(site="site2", status=self.mr.statusBooting)), {id2})
+        self.assertEqual(self.mr.countMachines(status=self.mr.statusBooting), 1)
+        self.assertEqual(self.mr.countMachines(site="site2"), 2)
+        self.assertEqual(self.mr.countMachines(site="site2", status=self.mr.statusBooting, machineType="machine2"), 1)
+        self.assertEqual(self.mr.countMachines(site="site2", status=self.mr.statusBooting, machineType="machine1"), 0)
+        self.assertEqual(self.mr.countMachines(machineType="machine1"), 2)
+        self.assertEqual(self.mr.getMachineOverview(), "MachineState: 1,1,0,1,0,0,0,0")
+
+        machine = self.mr.machines[id3]
+        self.mr.removeMachine(id3)
+        machine[self.mr.regStatus] = self.mr.statusDown
+        self.assertEqual(self.mr.getMachines(site="site2", status=self.mr.statusWorking), {})
+        self.assertEqual(self.mr.countMachines(status=self.mr.statusDown), 0)
+
+        # rebuild from a (loaded) plain dictionary
+        self.mr.machines = {mid: dict(machine_) for mid, machine_ in self.mr.machines.items()}
+        self.assertEqual(set(self.mr.getMachines(site="site2")), {id2})
+        self.assertEqual(self.mr.countMachines(), 2)
+
+    def test_journal(self):
+        logging.debug("=======Testing Machine Registry Journal=======")
+        cwd = os.getcwd()
+        tmpDir = tempfile.mkdtemp()
+        os.chdir(tmpDir)
+        try:
+            self.mr.journal = MachineRegistryLogger.enableJournal(snapshotInterval=2)
+            id1 = self.newMachine("site1", "machine1", self.mr.statusBooting)
+            id2 = self.newMachine("site1", "machine1", self.mr.statusBooting)
+            self.mr.updateMachineIp(id1, "10.0.0.1")
+            MachineRegistryLogger.dump(self.mr.machines)
+            self.assertFalse(os.path.exists("log/machine_registry_snapshot.json"))
+
+            self.mr.removeMachine(id2)
+            MachineRegistryLogger.dump(self.mr.machines)
+            MachineRegistryLogger.waitForSnapshot()
+            self.assertTrue(os.path.exists("log/machine_registry_snapshot.json"))
+
+            self.mr.updateMachineStatus(id1, self.mr.statusUp)
+            id3 = self.newMachine("site2", "machine2", self.mr.statusBooting)
+            expected = {mid: dict(machine) for mid, machine in self.mr.machines.items()}
+            self.mr.journal = None
+
+            state = MachineRegistryLogger.load()
+            self.assertEqual(set(state), {id1, id3})
+            self.assertEqual(len(state[id1][self.mr.statusChangeHistory]), 2)
+            # loaded status histories are lists, compare as registry entries
+            self.mr.machines = state
+            self.assertEqual({mid: dict(machine) for mid, machine in self.mr.machines.items()}, expected)
+        finally:
+            self.mr.journal = None
+            MachineRegistryLogger.disableJournal()
+            os.chdir(cwd)
+            shutil.rmtree(tmpDir)
+
+    def test_status_history(self):
+        logging.debug("=======Testing Status History=======")
+        mid = self.newMachine("site1", "machine1", self.mr.statusBooting)
+        for _ in range(self.mr.statusHistoryLength):
+            self.mr.updateMachineStatus(mid, self.mr.statusWorking)
+            self.mr.updateMachineStatus(mid, self.mr.statusPendingDisintegration)
+        history = self.mr.machines[mid][self.mr.statusChangeHistory]
+        self.assertEqual(len(history), self.mr.statusHistoryLength)
+        self.assertEqual(history[-1][:2], (self.mr.list_status.index(self.mr.statusWorking),
+                                           self.mr.list_status.index(self.mr.statusPendingDisintegration)))
+
+        # old format (export) can be loaded again
+        legacy = history.export()
+        self.assertEqual(legacy[-1]["old_status"], self.mr.statusWorking)
+        self.assertEqual(legacy[-1]["new_status"], self.mr.statusPendingDisintegration)
+        loaded = StatusHistory.fromList(legacy)
+        self.assertEqual([entry[:2] for entry in loaded], [entry[:2] for entry in history])
+        self.assertAlmostEqual(loaded[-1][2], history[-1][2], places=5)
+
+    def test_stats(self):
+        logging.debug("=======Testing Buffered Statistics=======")
+        sink = MemoryStatsSink()
+        CsvStats.setSink(sink)
+        try:
+            mid = self.newMachine("site1", "machine1", self.mr.statusBooting)
+            self.mr.updateMachineStatus(mid, self.mr.statusUp)
+            self.assertEqual(len(sink.records), 0)
+
+            CsvStats.write_stats()
+            self.assertEqual([record["new_status"] for record in sink.records],
+                             [self.mr.statusBooting, self.mr.statusUp])
+            self.assertEqual(sink.records[-1]["old_status"], self.mr.statusBooting)
+        finally:
+            CsvStats.setSink(None)
+
+
+class CompactMachineRegistryTest(MachineRegistryTest):
+    """Machine registry tests with MachineRecord entries."""
+
+    def setUp(self):
+        MachineRegistry.compactRecords = True
+        super(CompactMachineRegistryTest, self).setUp()
+
+    def tearDown(self):
+        super(CompactMachineRegistryTest, self).tearDown()
+        MachineRegistry.compactRecords = False
+
+    def test_record(self):
+        logging.debug("=======Testing Compact Machine Records=======")
+        mid = self.newMachine("site1", "machine1", self.mr.statusWorking)
+        machine = self.mr.machines[mid]
+        self.assertIsInstance(machine, MachineRecord)
+        self.assertEqual(machine[self.mr.regStatus], self.mr.statusWorking)
+        self.assertEqual(machine.statusCode, self.mr.statusCodes[self.mr.statusWorking])
+        self.assertLess(self.mr.statusCodes[self.mr.statusBooting], machine.statusCode)
+
+        machine["condor_slots"] = 4
+        self.assertEqual(machine.extras, {"condor_slots": 4})
+        self.assertEqual(machine.get(self.mr.regHostname), None)
+        self.assertNotIn(self.mr.regHostname, machine)
+        self.assertEqual(machine.pop("condor_slots"), 4)
+        self.assertEqual(dict(machine), {self.mr.regSite: "site1", self.mr.regMachineType: "machine1",
+                                         self.mr.regStatus: self.mr.statusWorking,
+                                         self.mr.regStatusLastUpdate: machine[self.mr.regStatusLastUpdate],
+                                         self.mr.statusChangeHistory: machine[self.mr.statusChangeHistory]})
@@ -22,6 +22,9 @@ from __future__ import unicode_literals
 
 import abc
 import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
 
 
 class EventBase(object):
@@ -36,25 +39,159 @@ class EventBase(object):
 class EventPublisher(object):
     __metaclass__ = abc.ABCMeta
 
+    # batch() collects events only if enabled, see beginBatch
+    batchingEnabled = False
+
     def __init__(self):
-        """(Abstract) Event manager. Registers listeners and publishes events."""
+        """(Abstract) Event manager. Registers listeners and publishes events.
+
+        Listeners may subscribe to certain event types and sites only (see eventSite). Events published by a listener
+        while handling an event are queued and delivered after it, instead of recursively. In batch mode
+        (beginBatch/endBatch), events are collected and delivered when the batch ends (see coalesceEvents). Listeners
+        registered with coalesce=True only get the combined events of a batch (see finalEvents).
+        """
         pass
 
     def init(self):
+        # [(listener, event types or None, site or None, coalesce), ...]
         self.__listener = []
+        # (event type, site) -> [(listener, coalesce), ...]
+        self.__routes = {}
+        self.__dispatch = threading.local()
+        self.__batches = threading.local()
 
     def publishEvent(self, evt):
         # type: (EventBase) -> None
-        [listener.onEvent(evt) for listener in self.__listener]
-
-    def registerListener(self, new_listener):
-        """Register a class as event listener. This class' method "onEvent" may get triggered."""
-        if new_listener not in self.__listener:
-            if not hasattr(new_listener, "onEvent"):
-                logging.error("Can't register listener %s. Method \"onEvent\" is missing."
-                              % type(new_listener).__name__)
+        # the site is resolved now, the machine may be gone when a queued/batched event is delivered
+        self.__publish(evt, self.eventSite(evt))
+
+    def __publish(self, evt, site, coalesced=None):
+        # type: (EventBase, Optional[str], Optional[bool]) -> None
+        """Deliver evt to the listeners subscribed to it.
+
+        :param coalesced: only to the listeners with (True) or without (False) coalesce, None: all
+        """
+        batch = getattr(self.__batches, "events", None)
+        if batch is not None:
+            batch.append((evt, site))
+            return
+        queue = getattr(self.__dispatch, "queue", None)
+        if queue is not None:
+            # called by a listener: deliver after the current event
+            queue.append((evt, site, coalesced))
+            return
+
+        queue = self.__dispatch.queue = deque(((evt, site, coalesced),))
+        try:
+            while queue:
+                evt, site, coalesced = queue.popleft()
+                [listener.onEvent(evt) for listener, coalesce in self.__route(evt, site)
+                 if coalesced is None or coalesce is coalesced]
+        finally:
+            self.__dispatch.queue = None
+
+    def hasListeners(self, evt, site):
+        # type: (EventBase, Optional[str]) -> bool
+        """Is any listener subscribed to events of this type and site?"""
+        return len(self.__route(evt, site)) > 0
+
+    def __route(self, evt, site):
+        # type: (EventBase, Optional[str]) -> List[object]
+        key = (type(evt), site)
+        listeners = self.__routes.get(key)
+        if listeners is None:
+            listeners = [(listener, coalesce) for listener, eventTypes, site, coalesce in self.__listener
+                         if (eventTypes is None or isinstance(evt, eventTypes)) and
+                         (site is None or site == key[1])]
+            self.__routes[key] = listeners
+        return listeners
+
+    def eventSite(self, evt):
+        # type: (EventBase) -> Optional[str]
+        """Site an event belongs to, for listeners subscribed to a single site. None: no site."""
+        return None
+
+    def registerListener(self, new_listener, eventTypes=None, site=None, coalesce=False):
+        # type: (object, Optional[Iterable[type]], Optional[str], bool) -> None
+        """Register a class as event listener. This class' method "onEvent" may get triggered.
+
+        :param eventTypes: only call onEvent for instances of these classes (None: all events)
+        :param site: only call onEvent for events of this site (None: all sites)
+        :param coalesce: in batch mode, only call onEvent for the combined events of the batch (see finalEvents)
+        """
+        if not hasattr(new_listener, "onEvent"):
+            logging.error("Can't register listener %s. Method \"onEvent\" is missing."
+                          % type(new_listener).__name__)
+        if eventTypes is not None:
+            eventTypes = tuple(eventTypes)
+        subscription = (new_listener, eventTypes, site, coalesce)
+        for i, (listener, _, _, _) in enumerate(self.__listener):
+            if listener is new_listener:
+                self.__listener[i] = subscription
+                break
+        else:
             logging.info("Registering new event listener: %s" % type(new_listener).__name__)
-            self.__listener.append(new_listener)
+            self.__listener.append(subscription)
+        self.__routes = {}
 
     def clearListeners(self):
         self.__listener = []
+        self.__routes = {}
+
+    def beginBatch(self):
+        """Collect the events published by the calling thread until endBatch is called. Batches may be nested.
+
+        Batches are per thread, events of other threads (e.g. other adapters, RPC) are delivered right away.
+        """
+        depth = getattr(self.__batches, "depth", 0)
+        if depth == 0:
+            self.__batches.events = []
+        self.__batches.depth = depth + 1
+
+    def endBatch(self):
+        """Deliver the events collected since beginBatch, when the outermost batch ends.
+
+        Listeners registered with coalesce=True get the events of finalEvents instead.
+        """
+        self.__batches.depth -= 1
+        if self.__batches.depth > 0:
+            return
+        events = self.coalesceEvents(self.__batches.events)
+        self.__batches.events = None
+        if not any(coalesce for _, _, _, coalesce in self.__listener):
+            for evt, site in events:
+                self.__publish(evt, site)
+            return
+
+        for (evt, site), final in zip(events, self.finalEvents(events)):
+            if final is evt:
+                self.__publish(evt, site)
+            else:
+                self.__publish(evt, site, coalesced=False)
+                if final is not None:
+                    self.__publish(final, site, coalesced=True)
+
+    @contextmanager
+    def batch(self):
+        """Batch mode for the enclosed block if batchingEnabled is set, see beginBatch."""
+        if self.batchingEnabled is not True:
+            yield
+            return
+        self.beginBatch()
+        try:
+            yield
+        finally:
+            self.endBatch()
+
+    def coalesceEvents(self, events):
+        # type: (List[Tuple[EventBase, Optional[str]]]) -> List[Tuple[EventBase, Optional[str]]]
+        """Filter the events of a batch ([(event, site), ...]). By default, all events are delivered in order."""
+        return events
+
+    def finalEvents(self, events):
+        # type: (List[Tuple[EventBase, Optional[str]]]) -> List[Optional[EventBase]]
+        """Events of a batch for listeners registered with coalesce=True, e.g. only the final status of each machine.
+
+        :return: per event of the batch: the event itself, an event delivered instead or None to skip it
+        """
+        return [evt for evt, site in events]
@@ -21,10 +21,12 @@
 from __future__ import unicode_literals, absolute_import
 
 import logging
+import threading
 
 from Util.PythonTools import Singleton
 from . import Event
 from . import ScaleTest
+from .MachineRegistry import MachineRegistry, StatusChangedEvent
 
 
 class EventPublisherTest(Event.EventPublisher, Singleton):
@@ -49,3 +51,99 @@ class EventManagerTest(ScaleTest.ScaleTestBase):
         emgr.publishEvent("eventstring")
 
         self.assertTrue(self.wasCalled)
+
+    def test_routing(self):
+        logging.debug("=======Testing Event Routing=======")
+        mr = MachineRegistry()
+        mr.clear()
+        received = []
+
+        class Listener(object):
+            def __init__(self, name):
+                self.name = name
+
+            def onEvent(self, evt):
+                received.append((self.name, evt.newStatus))
+                # published while handling an event: delivered after the current one
+                if evt.newStatus == mr.statusUp:
+                    mr.updateMachineStatus(evt.id, mr.statusIntegrating)
+
+        try:
+            mr.registerListener(Listener("site1"), eventTypes=(StatusChangedEvent,), site="site1")
+            mr.registerListener(Listener("site2"), eventTypes=(StatusChangedEvent,), site="site2")
+            mid = mr.newMachine()
+            mr.machines[mid][mr.regSite] = "site1"
+            mr.updateMachineStatus(mid, mr.statusUp)
+            self.assertEqual(received, [("site1", mr.statusUp), ("site1", mr.statusIntegrating)])
+
+            # batch() is a no-op unless enabled
+            del received[:]
+            with mr.batch():
+                mr.updateMachineStatus(mid, mr.statusWorking)
+                self.assertEqual(received, [("site1", mr.statusWorking)])
+
+            # batch mode: delivered at the end, intermediate statuses and removed machines included
+            mr.batchingEnabled = True
+            del received[:]
+            mid2 = mr.newMachine()
+            mr.machines[mid2][mr.regSite] = "site2"
+            with mr.batch():
+                mr.updateMachineStatus(mid, mr.statusPendingDisintegration)
+                mr.updateMachineStatus(mid, mr.statusDisintegrating)
+                mr.updateMachineStatus(mid2, mr.statusDisintegrated)
+                mr.removeMachine(mid2)
+                # events of other threads are not part of the batch
+                thread = threading.Thread(target=mr.updateMachineStatus, args=(mid, mr.statusDisintegrated))
+                thread.start()
+                thread.join()
+                self.assertEqual(received, [("site1", mr.statusDisintegrated)])
+            self.assertEqual(received, [("site1", mr.statusDisintegrated), ("site1", mr.statusPendingDisintegration),
+                                        ("site1", mr.statusDisintegrating), ("site2", mr.statusDisintegrated)])
+        finally:
+            mr.batchingEnabled = False
+            mr.clear()
+
+    def test_coalesce(self):
+        logging.debug("=======Testing Event Coalescing=======")
+        mr = MachineRegistry()
+        mr.clear()
+        received = []
+
+        class Listener(object):
+            def __init__(self, name):
+                self.name = name
+
+            def onEvent(self, evt):
+                received.append((self.name, evt.id, evt.oldStatus, evt.newStatus))
+
+        try:
+            mr.registerListener(Listener("all"), eventTypes=(StatusChangedEvent,))
+            mr.registerListener(Listener("final"), eventTypes=(StatusChangedEvent,), coalesce=True)
+            mid1, mid2 = mr.newMachine(), mr.newMachine()
+            mr.updateMachineStatus(mid1, mr.statusBooting)
+            mr.updateMachineStatus(mid2, mr.statusWorking)
+
+            mr.batchingEnabled = True
+            del received[:]
+            with mr.batch():
+                mr.updateMachineStatus(mid1, mr.statusUp)
+                mr.updateMachineStatus(mid2, mr.statusPendingDisintegration)
+                mr.updateMachineStatus(mid1, mr.statusIntegrating)
+                mr.updateMachineStatus(mid2, mr.statusWorking)
+            # every change for regular listeners, a single change from the first to the final status otherwise
+            self.assertEqual([event for event in received if event[0] == "all"],
+                             [("all", mid1, mr.statusBooting, mr.statusUp),
+                              ("all", mid2, mr.statusWorking, mr.statusPendingDisintegration),
+                              ("all", mid1, mr.statusUp, mr.statusIntegrating),
+                              ("all", mid2, mr.statusPendingDisintegration, mr.statusWorking)])
+            self.assertEqual([event for event in received if event[0] == "final"],
+                             [("final", mid1, mr.statusBooting, mr.statusIntegrating)])
+
+            # without batch, every change is delivered
+            mr.batchingEnabled = False
+            del received[:]
+            mr.updateMachineStatus(mid1, mr.statusWorking)
+            self.assertEqual(len(received), 2)
+        finally:
+            mr.batchingEnabled = False
+            mr.clear()
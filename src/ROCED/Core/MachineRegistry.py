@@ -22,8 +22,17 @@ from __future__ import unicode_literals, absolute_import
 
 import abc
 import logging
+import re
+import threading
+import time
 import uuid
-from datetime import datetime
+from collections import defaultdict, deque
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+from datetime import datetime, timedelta
 
 from Util.Logging import CsvStats
 from Util.PythonTools import Singleton
@@ -46,6 +55,8 @@ class MachineRegistry(Event.EventPublisher, Singleton):
                    statusDisintegrating, statusDisintegrated, statusDown)
 
     statusChangeHistory = "state_change_history"
+    # number of status changes kept per machine (see StatusHistory)
+    statusHistoryLength = 20
 
     regStatus = "status"
     regStatusLastUpdate = "status_last_update"
@@ -67,54 +78,150 @@ class MachineRegistry(Event.EventPublisher, Singleton):
     regVpnCert = "vpn_cert"
     regVpnCertIsValid = "vpn_cert_is_valid"
 
+    # machine keys with secondary indexes (see MachineEntry)
+    indexedKeys = frozenset((regSite, regStatus, regMachineType))
+
+    # integer status codes, ordered like list_status
+    statusCodes = dict(zip(list_status, range(len(list_status))))
+    # store machines as MachineRecord (slots, integer status codes) instead of MachineEntry (dictionary)
+    compactRecords = False
+
     def init(self):
         self.logger = logging.getLogger("MachReg")
+        # Adapters may run in parallel threads (concurrent management mode). Registry changes and the events they
+        # publish are serialized with this (re-entrant, since listeners change the registry as well) lock.
+        self.lock = threading.RLock()
+        # Optional write-ahead journal (Util.Logging.MachineRegistryJournal), receiving one record per change.
+        self.journal = None
         self.machines = dict()
         super(MachineRegistry, self).init()
 
+    @property
+    def entryType(self):
+        # type: () -> type
+        return MachineRecord if self.compactRecords is True else MachineEntry
+
+    @property
+    def machines(self):
+        # type: () -> dict
+        """Dictionary of all machines {machine_id: MachineEntry, ...}."""
+        return self.__machines
+
+    @machines.setter
+    def machines(self, machines):
+        # type: (dict) -> None
+        """Replace all machines (e.g. with a previously saved state) and rebuild the indexes."""
+        with self.lock:
+            self.__machines = dict()
+            self.__bySite = defaultdict(set)
+            self.__byStatus = defaultdict(set)
+            self.__bySiteStatus = defaultdict(set)
+            self.__count = defaultdict(int)
+            for mid, machine in machines.items():
+                history = machine.get(self.statusChangeHistory)
+                if history is not None and not isinstance(history, StatusHistory):
+                    machine = dict(machine)
+                    machine[self.statusChangeHistory] = StatusHistory.fromList(history, self.statusHistoryLength)
+                self.__machines[mid] = self.entryType(self, mid, machine)
+                self._indexMachine(mid, self.__machines[mid])
+
+    def _indexMachine(self, mid, machine):
+        # type: (str, dict) -> None
+        """Add machine to the indexes. Call with lock held."""
+        site = machine.get(self.regSite)
+        status = machine.get(self.regStatus)
+        self.__bySite[site].add(mid)
+        self.__byStatus[status].add(mid)
+        self.__bySiteStatus[(site, status)].add(mid)
+        self.__count[(site, machine.get(self.regMachineType), status)] += 1
+
+    def _unindexMachine(self, mid, machine):
+        # type: (str, dict) -> None
+        """Remove machine from the indexes. Call with lock held."""
+        site = machine.get(self.regSite)
+        status = machine.get(self.regStatus)
+        for index, key in ((self.__bySite, site), (self.__byStatus, status), (self.__bySiteStatus, (site, status))):
+            index[key].discard(mid)
+            if not index[key]:
+                del index[key]
+        key = (site, machine.get(self.regMachineType), status)
+        self.__count[key] -= 1
+        if self.__count[key] <= 0:
+            del self.__count[key]
+
     def getMachines(self, site=None, status=None, machineType=None):
         """Return MachineRegistry dictionary, filtered by variables.
 
         :return {machine_id: {a:b, c:d, e:f}, ... }
         """
-        return {mid: machine for mid, machine in self.machines.items() if
-                (site is None or machine.get(self.regSite) == site) and
-                (status is None or machine.get(self.regStatus) == status) and
-                (machineType is None or machine.get(self.regMachineType) == machineType)}
+        with self.lock:
+            if site is not None and status is not None:
+                mids = self.__bySiteStatus.get((site, status), ())
+            elif site is not None:
+                mids = self.__bySite.get(site, ())
+            elif status is not None:
+                mids = self.__byStatus.get(status, ())
+            else:
+                mids = self.__machines
+            return {mid: self.__machines[mid] for mid in mids if
+                    machineType is None or self.__machines[mid].get(self.regMachineType) == machineType}
+
+    def countMachines(self, site=None, status=None, machineType=None):
+        # type: (str, str, str) -> int
+        """Number of machines, filtered by variables. Same as len(getMachines(...)), but answered from the indexes.
+
+        Without machine type, and with site, status and machine type, this is a single lookup.
+        """
+        with self.lock:
+            if machineType is None:
+                if site is not None and status is not None:
+                    return len(self.__bySiteStatus.get((site, status), ()))
+                elif site is not None:
+                    return len(self.__bySite.get(site, ()))
+                elif status is not None:
+                    return len(self.__byStatus.get(status, ()))
+                return len(self.__machines)
+            if site is not None and status is not None:
+                return self.__count.get((site, machineType, status), 0)
+            return sum(count for (site_, machineType_, status_), count in self.__count.items() if
+                       (site is None or site_ == site) and
+                       (status is None or status_ == status) and
+                       machineType_ == machineType)
 
     def updateMachineStatus(self, mid, newStatus):
         """Change Machine status"""
-        newTime = datetime.now()
-        if self.regStatusLastUpdate in self.machines[mid]:
-            oldTime = self.machines[mid][self.regStatusLastUpdate]
-        else:
-            oldTime = newTime
-        diffTime = newTime - oldTime
+        with self.lock:
+            newTime = datetime.now()
+            if self.regStatusLastUpdate in self.machines[mid]:
+                oldTime = self.machines[mid][self.regStatusLastUpdate]
+            else:
+                oldTime = newTime
+            diffTime = newTime - oldTime
 
-        oldStatus = self.machines[mid].get(self.regStatus, None)
-        self.machines[mid][self.regStatus] = newStatus
-        self.machines[mid][self.regStatusLastUpdate] = newTime
-        self.machines[mid][self.statusChangeHistory].append({"old_status": oldStatus, "new_status": newStatus,
-                                                             "timestamp": str(newTime), "time_diff": str(diffTime)})
+            oldStatus = self.machines[mid].get(self.regStatus, None)
+            if not isinstance(self.machines[mid].get(self.statusChangeHistory), StatusHistory):
+                # not journaled, only the representation changes
+                self.machines[mid]._apply({self.statusChangeHistory: StatusHistory.fromList(
+                    self.machines[mid].get(self.statusChangeHistory, ()), self.statusHistoryLength)}, {}, ())
+            self.machines[mid].change(values={self.regStatus: newStatus, self.regStatusLastUpdate: newTime},
+                                      appendValues={self.statusChangeHistory: StatusHistory.entry(
+                                          oldStatus, newStatus, newTime, diffTime)})
 
-        if mid in self.machines and len(self.machines[mid][self.statusChangeHistory]) > 0:
+            # The statistics receive every status change, the registry only keeps the last ones.
             with CsvStats() as csv_stats:
                 csv_stats.add_item(site=self.machines[mid][self.regSite], mid=mid,
-                                   old_status=self.machines[mid][self.statusChangeHistory][-1]["old_status"],
-                                   new_status=self.machines[mid][self.statusChangeHistory][-1]["new_status"],
-                                   timestamp=self.machines[mid][self.statusChangeHistory][-1]["timestamp"],
-                                   time_diff=self.machines[mid][self.statusChangeHistory][-1]["time_diff"])
-                csv_stats.write_stats()
+                                   old_status=oldStatus, new_status=newStatus,
+                                   timestamp=str(newTime), time_diff=str(diffTime))
 
-        self.logger.info("Updating status of %s: %s -> %s" % (mid, oldStatus, newStatus))
-        self.publishEvent(StatusChangedEvent(mid, oldStatus, newStatus))
+            self.logger.info("Updating status of %s: %s -> %s" % (mid, oldStatus, newStatus))
+            self.publishEvent(StatusChangedEvent(mid, oldStatus, newStatus))
 
     def updateMachineIp(self, mid, ip):
         """Change Machine IP"""
-        self.machines[mid][self.regHostIp] = ip
+        with self.lock:
+            self.machines[mid][self.regHostIp] = ip
         self.logger.info("Updating status of %s: IP=%s" % (mid, ip))
 
-
     def calcLastStateChange(self, mid):
         # type: (str) -> int
         """Calculate time passed since last machine state change (in seconds)
@@ -128,7 +235,7 @@ class MachineRegistry(Event.EventPublisher, Singleton):
     def getMachineOverview(self):
         # type: () -> str
         """Create comma-separated list of number of machines in each state."""
-        info = "MachineState: %s" % ",".join((str(len(self.getMachines(status=status_)))
+        info = "MachineState: %s" % ",".join((str(self.countMachines(status=status_))
                                               for status_ in self.list_status))
         return info
 
@@ -138,10 +245,14 @@ class MachineRegistry(Event.EventPublisher, Singleton):
         if mid is None:
             mid = str(uuid.uuid4())
         self.logger.debug("Adding machine with id %s." % mid)
-        self.machines[mid] = dict()
-        self.machines[mid][self.regSite] = self.regSite
-        self.machines[mid][self.statusChangeHistory] = []
-        self.publishEvent(NewMachineEvent(mid))
+        with self.lock:
+            self.machines[mid] = self.entryType(self, mid, {self.regSite: self.regSite,
+                                                            self.statusChangeHistory: StatusHistory(
+                                                                maxlen=self.statusHistoryLength)})
+            self._indexMachine(mid, self.machines[mid])
+            if self.journal is not None:
+                self.journal.append({"op": "new", "mid": mid, "machine": dict(self.machines[mid])})
+            self.publishEvent(NewMachineEvent(mid))
         return mid
 
     def removeMachine(self, mid):
@@ -149,15 +260,316 @@ class MachineRegistry(Event.EventPublisher, Singleton):
         """Remove a machine entry and publish "MachineRemovedEvent" event to all listeners."""
         self.logger.debug("Removing machine with id %s." % mid)
         # Also publish machine information for possible cleanups, since it's already removed when the event occurs.
-        machine = self.machines[mid]
-        self.machines.pop(mid)
-        event = MachineRemovedEvent(mid, machine)
-        self.publishEvent(event)
+        with self.lock:
+            machine = self.machines.pop(mid)
+            self._unindexMachine(mid, machine)
+            machine.detach()
+            if self.journal is not None:
+                self.journal.append({"op": "remove", "mid": mid})
+            event = MachineRemovedEvent(mid, machine)
+            self.publishEvent(event)
+
+    def eventSite(self, evt):
+        # type: (Event.EventBase) -> Optional[str]
+        if isinstance(evt, MachineRemovedEvent):
+            return evt.machine.get(self.regSite)
+        elif isinstance(evt, MachineEvent) and evt.id in self.machines:
+            return self.machines[evt.id].get(self.regSite)
+        return None
+
+    def coalesceEvents(self, events):
+        # type: (List[Tuple[Event.EventBase, Optional[str]]]) -> List[Tuple[Event.EventBase, Optional[str]]]
+        """Drop the events no listener is subscribed to (event type and site of the machine when the event was
+        published). All other events are delivered in order, including intermediate statuses (e.g. up -> integrating)
+        and changes of machines removed in the meantime, since listeners act on exactly those."""
+        return [(evt, site) for evt, site in events if self.hasListeners(evt, site)]
+
+    def finalEvents(self, events):
+        # type: (List[Tuple[Event.EventBase, Optional[str]]]) -> List[Optional[Event.EventBase]]
+        """Combine the status changes of each machine into a single change from its first to its final status,
+        delivered in place of the last one. Machines ending up in their initial status are skipped."""
+        changes = defaultdict(list)
+        for evt, site in events:
+            if isinstance(evt, StatusChangedEvent):
+                changes[evt.id].append(evt)
+
+        final = []
+        for evt, site in events:
+            if not isinstance(evt, StatusChangedEvent):
+                final.append(evt)
+            elif evt is not changes[evt.id][-1]:
+                final.append(None)
+            elif len(changes[evt.id]) == 1:
+                final.append(evt)
+            elif changes[evt.id][0].oldStatus == evt.newStatus:
+                final.append(None)
+            else:
+                final.append(StatusChangedEvent(evt.id, changes[evt.id][0].oldStatus, evt.newStatus))
+        return final
 
     def clear(self):
         """ Clear machine registry (without raising any events). Should only be used in unit tests."""
-        self.machines = dict()
-        self.clearListeners()
+        with self.lock:
+            self.machines = dict()
+            self.clearListeners()
+
+
+class _MachineChanges(object):
+    """Registry-aware changes of a machine entry (indexes and journal), shared by MachineEntry and MachineRecord.
+
+    Subclasses provide _registry, _mid and _apply(values, appendValues, deleteKeys).
+    """
+    __slots__ = ()
+
+    def detach(self):
+        """Machine was removed from the registry, further changes don't affect indexes and journal."""
+        self._registry = None
+
+    def change(self, values=None, appendValues=None, deleteKeys=()):
+        # type: (dict, dict, Iterable[str]) -> None
+        """Set keys, append to (list) values and delete keys at once. The journal receives a single record."""
+        values = values or {}
+        appendValues = appendValues or {}
+        registry = self._registry
+        if registry is None:
+            self._apply(values, appendValues, deleteKeys)
+            return
+
+        with registry.lock:
+            reindex = any(key in registry.indexedKeys for key in list(values) + list(deleteKeys))
+            if reindex:
+                registry._unindexMachine(self._mid, self)
+            self._apply(values, appendValues, deleteKeys)
+            if reindex:
+                registry._indexMachine(self._mid, self)
+            if registry.journal is not None:
+                record = {"op": "update", "mid": self._mid}
+                if values:
+                    record["set"] = values
+                if appendValues:
+                    record["append"] = appendValues
+                if deleteKeys:
+                    record["delete"] = list(deleteKeys)
+                registry.journal.append(record)
+
+    def __setitem__(self, key, value):
+        self.change(values={key: value})
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.change(deleteKeys=(key,))
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        self.change(values=dict(*args, **kwargs))
+
+    def __reduce__(self):
+        """Copies/pickles are plain dictionaries, detached from the registry."""
+        return dict, (dict(self.items()),)
+
+
+class MachineEntry(_MachineChanges, dict):
+    def __init__(self, registry, mid, *args, **kwargs):
+        # type: (MachineRegistry, str, ...) -> None
+        """Single machine registry entry (a regular dictionary).
+
+        Changing an indexed key (site, status, machine type) updates the registry's secondary indexes. Every change
+        is written to the registry's journal, if journaling is enabled.
+        """
+        super(MachineEntry, self).__init__(*args, **kwargs)
+        self._registry = registry
+        self._mid = mid
+
+    def _apply(self, values, appendValues, deleteKeys):
+        for key, value in values.items():
+            dict.__setitem__(self, key, value)
+        for key, value in appendValues.items():
+            dict.setdefault(self, key, []).append(value)
+        for key in deleteKeys:
+            dict.__delitem__(self, key)
+
+
+class MachineRecord(_MachineChanges, MutableMapping):
+    # registry key -> slot of the core fields, all other keys are stored in "extras"
+    _slotKeys = {MachineRegistry.regStatus: "_status",
+                 MachineRegistry.regStatusLastUpdate: "_statusLastUpdate",
+                 MachineRegistry.regSite: "_site",
+                 MachineRegistry.regSiteType: "_siteType",
+                 MachineRegistry.regMachineType: "_machineType",
+                 MachineRegistry.regMachineId: "_machineId",
+                 MachineRegistry.regMachineCores: "_machineCores",
+                 MachineRegistry.regMachineLoad: "_machineLoad",
+                 MachineRegistry.regHostname: "_hostname",
+                 MachineRegistry.regHostIp: "_hostIp",
+                 MachineRegistry.statusChangeHistory: "_statusChangeHistory"}
+    __slots__ = ("_registry", "_mid", "extras") + tuple(sorted(_slotKeys.values()))
+
+    _unset = object()
+
+    def __init__(self, registry, mid, *args, **kwargs):
+        # type: (MachineRegistry, str, ...) -> None
+        """Compact machine registry entry, behaving like MachineEntry (machine[key], get, items, ...).
+
+        Core fields are stored in slots, the status as integer code (MachineRegistry.statusCodes), adapter specific
+        keys in the dictionary "extras".
+        """
+        for slot in self._slotKeys.values():
+            setattr(self, slot, self._unset)
+        self.extras = {}
+        self._registry = None
+        self._mid = mid
+        self._apply(dict(*args, **kwargs), {}, ())
+        self._registry = registry
+
+    @property
+    def statusCode(self):
+        # type: () -> Optional[int]
+        """Status as position in MachineRegistry.list_status (None: no or unknown status)."""
+        code = self._status
+        return code if isinstance(code, int) else None
+
+    def _apply(self, values, appendValues, deleteKeys):
+        for key, value in values.items():
+            self.__set(key, value)
+        for key, value in appendValues.items():
+            if key not in self:
+                self.__set(key, [])
+            self[key].append(value)
+        for key in deleteKeys:
+            if key in self._slotKeys:
+                setattr(self, self._slotKeys[key], self._unset)
+            else:
+                del self.extras[key]
+
+    def __set(self, key, value):
+        slot = self._slotKeys.get(key)
+        if slot is None:
+            self.extras[key] = value
+        elif slot == "_status":
+            self._status = MachineRegistry.statusCodes.get(value, value)
+        else:
+            setattr(self, slot, value)
+
+    def __getitem__(self, key):
+        slot = self._slotKeys.get(key)
+        if slot is None:
+            return self.extras[key]
+        value = getattr(self, slot)
+        if value is self._unset:
+            raise KeyError(key)
+        if slot == "_status" and isinstance(value, int):
+            return MachineRegistry.list_status[value]
+        return value
+
+    def __contains__(self, key):
+        slot = self._slotKeys.get(key)
+        if slot is None:
+            return key in self.extras
+        return getattr(self, slot) is not self._unset
+
+    def __iter__(self):
+        for key, slot in self._slotKeys.items():
+            if getattr(self, slot) is not self._unset:
+                yield key
+        for key in self.extras:
+            yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return "MachineRecord(%r)" % dict(self.items())
+
+
+class StatusHistory(deque):
+    """Last status changes of a machine, oldest first.
+
+    Each entry is a tuple (old status, new status, timestamp, time diff) with statuses as index of
+    MachineRegistry.list_status (-1: None, unknown statuses as string), the epoch timestamp of the change and the
+    seconds spent in the old status. JSON dumps contain these tuples as lists.
+    """
+
+    def __init__(self, iterable=(), maxlen=None):
+        super(StatusHistory, self).__init__(iterable, maxlen)
+
+    @staticmethod
+    def encodeStatus(status):
+        # type: (Optional[str]) -> Union[int, str]
+        if status is None:
+            return -1
+        return MachineRegistry.statusCodes.get(status, status)
+
+    @staticmethod
+    def decodeStatus(code):
+        # type: (Union[int, str]) -> Optional[str]
+        if isinstance(code, int):
+            return MachineRegistry.list_status[code] if code >= 0 else None
+        return code
+
+    @classmethod
+    def entry(cls, oldStatus, newStatus, timestamp, timeDiff):
+        # type: (Optional[str], str, datetime, timedelta) -> tuple
+        return (cls.encodeStatus(oldStatus), cls.encodeStatus(newStatus),
+                time.mktime(timestamp.timetuple()) + timestamp.microsecond / 1e6, timeDiff.total_seconds())
+
+    @classmethod
+    def fromList(cls, entries, maxlen=None):
+        # type: (Iterable[Union[list, dict]], int) -> StatusHistory
+        """Convert loaded entries, compact lists or dictionaries of the old format (see export)."""
+        history = cls(maxlen=maxlen)
+        for entry in entries:
+            if isinstance(entry, dict):
+                entry = cls.entry(entry.get("old_status"), entry.get("new_status"),
+                                  _parseDatetime(entry.get("timestamp")), _parseTimedelta(entry.get("time_diff")))
+            history.append(tuple(entry))
+        return history
+
+    def export(self):
+        # type: () -> List[dict]
+        """Entries in the old format: [{"old_status": .., "new_status": .., "timestamp": str(datetime),
+        "time_diff": str(timedelta)}, ...]"""
+        return [{"old_status": self.decodeStatus(oldCode),
+                 "new_status": self.decodeStatus(newCode),
+                 "timestamp": str(datetime.fromtimestamp(timestamp)),
+                 "time_diff": str(timedelta(seconds=timeDiff))}
+                for oldCode, newCode, timestamp, timeDiff in self]
+
+    def __reduce__(self):
+        return type(self), (list(self), self.maxlen)
+
+
+def _parseDatetime(value):
+    # type: (str) -> datetime
+    for format_ in ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S"):
+        try:
+            return datetime.strptime(value, format_)
+        except (TypeError, ValueError):
+            pass
+    return datetime.fromtimestamp(0)
+
+
+def _parseTimedelta(value):
+    # type: (str) -> timedelta
+    """Parse str(timedelta), e.g. "1 day, 2:03:04.500000"."""
+    match = re.match(r"(?:(-?\d+) days?, )?(\d+):(\d+):(\d+(?:\.\d+)?)$", value or "")
+    if match is None:
+        return timedelta()
+    days, hours, minutes, seconds = match.groups()
+    return timedelta(days=int(days or 0), hours=int(hours), minutes=int(minutes), seconds=float(seconds))
 
 
 class MachineEvent(Event.EventBase):
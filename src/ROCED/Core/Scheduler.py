@@ -0,0 +1,182 @@
+# ===============================================================================
+#
+# Copyright (c) 2010-2016
+# by Frank Fischer, Georg Fleig, Thomas Hauth and Stephan Riedel
+#
+# This file is part of ROCED.
+#
+# ROCED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ROCED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ROCED.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ===============================================================================
+from __future__ import unicode_literals, absolute_import
+
+import logging
+import math
+import threading
+import time
+from datetime import datetime
+
+logger = logging.getLogger("Scheduler")
+
+
+class CycleScheduler(object):
+    # What to do with cycles whose start time passed while the previous cycle was still running:
+    # skip them and continue with the next start time in the future
+    policySkip = "skip"
+    # run them immediately one after another (at most maxCatchUp of them)
+    policyCatchUp = "catch_up"
+
+    def __init__(self, function, interval, policy=policySkip, maxCatchUp=1, maxIterations=None):
+        # type: (Callable[[], None], float, str, int, Optional[int]) -> None
+        """Call function periodically at fixed start times (start + n * interval) from a single thread.
+
+        Unlike chained timers, the period does not grow with the duration of the function.
+
+        :param function: management cycle
+        :param interval: seconds between the start of two cycles
+        :param policy: policySkip or policyCatchUp, see above
+        :param maxCatchUp: number of missed cycles to run with policyCatchUp
+        :param maxIterations: stop after n cycles (None: run until stop() is called)
+        """
+        if policy not in (self.policySkip, self.policyCatchUp):
+            raise ValueError("Unknown cycle overrun policy \"%s\"." % policy)
+        self.function = function
+        self.interval = interval
+        self.policy = policy
+        self.maxCatchUp = maxCatchUp
+        self.maxIterations = maxIterations
+
+        # minimum time (seconds) between the start of the previous cycle and a cycle started by trigger()
+        self.minTriggerGap = 0
+
+        self.iterations = 0
+        self.skippedCycles = 0
+        self.triggeredCycles = 0
+        # the running (or last) cycle was started by trigger()
+        self.cycleTriggered = False
+        self.__nextCycleAt = None
+        self.__lastCycleStart = None
+        self.__cycleLag = 0.0
+        self.__triggered = False
+        self.__stopRequested = False
+        self.__wakeup = threading.Event()
+        self.__thread = None
+
+    @property
+    def nextCycleAt(self):
+        # type: () -> Optional[float]
+        """Scheduled start time (epoch seconds) of the next cycle, None if not running."""
+        return self.__nextCycleAt
+
+    @property
+    def cycleLag(self):
+        # type: () -> float
+        """Delay (seconds) between the scheduled and the actual start of the last cycle."""
+        return self.__cycleLag
+
+    @property
+    def isRunning(self):
+        return self.__nextCycleAt is not None
+
+    def start(self):
+        """Run the cycles in a separate (daemon) thread."""
+        self.__stopRequested = False
+        self.__thread = threading.Thread(target=self.run, name="CycleScheduler")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def trigger(self, reason=""):
+        # type: (str) -> None
+        """Start the next cycle early, but not before minTriggerGap seconds after the start of the previous one.
+
+        Cycles never overlap: if a cycle is running, the triggered cycle starts after it. The regular start times are
+        shifted to the triggered cycle.
+        """
+        if self.__triggered is False:
+            logger.info("Early management cycle triggered%s." % (": " + reason if reason else ""))
+        self.__triggered = True
+        self.__wakeup.set()
+
+    def stop(self, wait=False, timeout=None):
+        """Stop after the currently running cycle (if any) is finished.
+
+        :param wait: block until the scheduler thread (see start()) has ended
+        :param timeout: maximum time to wait
+        """
+        self.__stopRequested = True
+        self.__wakeup.set()
+        if wait is True and self.__thread is not None and self.__thread is not threading.current_thread():
+            self.__thread.join(timeout)
+
+    def run(self):
+        """Run the cycles in the calling thread until stop() is called or maxIterations is reached."""
+        self.__nextCycleAt = time.time()
+        try:
+            while not self.__stopRequested:
+                scheduled = self.__dueTime()
+                delay = scheduled - time.time()
+                if delay > 0:
+                    self.__wakeup.wait(delay)
+                    self.__wakeup.clear()
+                    continue
+
+                self.cycleTriggered = scheduled < self.__nextCycleAt
+                if self.cycleTriggered:
+                    # the following regular start times are shifted to this cycle
+                    self.triggeredCycles += 1
+                    scheduled = time.time()
+                self.__triggered = False
+                self.__lastCycleStart = time.time()
+                self.__cycleLag = self.__lastCycleStart - scheduled
+                try:
+                    self.function()
+                except Exception:
+                    logger.exception("Management cycle failed.")
+                self.iterations += 1
+
+                if self.maxIterations is not None and self.iterations >= self.maxIterations:
+                    break
+                self.__nextCycleAt = self.__nextStart(scheduled)
+                logger.info("Cycle took %.1fs (started %.1fs late), next cycle at %s." % (
+                    time.time() - scheduled - self.__cycleLag, self.__cycleLag,
+                    datetime.fromtimestamp(self.__nextCycleAt).strftime("%Y-%m-%d %H:%M:%S")))
+        finally:
+            self.__nextCycleAt = None
+
+    def __dueTime(self):
+        # type: () -> float
+        """Start time of the next cycle, taking a pending trigger() into account."""
+        if self.__triggered is False or self.__lastCycleStart is None:
+            return self.__nextCycleAt
+        return min(self.__nextCycleAt, self.__lastCycleStart + self.minTriggerGap)
+
+    def __nextStart(self, scheduled):
+        # type: (float) -> float
+        """Start time of the next cycle, depending on the overrun policy."""
+        nextStart = scheduled + self.interval
+        now = time.time()
+        if nextStart >= now:
+            return nextStart
+
+        missed = int(math.ceil((now - nextStart) / self.interval))
+        if self.policy == self.policyCatchUp:
+            # run (at most maxCatchUp) missed cycles right away
+            skipped = max(0, missed - self.maxCatchUp)
+        else:
+            skipped = missed
+        if skipped > 0:
+            self.skippedCycles += skipped
+            logger.warning("Management cycle overran the interval of %ss, skipping %d cycle(s)."
+                           % (self.interval, skipped))
+        return nextStart + skipped * self.interval
@@ -0,0 +1,92 @@
+# ===============================================================================
+#
+# Copyright (c) 2010-2016
+# by Frank Fischer, Georg Fleig, Thomas Hauth and Stephan Riedel
+#
+# This file is part of ROCED.
+#
+# ROCED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ROCED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ROCED.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ===============================================================================
+from __future__ import unicode_literals, absolute_import
+
+import logging
+import threading
+
+logger = logging.getLogger("Watcher")
+
+
+class RequirementWatcher(object):
+    def __init__(self, reqBox, scheduler, probeInterval=10, threshold=10):
+        # type: (RequirementBox, CycleScheduler, float, int) -> None
+        """Trigger an early management cycle if the queue changes considerably between two regular cycles.
+
+        The requirement adapters are probed every probeInterval seconds (RequirementAdapterBase.probeRequirement).
+        The baseline is probed by the management cycle when it reads the requirements (setBaseline), a change of at
+        least threshold compared to it triggers the next cycle. Requirements set via RPC are compared to the requirement of the last cycle.
+        The scheduler rate limits triggered cycles (CycleScheduler.minTriggerGap).
+        """
+        self.reqBox = reqBox
+        self.scheduler = scheduler
+        self.probeInterval = probeInterval
+        self.threshold = threshold
+
+        self.__baseline = {}
+        self.__stopEvent = threading.Event()
+        self.__thread = None
+
+    def start(self):
+        self.reqBox.setRequirementListener(self.requirementSet)
+        self.__stopEvent.clear()
+        self.__thread = threading.Thread(target=self.__run, name="RequirementWatcher")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        self.reqBox.setRequirementListener(None)
+        self.__stopEvent.set()
+
+    def __run(self):
+        while not self.__stopEvent.wait(self.probeInterval):
+            try:
+                self.check()
+            except Exception:
+                logger.exception("Requirement probe failed.")
+
+    def setBaseline(self):
+        """Probe the requirement adapters for the baseline, called by the management cycle."""
+        self.__baseline = self.reqBox.probeRequirement()
+
+    def check(self):
+        # type: () -> bool
+        """Probe the requirement adapters once, trigger a cycle if necessary.
+
+        :return: cycle triggered
+        """
+        baseline = self.__baseline
+        for adapter, value in self.reqBox.probeRequirement().items():
+            if adapter in baseline and abs(value - baseline[adapter]) >= self.threshold:
+                self.scheduler.trigger("%s queue changed from %s to %s" % (adapter.description,
+                                                                          baseline[adapter], value))
+                return True
+        return False
+
+    def requirementSet(self, adapter, requirement):
+        # type: (RequirementAdapterBase, Optional[int]) -> None
+        previous = self.reqBox.getMachineTypeRequirement(fromCache=True).get(adapter.getNeededMachineType())
+        if requirement is None or previous is None:
+            return
+        if abs(requirement - previous) >= self.threshold:
+            self.scheduler.trigger("requirement of %s set from %s to %s" % (adapter.description,
+                                                                           previous, requirement))
@@ -44,12 +44,12 @@ class FakeIntegrationAdapter(IntegrationAdapterBase):
                                      description="Site name")
         self.addOptionalConfigKeys(self.configSiteLogger, Config.ConfigTypeString,
                                    description="Logger name of Site Adapter", default="FakeInt")
-        self.mr.registerListener(self)
 
     def init(self):
         super(FakeIntegrationAdapter, self).init()
         self.logger = logging.getLogger(self.getConfig("logger_name"))
         self.siteName = self.getConfig(self.configSiteName)
+        self.mr.registerListener(self, eventTypes=(MachineRegistry.StatusChangedEvent,), site=self.siteName)
 
     def manage(self):
         [self.mr.updateMachineStatus(mid, self.mr.statusDisintegrated) for mid
@@ -45,7 +45,7 @@ class GridEngineIntegrationAdapter(IntegrationAdapterBase):
 
     def init(self):
         super(GridEngineIntegrationAdapter, self).init()
-        self.mr.registerListener(self)
+        self.mr.registerListener(self, eventTypes=(MachineRegistry.StatusChangedEvent,))
 
     def manage(self):
         """called every manage cycle"""
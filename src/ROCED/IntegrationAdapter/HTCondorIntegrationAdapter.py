@@ -27,8 +27,9 @@ from collections import defaultdict
 from datetime import datetime
 
 from Core import MachineRegistry, Config
-from IntegrationAdapter.Integration import IntegrationAdapterBase
+from IntegrationAdapter.Integration import IntegrationAdapterBase, SlotSummary
 from Util import ScaleTools
+from Util.HTCondor import HTCondorPy, htcondor
 from Util.PythonTools import Caching
 
 
@@ -42,8 +43,14 @@ class HTCondorIntegrationAdapter(IntegrationAdapterBase):
     configCondorWaitPD = "condor_wait_pd"
     configCondorWaitWorking = "condor_wait_working"
     configCondorDeadline = "condor_deadline"
+    configCondorBackend = "condor_backend"
+    configCondorCollector = "condor_collector"
 
-    # list of the different slot states for each machine, e.g. [slot1,slot2,...]
+    # query HTCondor with the command line tools (via SSH) or the python bindings
+    condorBackendCli = "cli"
+    condorBackendPython = "python"
+
+    # number of slots per state for each machine (SlotSummary)
     reg_site_condor_status = "condor_slot_status"
     reg_status_last_update = MachineRegistry.MachineRegistry.regStatusLastUpdate
     # possible slot state
@@ -100,6 +107,15 @@ class HTCondorIntegrationAdapter(IntegrationAdapterBase):
         self.addCompulsoryConfigKeys(self.configCondorDeadline, Config.ConfigTypeInt,
                                      description="Timeout (in minutes) before a machine stuck in "
                                                  "status integrating/disintegrating is considered lost.")
+        self.addOptionalConfigKeys(key=self.configCondorBackend, datatype=Config.ConfigTypeString,
+                                   description="Query the collector with the command line tools (\"%s\") or the "
+                                               "HTCondor python bindings (\"%s\")."
+                                               % (self.condorBackendCli, self.condorBackendPython),
+                                   default=self.condorBackendCli)
+        self.addOptionalConfigKeys(key=self.configCondorCollector, datatype=Config.ConfigTypeString,
+                                   description="Collector address for the python bindings (default: local "
+                                               "HTCondor configuration).",
+                                   default="")
 
         self.logger = logging.getLogger(self.getConfig(self.configIntLogger))
 
@@ -109,14 +125,43 @@ class HTCondorIntegrationAdapter(IntegrationAdapterBase):
         :return:
         """
         super(HTCondorIntegrationAdapter, self).init()
-        self.mr.registerListener(self)
+        self.mr.registerListener(self, eventTypes=(MachineRegistry.StatusChangedEvent,), site=self.siteName)
+        if self.getConfig(self.configCondorBackend) == self.condorBackendPython and htcondor is None:
+            self.logger.error("HTCondor python bindings not available, using command line tools.")
+            self.setConfig(self.configCondorBackend, self.condorBackendCli)
+
+    @classmethod
+    def summarizeSlots(cls, slots):
+        # type: (Iterable[Tuple[str, str]]) -> SlotSummary
+        """Count the slots of a machine given as [[state, activity], [state, activity], ..].
+
+        Retiring slots are counted as draining (and claimed).
+        """
+        claimed = idle = draining = drained = total = 0
+        for state, activity in slots:
+            total += 1
+            if state == cls.condorStatusClaimed:
+                claimed += 1
+            elif state in cls.condorStatusIdle:
+                idle += 1
+            elif state == cls.condorActivityDrained:
+                drained += 1
+            if activity == cls.condorStatusRetiring:
+                draining += 1
+        return SlotSummary(claimed, idle, draining, drained, total)
+
+    @classmethod
+    def getSlotSummary(cls, machine_id):
+        # type: (str) -> SlotSummary
+        return SlotSummary.fromRegistry(cls.mr.machines[machine_id].get(cls.reg_site_condor_status),
+                                        cls.summarizeSlots)
 
     @classmethod
     def calcMachineLoad(cls, machine_id):
         # type: (dict) -> float
         """Calculate machine load [interval (0,1)] & update object accordingly.
 
-        Go over all job slots and check if they are (un)claimed.
+        Check how many job slots are claimed.
         Function is made available externally since site adapters may require this information to
         terminate machines accordingly.
 
@@ -125,16 +170,12 @@ class HTCondorIntegrationAdapter(IntegrationAdapterBase):
         :return: float
         """
         machine = cls.mr.machines[machine_id]
-        cores_claimed = 0.0
-        machine[cls.mr.regMachineLoad] = 0.0
-        for slot in range(len(machine[cls.reg_site_condor_status])):
-            if machine[cls.reg_site_condor_status][slot][0] in cls.condorStatusClaimed:
-                cores_claimed += 1
-                # set a timestamp on this event
-                machine[cls.reg_status_last_update] = datetime.now()
-                # update machine load in machine object
-                machineLoad = cores_claimed / len(machine[cls.reg_site_condor_status])
-                machine[cls.mr.regMachineLoad] = machineLoad
+        slots = cls.getSlotSummary(machine_id)
+        if slots.claimed > 0:
+            # set a timestamp on this event
+            machine[cls.reg_status_last_update] = datetime.now()
+        # update machine load in machine object
+        machine[cls.mr.regMachineLoad] = slots.load
         return machine[cls.mr.regMachineLoad]
 
     @classmethod
@@ -145,18 +186,11 @@ class HTCondorIntegrationAdapter(IntegrationAdapterBase):
         :param machine_id:
         :return Tuple(int, bool):
         """
-        nDrainedSlots = 0
-        statusDraining = False
         try:
-            for slot in cls.mr.machines[machine_id][cls.reg_site_condor_status]:
-                if slot[0] == cls.condorActivityDrained:
-                    nDrainedSlots += 1
-                    statusDraining = True
-                if slot[1] == cls.condorStatusRetiring:
-                    statusDraining = True
+            slots = cls.getSlotSummary(machine_id)
         except KeyError:
-            pass
-        return nDrainedSlots, statusDraining
+            return 0, False
+        return slots.drained, slots.drained > 0 or slots.draining > 0
 
     @property
     def siteName(self):
@@ -216,8 +250,8 @@ class HTCondorIntegrationAdapter(IntegrationAdapterBase):
                     # number of cores = number of slots
                     self.mr.machines[mid][self.reg_site_condor_status] = condor_machines[
                         machine_[self.reg_site_server_node_name]]
-                    self.mr.machines[mid][self.mr.regMachineCores] = len(
-                        self.mr.machines[mid][self.reg_site_condor_status])
+                    self.mr.machines[mid][self.mr.regMachineCores] = condor_machines[
+                        machine_[self.reg_site_server_node_name]].total
                 # Machine stuck integrating? -> Disintegrated
                 elif self.mr.calcLastStateChange(mid) > condor_timeout:
                     self.mr.updateMachineStatus(mid, self.mr.statusDisintegrated)
@@ -291,13 +325,20 @@ class HTCondorIntegrationAdapter(IntegrationAdapterBase):
         return "HTCondorIntegrationAdapter"
 
     @property
-    @Caching(validityPeriod=-1, redundancyPeriod=900)
+    @Caching(validityPeriod=-1, redundancyPeriod=900, refreshInBackground=True)
     def condorList(self):
-        # type: () -> Defaultdict(List)
-        """Return list of condor machines {machine name : [[state, activity], [state, activity], ..]}
+        # type: () -> Dict[str, SlotSummary]
+        """Return list of condor machines {machine name : SlotSummary}
 
         :return: condor_machines
         """
+        if self.getConfig(self.configCondorBackend) == self.condorBackendPython:
+            try:
+                condor = HTCondorPy.get(self.getConfig(self.configCondorCollector) or None)
+                condor_slots = condor.status(constraint=self.getConfig(self.configCondorConstraint))
+            except (IOError, RuntimeError) as err:
+                raise ValueError("HTCondor collector could not be queried: %s" % err)
+            return {machine_name: self.summarizeSlots(slots) for machine_name, slots in condor_slots.items()}
 
         # load the connection settings from config
         condor_server = self.getConfig(self.configCondorServer)
@@ -320,14 +361,14 @@ class HTCondorIntegrationAdapter(IntegrationAdapterBase):
         # prepare list of condor machines
         tmp_condor_machines = self.regex_queue_parser.findall(condor_result[1])
 
-        # transform list into dictionary with one list per slot
-        # {machine name : [[state, activity], [state, activity], ..]}
-        condor_machines = defaultdict(list)
+        # transform list into dictionary with the slot states summarized per machine
+        # {machine name : SlotSummary}
+        condor_slots = defaultdict(list)
         if len(tmp_condor_machines) > 1 and any(tmp_condor_machines[0]):
             for machine_name, state, activity in tmp_condor_machines:
-                condor_machines[machine_name].append([state, activity])
+                condor_slots[machine_name].append((state, activity))
 
-        return condor_machines
+        return {machine_name: self.summarizeSlots(slots) for machine_name, slots in condor_slots.items()}
 
     @classmethod
     def drainMachine(cls, mid):
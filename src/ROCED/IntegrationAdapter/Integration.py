@@ -21,10 +21,42 @@
 from __future__ import unicode_literals, absolute_import
 
 import abc
+from collections import namedtuple
 
 from Core import Adapter, MachineRegistry
 
 
+class SlotSummary(namedtuple("SlotSummary", "claimed idle draining drained total")):
+    """Number of job slots per state of a single worker node.
+
+    Stored in the machine registry instead of one [state, activity] entry per slot. Depending on the batch system,
+    a slot may be counted in more than one state (e.g. claimed and draining); total is the number of slots.
+    JSON turns it into a plain list, use fromRegistry to read it back.
+    """
+    __slots__ = ()
+
+    @property
+    def load(self):
+        # type: () -> float
+        return float(self.claimed) / self.total if self.total > 0 else 0.0
+
+    @classmethod
+    def fromRegistry(cls, value, summarizeSlots):
+        """Slot summary from a machine registry entry.
+
+        :param value: SlotSummary, its JSON list representation or a (previous) list of [state, activity] per slot
+        :param summarizeSlots: function converting a list of [state, activity] to a SlotSummary
+        :return: SlotSummary
+        """
+        if isinstance(value, cls):
+            return value
+        elif not value:
+            return cls(0, 0, 0, 0, 0)
+        elif isinstance(value[0], (list, tuple)):
+            return summarizeSlots(value)
+        return cls(*value)
+
+
 class IntegrationAdapterBase(Adapter.AdapterBase):
     """
     IntegrationAdapters are responsible for monitoring changes in the scheduling infrastructure (batch servers!).
@@ -24,8 +24,11 @@ import logging
 
 from Core import MachineRegistry
 from Core import ScaleTest
-from IntegrationAdapter import TorqueIntegrationAdapter
+from IntegrationAdapter import HTCondorIntegrationAdapter, TorqueIntegrationAdapter
+from IntegrationAdapter.Integration import SlotSummary
+from RequirementAdapter.RequirementTest import FakeHTCondorPy
 from Util import ScaleTools
+from Util.HTCondor import HTCondorPy
 
 
 class FakeSsh(ScaleTools.Ssh):
@@ -105,3 +108,44 @@ class TorqueIntegrationAdapterTest(ScaleTest.ScaleTestBase):
         # integration.manage()
         # self.assertTrue( "python torqconf.py del_node cloud-001" in FakeSsh.ranCommands )
         # self.assertEqual( self.mr.machines[mid][self.mr.reg_status], self.mr.StatusDisintegrated )
+
+
+class HTCondorSlotSummaryTest(ScaleTest.ScaleTestBase):
+    def setUp(self):
+        self.mr = MachineRegistry.MachineRegistry()
+        self.mr.clear()
+
+    def test_slotSummary(self):
+        logging.debug("=======Testing Slot Summary=======")
+        adapter = HTCondorIntegrationAdapter.HTCondorIntegrationAdapter
+        slots = [["Claimed", "Busy"], ["Claimed", "Retiring"], ["Unclaimed", "Idle"], ["Drained", "Idle"]]
+        self.assertEqual(adapter.summarizeSlots(slots), SlotSummary(2, 1, 1, 1, 4))
+
+        mid = self.mr.newMachine()
+        # previous registry format (one entry per slot)
+        self.mr.machines[mid][adapter.reg_site_condor_status] = slots
+        self.assertEqual(adapter.calcMachineLoad(mid), 0.5)
+        self.assertEqual(adapter.calcDrainStatus(mid), (1, True))
+
+        # loaded from JSON
+        self.mr.machines[mid][adapter.reg_site_condor_status] = [0, 4, 0, 0, 4]
+        self.assertEqual(adapter.calcMachineLoad(mid), 0.0)
+        self.assertEqual(adapter.calcDrainStatus(mid), (0, False))
+
+
+class HTCondorIntegrationAdapterTest(ScaleTest.ScaleTestBase):
+    def setUp(self):
+        HTCondorPy.instances["fake-collector"] = FakeHTCondorPy(slots={
+            "cloud-001": [["Claimed", "Busy"], ["Unclaimed", "Idle"]],
+            "cloud-002": [["Drained", "Idle"]]})
+
+    def tearDown(self):
+        HTCondorPy.instances.pop("fake-collector")
+
+    def test_pythonBackend(self):
+        logging.debug("=======Testing HTCondor Integration (Python Bindings)=======")
+        adapter = HTCondorIntegrationAdapter.HTCondorIntegrationAdapter()
+        adapter.setConfig(adapter.configCondorBackend, adapter.condorBackendPython)
+        adapter.setConfig(adapter.configCondorCollector, "fake-collector")
+        self.assertEqual(adapter.condorList, {"cloud-001": SlotSummary(1, 1, 0, 0, 2),
+                                              "cloud-002": SlotSummary(0, 0, 0, 1, 1)})
@@ -23,11 +23,10 @@ from __future__ import unicode_literals, absolute_import
 import getpass
 import logging
 import pprint
-from collections import defaultdict
 from datetime import datetime
 
 from Core import MachineRegistry, Config
-from IntegrationAdapter.Integration import IntegrationAdapterBase
+from IntegrationAdapter.Integration import IntegrationAdapterBase, SlotSummary
 from Util import ScaleTools
 from Util.PythonTools import Caching
 
@@ -43,8 +42,13 @@ class SlurmIntegrationAdapter(IntegrationAdapterBase):
     configSlurmPartition = "slurm_partition"
     configSlurmWaitWorking = "slurm_wait_working"
     configSlurmDeadline = "slurm_deadline"
+    configSlurmNodeQuery = "slurm_node_query"
 
-    # list of the different slot states for each machine, e.g. [slot1,slot2,...]
+    # query all nodes with a single sinfo call or each node separately (previous behaviour)
+    slurmNodeQueryNodeList = "nodelist"
+    slurmNodeQueryPerNode = "per_node"
+
+    # number of slots (cores) per state for each machine (SlotSummary)
     reg_site_slurm_status = "slurm_slot_status"
     reg_status_last_update = MachineRegistry.MachineRegistry.regStatusLastUpdate
     # possible slot state
@@ -103,6 +107,11 @@ class SlurmIntegrationAdapter(IntegrationAdapterBase):
         self.addCompulsoryConfigKeys(self.configSlurmDeadline, Config.ConfigTypeInt,
                                      description="Timeout (in minutes) before a machine stuck in "
                                                  "status integrating/disintegrating is considered lost.")
+        self.addOptionalConfigKeys(self.configSlurmNodeQuery, Config.ConfigTypeString,
+                                   description="Query the nodes with jobs in the partition with a single sinfo call "
+                                               "(\"%s\") or with one call per node (\"%s\")."
+                                               % (self.slurmNodeQueryNodeList, self.slurmNodeQueryPerNode),
+                                   default=self.slurmNodeQueryNodeList)
 
         self.logger = logging.getLogger(self.getConfig(self.configIntLogger))
 
@@ -112,14 +121,29 @@ class SlurmIntegrationAdapter(IntegrationAdapterBase):
         :return:
         """
         super(SlurmIntegrationAdapter, self).init()
-        self.mr.registerListener(self)
+        self.mr.registerListener(self, eventTypes=(MachineRegistry.StatusChangedEvent,), site=self.siteName)
+
+    @classmethod
+    def summarizeSlots(cls, slots):
+        # type: (Iterable[List[str]]) -> SlotSummary
+        """Count the slots of a machine given as [[state, activity], [state, activity], ..]."""
+        states = [slot[0] for slot in slots]
+        return SlotSummary(states.count(cls.slurmStatusAllocated), states.count(cls.slurmStatusIdle),
+                           states.count(cls.slurmStatusDraining), states.count(cls.slurmStatusDrained),
+                           len(states))
+
+    @classmethod
+    def getSlotSummary(cls, machine_id):
+        # type: (str) -> SlotSummary
+        return SlotSummary.fromRegistry(cls.mr.machines[machine_id].get(cls.reg_site_slurm_status),
+                                        cls.summarizeSlots)
 
     @classmethod
     def calcMachineLoad(cls, machine_id):
         # type: (dict) -> float
         """Calculate machine load [interval (0,1)] & update object accordingly.
 
-        Go over all job slots and check if they are (un)claimed.
+        Check how many job slots (cores) are allocated.
         Function is made available externally since site adapters may require this information to
         terminate machines accordingly.
 
@@ -128,16 +152,12 @@ class SlurmIntegrationAdapter(IntegrationAdapterBase):
         :return: float
         """
         machine = cls.mr.machines[machine_id]
-        cores_claimed = 0.0
-        machine[cls.mr.regMachineLoad] = 0.0
-        for slot in range(len(machine[cls.reg_site_slurm_status])):
-            if machine[cls.reg_site_slurm_status][slot][0] in cls.slurmStatusAllocated:
-                cores_claimed += 1
-                # set a timestamp on this event
-                machine[cls.reg_status_last_update] = datetime.now()
-                # update machine load in machine object
-                machineLoad = cores_claimed / len(machine[cls.reg_site_slurm_status])
-                machine[cls.mr.regMachineLoad] = machineLoad
+        slots = cls.getSlotSummary(machine_id)
+        if slots.claimed > 0:
+            # set a timestamp on this event
+            machine[cls.reg_status_last_update] = datetime.now()
+        # update machine load in machine object
+        machine[cls.mr.regMachineLoad] = slots.load
         return machine[cls.mr.regMachineLoad]
 
     @classmethod
@@ -148,16 +168,12 @@ class SlurmIntegrationAdapter(IntegrationAdapterBase):
         :param machine_id:
         :return Tuple(int, bool):
         """
-        nDrainedSlots = 0
-        statusDraining = False
         try:
-            for slot in cls.mr.machines[machine_id][cls.reg_site_slurm_status]:
-                if cls.slurmStatusDraining in slot[0]  or cls.slurmStatusDrained in slot[0]:
-                    nDrainedSlots += 1
-                    statusDraining = True
+            slots = cls.getSlotSummary(machine_id)
         except KeyError:
-            pass
-        return nDrainedSlots, statusDraining
+            return 0, False
+        nDrainedSlots = slots.draining + slots.drained
+        return nDrainedSlots, nDrainedSlots > 0
 
     @property
     def siteName(self):
@@ -225,7 +241,7 @@ class SlurmIntegrationAdapter(IntegrationAdapterBase):
                     self.mr.updateMachineStatus(mid, self.mr.statusWorking)
                     # number of cores = number of slots
                     self.mr.machines[mid][self.reg_site_slurm_status] = slurm_machines[self.getSlurmHostname(machine_[self.mr.regHostIp])]
-                    self.mr.machines[mid][self.mr.regMachineCores] = len(self.mr.machines[mid][self.reg_site_slurm_status])
+                    self.mr.machines[mid][self.mr.regMachineCores] = self.mr.machines[mid][self.reg_site_slurm_status].total
                 # Machine stuck integrating? -> Disintegrated
                 elif self.mr.calcLastStateChange(mid) > slurm_timeout:
                     self.logger.debug("Working stuck integrating -> statusDisintegrated")
@@ -333,10 +349,10 @@ class SlurmIntegrationAdapter(IntegrationAdapterBase):
         return "SlurmIntegrationAdapter"
 
     @property
-    @Caching(validityPeriod=-1, redundancyPeriod=900)
+    @Caching(validityPeriod=-1, redundancyPeriod=900, refreshInBackground=True)
     def slurmList(self):
-        # type: () -> Defaultdict(List)
-        """Return list of slurm machines {machine name : [[state, activity], [state, activity], ..]}
+        # type: () -> Dict[str, SlotSummary]
+        """Return list of slurm machines {machine name : SlotSummary}
 
         :return: slurm_machines
         """
@@ -354,7 +370,7 @@ class SlurmIntegrationAdapter(IntegrationAdapterBase):
 
         #this outputs those nodes which are used by a job of this queue. It ignores most "down", "drained" and "draining" machines
         #in addition, one could just get the machines which are draining or drained. It might not matter which service cancels the job
-        #first determine the list of nodes, then make the ssh call for each of them again for sinfo
+        #first determine the list of nodes, then query sinfo for all of them at once (or for each node, see slurm_node_query)
 
         # Find all nodes assigned a job in this particular slurm_partition queue
         cmd = ("squeue -p {} -h --format=%N  | sort | uniq".format(slurm_partition))
@@ -364,25 +380,18 @@ class SlurmIntegrationAdapter(IntegrationAdapterBase):
         else: 
             nodes_this_partition = nodes_from_squeue[1].split('\n')
 
+        nodes_this_partition = [nn for nn in nodes_this_partition if nn != ""]
         self.logger.debug("Querying information for these nodes {}".format( nodes_this_partition))
 
-        slurm_result_status = 0
-        slurm_result_sinfos = ""
-        slurm_ssh_error = ""
-        for nn in nodes_this_partition:
-            if nn == "":
-                continue
-            # for each of these nodes, query its sinfo status 
-            #     in the form <hostname>,<CPU-State: allocated/idle/other/total>,<host state>
-            cmd =  ("sinfo -h -l -N -p {} -n {} --format %n,%C,%T" ).format( slurm_partition , nn)
-            slurm_result_nn = slurm_ssh.handleSshCall(call=cmd, quiet=True)
-            slurm_result_status += slurm_result_nn[0]
-            slurm_result_sinfos += slurm_result_nn[1] + "\n"
-            slurm_ssh_error += str( slurm_result_nn[2] )
-
-        
-        #put slurm_result together in the way it is needed:
-        slurm_result = (slurm_result_status,  slurm_result_sinfos , slurm_ssh_error)
+        if self.getConfig(self.configSlurmNodeQuery) == self.slurmNodeQueryPerNode:
+            slurm_result = self._sinfoPerNode(slurm_ssh, slurm_partition, nodes_this_partition)
+        elif nodes_this_partition:
+            # one call for all nodes, sinfo accepts a comma separated list of node names/expressions
+            cmd = ("sinfo -h -N -p {} -n {} --format %n,%C,%T").format(slurm_partition,
+                                                                       ",".join(nodes_this_partition))
+            slurm_result = slurm_ssh.handleSshCall(call=cmd, quiet=True)
+        else:
+            slurm_result = (nodes_from_squeue[0], "", nodes_from_squeue[2])
         self.logger.debug("slurm_result: {}".format(slurm_result))
 
         # get a list of the slurm machines (SSH)
@@ -402,7 +411,7 @@ class SlurmIntegrationAdapter(IntegrationAdapterBase):
         logging.debug("Trying to parse sinfo output" )
         tmp_slurm_machines=self.parse_sinfo_output(slurm_result[1])
 
-        slurm_machines = defaultdict(list)
+        slurm_machines = {}
         for node in tmp_slurm_machines:
             
             # ignore invalid lines
@@ -425,23 +434,37 @@ class SlurmIntegrationAdapter(IntegrationAdapterBase):
             idleCPUs = int(cpus[1])
             totalCPUs = int(cpus[3])
 
-            for slot in range(totalCPUs):
-                if allocatedCPUs > 0:
-                    slurm_machines[machine_name].append(['allocated', None])
-                    allocatedCPUs = allocatedCPUs - 1
-                elif idleCPUs > 0:
-                    slurm_machines[machine_name].append(['idle', None])
-                    idleCPUs = idleCPUs - 1
-                elif "draining" in state:
-                    slurm_machines[machine_name].append(['draining', None])
-                elif "drained" in state:
-                    slurm_machines[machine_name].append(['drained', None])
-                else:
-                    print "WARNING!!! this is a bug!"
+            # remaining CPUs of draining/drained machines are counted as draining/drained, others are ignored
+            otherCPUs = max(totalCPUs - allocatedCPUs - idleCPUs, 0)
+            drainingCPUs = otherCPUs if self.slurmStatusDraining in state else 0
+            drainedCPUs = otherCPUs if self.slurmStatusDrained in state and drainingCPUs == 0 else 0
+            if otherCPUs > drainingCPUs + drainedCPUs:
+                self.logger.warning("Unexpected CPU state of %s: %s,%s" % (machine_name, node[1], state))
+            slurm_machines[machine_name] = SlotSummary(allocatedCPUs, idleCPUs, drainingCPUs, drainedCPUs,
+                                                       allocatedCPUs + idleCPUs + drainingCPUs + drainedCPUs)
 
         return slurm_machines
 
 
+    def _sinfoPerNode(self, slurm_ssh, slurm_partition, nodes):
+        # type: (ScaleTools.Ssh, str, List[str]) -> Tuple[int, str, str]
+        """Query sinfo with one SSH call per node and put the results together like a single call.
+
+        :return: summed return code, sinfo output, SSH errors
+        """
+        slurm_result_status = 0
+        slurm_result_sinfos = ""
+        slurm_ssh_error = ""
+        for nn in nodes:
+            # for each of these nodes, query its sinfo status
+            #     in the form <hostname>,<CPU-State: allocated/idle/other/total>,<host state>
+            cmd = ("sinfo -h -l -N -p {} -n {} --format %n,%C,%T").format(slurm_partition, nn)
+            slurm_result_nn = slurm_ssh.handleSshCall(call=cmd, quiet=True)
+            slurm_result_status += slurm_result_nn[0]
+            slurm_result_sinfos += slurm_result_nn[1] + "\n"
+            slurm_ssh_error += str(slurm_result_nn[2])
+        return slurm_result_status, slurm_result_sinfos, slurm_ssh_error
+
     @classmethod
     def drainMachine(cls, mid):
         # type: (dict) -> None
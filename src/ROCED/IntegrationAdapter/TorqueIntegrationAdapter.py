@@ -67,7 +67,7 @@ class TorqueIntegrationAdapter(IntegrationAdapterBase):
 
     def init(self):
         super(TorqueIntegrationAdapter, self).init()
-        self.mr.registerListener(self)
+        self.mr.registerListener(self, eventTypes=(MachineRegistry.StatusChangedEvent,))
 
     def manage(self):
 
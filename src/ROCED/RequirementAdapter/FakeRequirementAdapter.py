@@ -54,6 +54,9 @@ class FakeRequirementAdapter(RequirementAdapterBase):
     def description(self):
         return "FakeRequirementAdapter"
 
+    def probeRequirement(self):
+        return self._curRequirement
+
     @property
     def requirement(self):
         if self.completeJobs is False:
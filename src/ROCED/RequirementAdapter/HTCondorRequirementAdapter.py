@@ -26,6 +26,7 @@ import logging
 from Core import Config
 from RequirementAdapter.Requirement import RequirementAdapterBase
 from Util import Logging, ScaleTools
+from Util.HTCondor import HTCondorPy, htcondor
 from Util.PythonTools import Caching
 
 
@@ -36,6 +37,12 @@ class HTCondorRequirementAdapter(RequirementAdapterBase):
     configCondorServer = "condor_server"
     configCondorRequirement = "condor_requirement"
     configCondorConstraint = "condor_constraint"
+    configCondorBackend = "condor_backend"
+    configCondorCollector = "condor_collector"
+
+    # query HTCondor with the command line tools (via SSH) or the python bindings
+    condorBackendCli = "cli"
+    condorBackendPython = "python"
 
     # See https://htcondor-wiki.cs.wisc.edu/index.cgi/wiki?p=MagicNumbers
     condorStatusIdle = 1
@@ -72,41 +79,63 @@ class HTCondorRequirementAdapter(RequirementAdapterBase):
         self.addOptionalConfigKeys(key=self.configCondorConstraint, datatype=Config.ConfigTypeString,
                                    description="ClassAd constraint in condor_q expression",
                                    default="True")
+        self.addOptionalConfigKeys(key=self.configCondorBackend, datatype=Config.ConfigTypeString,
+                                   description="Query the queue with the command line tools (\"%s\") or the HTCondor "
+                                               "python bindings (\"%s\")."
+                                               % (self.condorBackendCli, self.condorBackendPython),
+                                   default=self.condorBackendCli)
+        self.addOptionalConfigKeys(key=self.configCondorCollector, datatype=Config.ConfigTypeString,
+                                   description="Collector address for the python bindings (default: local "
+                                               "HTCondor configuration).",
+                                   default="")
 
         self.logger = logging.getLogger("HTCondorReq")
         self.__str__ = self.description
 
     def init(self):
         super(HTCondorRequirementAdapter, self).init()
+        if self.getConfig(self.configCondorBackend) == self.condorBackendPython and htcondor is None:
+            self.logger.error("HTCondor python bindings not available, using command line tools.")
+            self.setConfig(self.configCondorBackend, self.condorBackendCli)
 
     @property
     def description(self):
         return "HTCondorRequirementAdapter"
 
     @property
-    @Caching(validityPeriod=-1, redundancyPeriod=900)
     def requirement(self):
-        ssh = ScaleTools.Ssh(host=self.getConfig(self.configCondorServer),
-                             username=self.getConfig(self.configCondorUser),
-                             key=self.getConfig(self.configCondorKey))
+        queue_summary = self._queueSummary()
+        if queue_summary is None:
+            return None
+        required_cpus_total, required_cpus_idle_jobs, required_cpus_running_jobs = queue_summary
 
-        # Target.Requirements can't be filtered with -constraints since it would require ClassAd based regex matching.
-        # TODO: Find a more generic way to match resources/requirements (condor_q -slotads ??)
-        # cmd_idle = "condor_q -constraint 'JobStatus == 1' -slotads slotads_bwforcluster " \
-        #            "-analyze:summary,reverse | tail -n1 | awk -F ' ' " \
-        #            "'{print $3 "\n" $4}'| sort -n | head -n1"
-        constraint = "( %s ) && ( %s )" % (self._query_constraints, self.getConfig(self.configCondorConstraint))
+        # cores->machines: machine definition required for RequirementAdapter
+        n_cores = - int(self.getConfig(self.configMachines)[self.getNeededMachineType()]["cores"])
+        self._curRequirement = - (required_cpus_total // n_cores)
 
-        cmd = ("condor_q -global -allusers -nobatch -constraint '%s' %s" % (constraint, self._query_format_string))
-        result = ssh.handleSshCall(call=cmd, quiet=True)
-        if result[0] != 0:
-            self.logger.warning("Could not get HTCondor queue status! %d: %s" % (result[0], result[2]))
-            return None
-        elif any(error_string in result[1] for error_string in self._CLI_error_strings):
-            self.logger.warning("condor_q request timed out.")
+        with Logging.JsonLog() as json_log:
+            json_log.addItem(self.getNeededMachineType(), "jobs_idle", required_cpus_idle_jobs)
+            json_log.addItem(self.getNeededMachineType(), "jobs_running", required_cpus_running_jobs)
+
+        return self._curRequirement
+
+    def invalidateRequirement(self):
+        self._queueSummary.invalidate()
+
+    @Caching(validityPeriod=-1, redundancyPeriod=900, refreshInBackground=True)
+    def _queueSummary(self):
+        # type: () -> Optional[Tuple[int, int, int]]
+        """Query the queue, possibly in a background refresh thread, therefore without side effects.
+
+        :return: cores requested by all, idle and running jobs or None on errors
+        """
+        if self.getConfig(self.configCondorBackend) == self.condorBackendPython:
+            queue_line = self._queueFromBindings()
+        else:
+            queue_line = self._queueFromCli()
+        if queue_line is None:
             return None
 
-        queue_line = (entry.split(",", 3) for entry in str(result[1]).splitlines())
         converted_line = ((int(status), int(cores), requirement) for status, cores, requirement in queue_line)
         if self.getConfig(self.configCondorRequirement):
             # TODO: We could use ClassAd bindings, to check requirement(s)
@@ -133,16 +162,77 @@ class HTCondorRequirementAdapter(RequirementAdapterBase):
 
         self.logger.debug("HTCondor queue: Idle: %d; Running: %d." %
                           (required_cpus_idle_jobs, required_cpus_running_jobs))
+        return required_cpus_total, required_cpus_idle_jobs, required_cpus_running_jobs
+
+    def probeRequirement(self):
+        # type: () -> Optional[int]
+        """Number of cores requested by idle jobs, without the (large) Requirements expressions."""
+        constraint = "RoutedToJobId =?= undefined && JobStatus == %d && ( %s )" % (
+            self.condorStatusIdle, self.getConfig(self.configCondorConstraint))
+        if self.getConfig(self.configCondorBackend) == self.condorBackendPython:
+            try:
+                condor = HTCondorPy.get(self.getConfig(self.configCondorCollector) or None)
+                return sum(int(ad.get("RequestCpus", 1))
+                           for ad in condor.jobs(constraint=constraint, projection=("RequestCpus",)))
+            except (IOError, RuntimeError) as err:
+                self.logger.warning("Could not probe HTCondor queue! %s" % err)
+                return None
 
-        # cores->machines: machine definition required for RequirementAdapter
-        n_cores = - int(self.getConfig(self.configMachines)[self.getNeededMachineType()]["cores"])
-        self._curRequirement = - (required_cpus_total // n_cores)
+        ssh = ScaleTools.Ssh(host=self.getConfig(self.configCondorServer),
+                             username=self.getConfig(self.configCondorUser),
+                             key=self.getConfig(self.configCondorKey))
+        cmd = "condor_q -global -allusers -nobatch -constraint '%s' -autoformat:r RequestCpus" % constraint
+        result = ssh.handleSshCall(call=cmd, quiet=True)
+        if result[0] != 0 or any(error_string in result[1] for error_string in self._CLI_error_strings):
+            self.logger.warning("Could not probe HTCondor queue! %d: %s" % (result[0], result[2]))
+            return None
+        try:
+            return sum(int(line) for line in str(result[1]).split())
+        except ValueError:
+            return None
 
-        with Logging.JsonLog() as json_log:
-            json_log.addItem(self.getNeededMachineType(), "jobs_idle", required_cpus_idle_jobs)
-            json_log.addItem(self.getNeededMachineType(), "jobs_running", required_cpus_running_jobs)
+    def _queueFromCli(self):
+        # type: () -> Optional[Iterator[List[str]]]
+        """Query the queue with condor_q (via SSH).
 
-        return self._curRequirement
+        :return: [status, cores, requirement] per job or None on errors
+        """
+        ssh = ScaleTools.Ssh(host=self.getConfig(self.configCondorServer),
+                             username=self.getConfig(self.configCondorUser),
+                             key=self.getConfig(self.configCondorKey))
+
+        # Target.Requirements can't be filtered with -constraints since it would require ClassAd based regex matching.
+        # TODO: Find a more generic way to match resources/requirements (condor_q -slotads ??)
+        # cmd_idle = "condor_q -constraint 'JobStatus == 1' -slotads slotads_bwforcluster " \
+        #            "-analyze:summary,reverse | tail -n1 | awk -F ' ' " \
+        #            "'{print $3 "\n" $4}'| sort -n | head -n1"
+        constraint = "( %s ) && ( %s )" % (self._query_constraints, self.getConfig(self.configCondorConstraint))
+
+        cmd = ("condor_q -global -allusers -nobatch -constraint '%s' %s" % (constraint, self._query_format_string))
+        result = ssh.handleSshCall(call=cmd, quiet=True)
+        if result[0] != 0:
+            self.logger.warning("Could not get HTCondor queue status! %d: %s" % (result[0], result[2]))
+            return None
+        elif any(error_string in result[1] for error_string in self._CLI_error_strings):
+            self.logger.warning("condor_q request timed out.")
+            return None
+
+        return (entry.split(",", 3) for entry in str(result[1]).splitlines())
+
+    def _queueFromBindings(self):
+        # type: () -> Optional[List[Tuple[int, int, str]]]
+        """Query the queue of all schedds with the HTCondor python bindings.
+
+        :return: (status, cores, requirement) per job or None on errors
+        """
+        try:
+            condor = HTCondorPy.get(self.getConfig(self.configCondorCollector) or None)
+            return [(ad.get("JobStatus"), ad.get("RequestCpus", 1), str(ad.get("Requirements", "")))
+                    for ad in condor.jobs(constraint=self.getConfig(self.configCondorConstraint),
+                                          projection=("JobStatus", "RequestCpus", "Requirements"))]
+        except (IOError, RuntimeError) as err:
+            self.logger.warning("Could not get HTCondor queue status! %s" % err)
+            return None
 
     def getNeededMachineType(self):
         # TODO: Handle multiple machine types!
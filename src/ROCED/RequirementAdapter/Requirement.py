@@ -26,6 +26,7 @@ The broker then decides how many machines have to be started.
 """
 
 import abc
+import logging
 
 from Core.Adapter import AdapterBase, AdapterBoxBase
 
@@ -39,13 +40,18 @@ class RequirementAdapterBase(AdapterBase):
         super(RequirementAdapterBase, self).__init__()
         self._curRequirement = 0
         self._machineType = machineType
+        # called with (adapter, requirement) when the requirement is set via RPC
+        self.requirementListener = None
         self.setConfig(self.ConfigReqName, "DefaultReq")
 
     def init(self):
         super(RequirementAdapterBase, self).init()
-        self.exportMethod(lambda requirement_: self.__setattr__(name="requirement",
-                                                                value=requirement_),
-                          type(self).__name__ + "_setRequirement")
+        self.exportMethod(self._setRequirement, type(self).__name__ + "_setRequirement")
+
+    def _setRequirement(self, requirement_):
+        self.requirement = requirement_
+        if self.requirementListener is not None:
+            self.requirementListener(self, self._curRequirement)
 
     @property
     def name(self):
@@ -72,6 +78,19 @@ class RequirementAdapterBase(AdapterBase):
             requirement_ = None
         self._curRequirement = requirement_
 
+    def invalidateRequirement(self):
+        """Drop the cached requirement (if the adapter caches it), the next call queries the batch system."""
+        invalidate = getattr(type(self).requirement.fget, "invalidate", None)
+        if invalidate is not None:
+            invalidate(self)
+
+    def probeRequirement(self):
+        """Cheap indicator of the queue state (e.g. number of idle jobs) checked between management cycles.
+
+        Only changes of the value are evaluated, it doesn't need to be a number of machines.
+        None: not supported by this adapter."""
+        return None
+
     def getNeededMachineType(self):
         return self._machineType
 
@@ -90,11 +109,13 @@ class RequirementBox(AdapterBoxBase):
 
         needDict = dict()
 
-        for adapter in self._adapterList:
+        # Timed out requirement queries (concurrent mode) are handled like failed ones.
+        requirements = self.callAdapters(lambda adapter: adapter.requirement, phase="requirement")
+
+        for adapter, curReq in zip(self._adapterList, requirements):
             if adapter.getNeededMachineType() not in needDict:
                 needDict[adapter.getNeededMachineType()] = 0
 
-            curReq = adapter.requirement
             if curReq is not None:
                 needDict[adapter.getNeededMachineType()] += int(curReq)
             else:
@@ -104,5 +125,30 @@ class RequirementBox(AdapterBoxBase):
 
         return needDict
 
+    def probeRequirement(self):
+        """Probe all adapters supporting it, see RequirementAdapterBase.probeRequirement.
+
+        Format: {adapter: value}"""
+        probes = dict()
+        for adapter in self._adapterList:
+            try:
+                value = adapter.probeRequirement()
+            except Exception:
+                logging.exception("Requirement probe of %s failed." % adapter.name)
+                continue
+            if value is not None:
+                probes[adapter] = value
+        return probes
+
+    def invalidateRequirement(self):
+        """Drop the cached requirements, see RequirementAdapterBase.invalidateRequirement."""
+        for adapter in self._adapterList:
+            adapter.invalidateRequirement()
+
+    def setRequirementListener(self, listener):
+        """Call listener(adapter, requirement) when the requirement of an adapter is set via RPC."""
+        for adapter in self._adapterList:
+            adapter.requirementListener = listener
+
     def manage(self):
         pass
@@ -21,9 +21,13 @@
 from __future__ import unicode_literals, absolute_import
 
 import logging
+import time
 
 from Core import ScaleTest
 from RequirementAdapter import Requirement
+from RequirementAdapter.HTCondorRequirementAdapter import HTCondorRequirementAdapter
+from Util.HTCondor import HTCondorPy
+from Util.PythonTools import Caching
 
 
 class RequirementAdapterTest(Requirement.RequirementAdapterBase):
@@ -66,3 +70,68 @@ class RequirementBoxTest(ScaleTest.ScaleTestBase):
         self.assertEqual(len(box.getMachineTypeRequirement()), 3)
         self.assertEqual(box.getMachineTypeRequirement()["type2"], 5)
         logging.info(str(box.getMachineTypeRequirement()))
+
+
+class FakeHTCondorPy(object):
+    """Stand-in for HTCondorPy, returning predefined ClassAds instead of querying a collector."""
+
+    def __init__(self, jobs=(), slots=None):
+        self.jobAds = list(jobs)
+        self.slots = slots or {}
+
+    def jobs(self, constraint=True, projection=()):
+        return iter(self.jobAds)
+
+    def status(self, constraint=True):
+        return self.slots
+
+
+class HTCondorRequirementAdapterTest(ScaleTest.ScaleTestBase):
+    def setUp(self):
+        HTCondorPy.instances["fake-collector"] = FakeHTCondorPy(jobs=[
+            {"JobStatus": HTCondorPy.jobStatusIdle, "RequestCpus": 4, "Requirements": "TARGET.CloudSite == \"a\""},
+            {"JobStatus": HTCondorPy.jobStatusRunning, "RequestCpus": 2, "Requirements": "TARGET.CloudSite == \"b\""},
+            {"JobStatus": HTCondorPy.jobStatusRunning, "RequestCpus": 1, "Requirements": "TARGET.CloudSite == \"a\""}])
+
+    def tearDown(self):
+        HTCondorPy.instances.pop("fake-collector")
+
+    def test_pythonBackend(self):
+        logging.debug("=======Testing HTCondor Requirement (Python Bindings)=======")
+        adapter = HTCondorRequirementAdapter()
+        adapter.setConfig(adapter.configMachines, {"vm": {"cores": 4}})
+        adapter.setConfig(adapter.configCondorBackend, adapter.condorBackendPython)
+        adapter.setConfig(adapter.configCondorCollector, "fake-collector")
+        self.assertEqual(adapter.requirement, 2)
+
+        adapter.setConfig(adapter.configCondorRequirement, "CloudSite == \"a\"")
+        self.assertEqual(adapter.requirement, 2)
+        adapter.setConfig(adapter.configCondorRequirement, "CloudSite == \"b\"")
+        self.assertEqual(adapter.requirement, 1)
+
+    def test_backgroundRefresh(self):
+        logging.debug("=======Testing HTCondor Requirement (Background Refresh)=======")
+        adapter = HTCondorRequirementAdapter()
+        adapter.setConfig(adapter.configMachines, {"vm": {"cores": 4}})
+        adapter.setConfig(adapter.configCondorBackend, adapter.condorBackendPython)
+        adapter.setConfig(adapter.configCondorCollector, "fake-collector")
+        condor = HTCondorPy.instances["fake-collector"]
+        Caching.backgroundRefresh = True
+        try:
+            self.assertEqual(adapter.requirement, 2)
+            condor.jobAds.append({"JobStatus": HTCondorPy.jobStatusIdle, "RequestCpus": 8, "Requirements": ""})
+            # stale value, the queue is queried in the background
+            self.assertEqual(adapter.requirement, 2)
+            for _ in range(100):
+                if HTCondorRequirementAdapter._queueSummary.cache.peek(adapter) == (15, 12, 3):
+                    break
+                time.sleep(0.01)
+            # the refresh thread doesn't change the requirement of the current cycle
+            self.assertEqual(adapter._curRequirement, 2)
+            self.assertEqual(adapter.requirement, 4)
+
+            condor.jobAds.pop()
+            adapter.invalidateRequirement()
+            self.assertEqual(adapter.requirement, 2)
+        finally:
+            Caching.backgroundRefresh = False
@@ -87,8 +87,32 @@ class SlurmRequirementAdapter(RequirementAdapterBase):
         return "SlurmRequirementAdapter"
 
     @property
-    @Caching(validityPeriod=-1, redundancyPeriod=900)
     def requirement(self):
+        queue_summary = self._queueSummary()
+        if queue_summary is None:
+            return None
+        required_cpus_total, required_cpus_idle_jobs, required_cpus_running_jobs = queue_summary
+
+        # cores->machines: machine definition required for RequirementAdapter
+        n_cores = - int(self.getConfig(self.configMachines)[self.getNeededMachineType()]["cores"])
+        self._curRequirement = - (required_cpus_total // n_cores)
+
+        with Logging.JsonLog() as json_log:
+            json_log.addItem(self.getNeededMachineType(), "jobs_idle", required_cpus_idle_jobs)
+            json_log.addItem(self.getNeededMachineType(), "jobs_running", required_cpus_running_jobs)
+
+        return self._curRequirement
+
+    def invalidateRequirement(self):
+        self._queueSummary.invalidate()
+
+    @Caching(validityPeriod=-1, redundancyPeriod=900, refreshInBackground=True)
+    def _queueSummary(self):
+        # type: () -> Optional[Tuple[int, int, int]]
+        """Query the queue, possibly in a background refresh thread, therefore without side effects.
+
+        :return: cores requested by all, idle and running jobs or None on errors
+        """
         ssh = ScaleTools.Ssh(host=self.getConfig(self.configSlurmServer),
                              username=self.getConfig(self.configSlurmUser),
                              key=self.getConfig(self.configSlurmKey))
@@ -146,19 +170,11 @@ class SlurmRequirementAdapter(RequirementAdapterBase):
         self.logger.debug("Slurm queue: Idle: %d; Running: %d. in partition: %s." %
                           (required_cpus_idle_jobs, required_cpus_running_jobs, self.getConfig(self.configSlurmPartition) ))
 
-        # cores->machines: machine definition required for RequirementAdapter
-        n_cores = - int(self.getConfig(self.configMachines)[self.getNeededMachineType()]["cores"])
-        self._curRequirement = - (required_cpus_total // n_cores)
-
 	self.logger.debug("Required CPUs total=%s" % required_cpus_total)
         self.logger.debug("Required CPUs idle Jobs=%s" % required_cpus_idle_jobs)
         self.logger.debug("Required CPUs running Jobs=%s" % required_cpus_running_jobs)
         self.logger.debug("CPUs dependency Jobs=%s" % cpus_dependency_jobs)
-        with Logging.JsonLog() as json_log:
-            json_log.addItem(self.getNeededMachineType(), "jobs_idle", required_cpus_idle_jobs)
-            json_log.addItem(self.getNeededMachineType(), "jobs_running", required_cpus_running_jobs)
-
-        return self._curRequirement
+        return required_cpus_total, required_cpus_idle_jobs, required_cpus_running_jobs
 
     def getNeededMachineType(self):
         # TODO: Handle multiple machine types!
@@ -23,6 +23,9 @@ from __future__ import unicode_literals, absolute_import
 import logging
 import re
 import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
 try:
     import boto3
@@ -58,6 +61,9 @@ class Ec2SiteAdapter(SiteAdapterBase):
     configMinCount = "min_count"
     configMaxCount = "max_count"
     configOwnerID = "owner_id"
+    configRegion = "region"
+    configInstanceTag = "instance_tag"
+    configCleanupInterval = "cleanup_interval"
 
     # keywords for EC2
     ec2 = "ec2"
@@ -77,6 +83,13 @@ class Ec2SiteAdapter(SiteAdapterBase):
     stop = "stop"
     terminate = "terminate"
 
+    # maximum number of instance ids per start/stop/terminate request
+    batchSize = 1000
+
+    # EC2 clients of long-lived boto3 sessions, shared by all adapters of the same region, see getEc2Client
+    __clients = {}
+    __clientsLock = threading.Lock()
+
     def __init__(self):
         """Init function
 
@@ -115,6 +128,21 @@ class Ec2SiteAdapter(SiteAdapterBase):
                                    default=None)
         self.addCompulsoryConfigKeys(self.configOwnerID, Config.ConfigTypeString,
                                      description="Owner ID in Amazon EC2")
+        self.addOptionalConfigKeys(self.configRegion, Config.ConfigTypeString,
+                                   description="EC2 region (default: region of the boto3 configuration)",
+                                   default=None)
+        self.addOptionalConfigKeys(self.configInstanceTag, Config.ConfigTypeString,
+                                   description="Tag (key=value) of spawned machines, only machines with this tag "
+                                               "(and the service machines) are listed",
+                                   default=None)
+        self.addOptionalConfigKeys(self.configCleanupInterval, Config.ConfigTypeInt,
+                                   description="Seconds between two cleanups of unused volumes and snapshots "
+                                               "(0: disabled)",
+                                   default=3600)
+
+        self.__cleanupPool = None
+        self.__cleanupResult = None
+        self.__lastCleanup = 0
 
     def init(self):
         super(Ec2SiteAdapter, self).init()
@@ -137,22 +165,77 @@ class Ec2SiteAdapter(SiteAdapterBase):
 
         self.mr.registerListener(self)
 
-    def getEC2Machines(self):
+        self.__cleanupPool = ThreadPool(processes=1)
+
+    def shutdown(self):
+        """wait for a running cleanup, see scheduleCleanup"""
+        if self.__cleanupPool is not None:
+            self.__cleanupPool.close()
+            self.__cleanupPool.join()
+            self.__cleanupPool = None
+
+    @classmethod
+    def getEc2Client(cls, region=None):
+        """EC2 client of region, created once and shared (boto3 clients are thread safe)."""
+        with cls.__clientsLock:
+            if region not in cls.__clients:
+                cls.__clients[region] = boto3.session.Session(region_name=region).client(cls.ec2)
+            return cls.__clients[region]
+
+    @property
+    def client(self):
+        return self.getEc2Client(self.getConfig(self.configRegion))
+
+    @property
+    def serviceIDs(self):
+        # type: () -> list
+        return (self.getConfig(self.configServiceIDs) or "").split()
+
+    @property
+    def instanceTag(self):
+        # type: () -> Optional[Tuple[str, str]]
+        """(key, value) of the configured instance tag or None."""
+        if not self.getConfig(self.configInstanceTag):
+            return None
+        key, _, value = self.getConfig(self.configInstanceTag).partition("=")
+        return key.strip(), value.strip()
+
+    def __listInstances(self, filters):
+        instance_ids = list()
+        for page in self.client.get_paginator("describe_instances").paginate(Filters=filters):
+            for reservation in page["Reservations"]:
+                instance_ids.extend(instance[self.ec2_instance_id] for instance in reservation["Instances"])
+        return instance_ids
+
+    def getEC2Machines(self, instance_ids=None):
         """
-        return all machines running on EC2
-        :return: ec2_machines
+        return all machines on EC2 (ec2_machines_list) and the status of the running ones (ec2_machines_status)
+
+        with instance_tag configured, only machines with this tag and the service machines are listed.
+        :param instance_ids: only list these machines
+        :return: ec2_machines_status, ec2_machines_list
         """
-        ec2 = boto3.resource(self.ec2)
+        if instance_ids is not None:
+            ec2_machines_list = self.__listInstances([{"Name": "instance-id", "Values": list(instance_ids)}]) \
+                if instance_ids else list()
+        elif self.instanceTag is not None:
+            key, value = self.instanceTag
+            ec2_machines_list = self.__listInstances([{"Name": "tag:%s" % key, "Values": [value]}])
+            if self.serviceIDs:
+                ec2_machines_list += self.__listInstances([{"Name": "instance-id", "Values": self.serviceIDs}])
+        else:
+            ec2_machines_list = self.__listInstances([])
 
-        tmp_ec2_machines = ec2.instances.all()
-        ec2_machines_list = list()
-        for instance in tmp_ec2_machines:
-            ec2_machines_list.append(instance.id)
+        paginator = self.client.get_paginator("describe_instance_status")
+        if instance_ids is None and self.instanceTag is None:
+            status_pages = list(paginator.paginate())
+        else:
+            status_pages = list()
+            for i in range(0, len(ec2_machines_list), self.batchSize):
+                status_pages.extend(paginator.paginate(InstanceIds=ec2_machines_list[i:i + self.batchSize]))
 
-        tmp_ec2_machines = ec2.meta.client.describe_instance_status()[self.ec2_instance_statuses]
         ec2_machines_status = dict()
-
-        for machine in tmp_ec2_machines:
+        for machine in (machine for page in status_pages for machine in page[self.ec2_instance_statuses]):
             instance_id = machine[self.ec2_instance_id]
             instance_state = machine[self.ec2_instance_state]
             instance_status = machine[self.ec2_instance_status]
@@ -171,15 +254,17 @@ class Ec2SiteAdapter(SiteAdapterBase):
         :return: running
         """
 
-        ec2 = boto3.client(self.ec2)
+        if not self.serviceIDs:
+            return True
 
-        ec2_machines_status, ec2_machines_list = self.getEC2Machines()
+        ec2_machines_status, ec2_machines_list = self.getEC2Machines(instance_ids=self.serviceIDs)
 
         all_running = True
-        for service_machine in self.getConfig(self.configServiceIDs).split():
+        to_start = []
+        for service_machine in self.serviceIDs:
             try:
                 if service_machine in ec2_machines_list and not service_machine in ec2_machines_status:
-                    ec2.start_instances(InstanceIds=[service_machine])
+                    to_start.append(service_machine)
                     all_running *= False
                 elif service_machine in ec2_machines_list and \
                                 ec2_machines_status[service_machine][self.ec2_instance_status][
@@ -193,6 +278,9 @@ class Ec2SiteAdapter(SiteAdapterBase):
                 print(e)
                 all_running *= False
 
+        if to_start:
+            self.client.start_instances(InstanceIds=to_start)
+
         return all_running
 
     def spawnMachines(self, machineType, requested):
@@ -207,9 +295,6 @@ class Ec2SiteAdapter(SiteAdapterBase):
         if machineType != self._machineType:
             return 0
 
-        # get EC2 client
-        ec2 = boto3.resource(self.ec2)
-
         if not self.checkServiceMachines():
             return
 
@@ -225,89 +310,119 @@ class Ec2SiteAdapter(SiteAdapterBase):
 
         userdata = open(self.getConfig(self.configUserData), "r").read()
 
-        new_machines = ec2.create_instances(ImageId=self.getConfig(self.configImageID),
-                                            MinCount=min_count,
-                                            MaxCount=max_count,
-                                            UserData=userdata,
-                                            SecurityGroupIds=self.getConfig(
-                                                self.configSecurityGroupIDs).split(),
-                                            InstanceType=self.getConfig(self.configInstanceType)
-                                            # BlockDeviceMappings=[
-                                            #     {
-                                            #         "VirtualName": "Storage",
-                                            #         "DeviceName": "/dev/xvda",
-                                            #         "Ebs": {
-                                            #             "SnapshotId": "snap-46c947ad",
-                                            #             "VolumeSize": 80,
-                                            #             "DeleteOnTermination": True,
-                                            #             "Encrypted": False,
-                                            #             "VolumeType": "standard",
-                                            #             "Iops": ""
-                                            #         }
-                                            #     }
-                                            # ]
-                                            )
-
-        for machine in new_machines:
-            # create new machine in machine registry
-            mid = self.mr.newMachine()
-
-            # set some machine specific entries in machine registry
-            self.mr.machines[mid][self.mr.regSite] = self.siteName
-            self.mr.machines[mid][self.mr.regSiteType] = self.siteType
-            self.mr.machines[mid][self.mr.regMachineType] = machineType
-            # self.mr.machines[mid][self.reg_site_server_name] = machine.id
-            self.mr.machines[mid][self.reg_site_server_id] = machine.id
-            # self.mr.machines[mid][self.reg_site_server_status] = vm[self.oao_status][self.oao_state]
-            self.mr.machines[mid][self.reg_site_server_condor_name] = machine.id
-
-            # update machine status
-            self.mr.updateMachineStatus(mid, self.mr.statusBooting)
+        # tag the machines to find them in getEC2Machines
+        tags = dict()
+        if self.instanceTag is not None:
+            key, value = self.instanceTag
+            tags["TagSpecifications"] = [{"ResourceType": "instance", "Tags": [{"Key": key, "Value": value}]}]
+
+        new_machines = self.client.run_instances(ImageId=self.getConfig(self.configImageID),
+                                                 MinCount=min_count,
+                                                 MaxCount=max_count,
+                                                 UserData=userdata,
+                                                 SecurityGroupIds=self.getConfig(
+                                                     self.configSecurityGroupIDs).split(),
+                                                 InstanceType=self.getConfig(self.configInstanceType),
+                                                 **tags
+                                                 # BlockDeviceMappings=[
+                                                 #     {
+                                                 #         "VirtualName": "Storage",
+                                                 #         "DeviceName": "/dev/xvda",
+                                                 #         "Ebs": {
+                                                 #             "SnapshotId": "snap-46c947ad",
+                                                 #             "VolumeSize": 80,
+                                                 #             "DeleteOnTermination": True,
+                                                 #             "Encrypted": False,
+                                                 #             "VolumeType": "standard",
+                                                 #             "Iops": ""
+                                                 #         }
+                                                 #     }
+                                                 # ]
+                                                 )["Instances"]
+
+        with self.mr.batch():
+            for machine in new_machines:
+                # create new machine in machine registry
+                mid = self.mr.newMachine()
+
+                # set some machine specific entries in machine registry
+                self.mr.machines[mid][self.mr.regSite] = self.siteName
+                self.mr.machines[mid][self.mr.regSiteType] = self.siteType
+                self.mr.machines[mid][self.mr.regMachineType] = machineType
+                # self.mr.machines[mid][self.reg_site_server_name] = machine.id
+                self.mr.machines[mid][self.reg_site_server_id] = machine[self.ec2_instance_id]
+                # self.mr.machines[mid][self.reg_site_server_status] = vm[self.oao_status][self.oao_state]
+                self.mr.machines[mid][self.reg_site_server_condor_name] = machine[self.ec2_instance_id]
+
+                # update machine status
+                self.mr.updateMachineStatus(mid, self.mr.statusBooting)
 
         return 1
 
     def cleanupEC2(self):
-        ec2 = boto3.resource(self.ec2)
+        """
+        delete unused volumes and the snapshots of deleted images
 
-        available_volumes = ec2.volumes.filter(
-            Filters=[{"Name": "status", "Values": ["available"]}])
-        for volume in available_volumes:
-            volume.delete()
+        runs in the background every cleanup_interval seconds, see scheduleCleanup
+        """
+        client = self.client
+
+        for page in client.get_paginator("describe_volumes").paginate(
+                Filters=[{"Name": "status", "Values": ["available"]}]):
+            for volume in page["Volumes"]:
+                client.delete_volume(VolumeId=volume["VolumeId"])
+
+        owner_id = self.getConfig(self.configOwnerID)
+        images = [image["ImageId"] for image in client.describe_images(Owners=[owner_id])["Images"]]
+        for page in client.get_paginator("describe_snapshots").paginate(OwnerIds=[owner_id]):
+            for snapshot in page["Snapshots"]:
+                r = re.match(r"(ami-.*)", snapshot.get("Description", ""))
+                if r:
+                    if r.groups()[0] not in images:
+                        client.delete_snapshot(SnapshotId=snapshot["SnapshotId"])
+
+    def scheduleCleanup(self):
+        """start cleanupEC2 in the background if cleanup_interval has passed and the last cleanup is finished"""
+        interval = self.getConfig(self.configCleanupInterval)
+        if not interval or self.__cleanupPool is None:
+            return
+        if self.__cleanupResult is not None and not self.__cleanupResult.ready():
+            return
+        if time.time() - self.__lastCleanup < interval:
+            return
 
-        # available_snapshots = ec2.snapshots.filter(OwnerIds=["181010420550"])
-        # for snapshot in available_snapshots:
-        #    snapshot.delete()
+        def cleanup():
+            try:
+                self.cleanupEC2()
+            except Exception as e:
+                self.logger.warning("Cleanup of EC2 volumes and snapshots failed: %s" % e)
 
-        images = ec2.images.all()
-        images = [image.id for image in images]
-        for snapshot in ec2.snapshots.filter(OwnerIds=[self.getConfig(self.configOwnerID)]):
-            r = re.match(r"(ami-.*)", snapshot.description)
-            if r:
-                if r.groups()[0] not in images:
-                    snapshot.delete()
+        self.__lastCleanup = time.time()
+        self.__cleanupResult = self.__cleanupPool.apply_async(cleanup)
 
-        if len(self.getSiteMachines()) == 0:
-            ec2 = boto3.client(self.ec2)
-            ec2.stop_instances(InstanceIds=self.getConfig(self.configServiceIDs).split())
+    def stopServiceMachines(self):
+        """stop the service machines, if no machines are left on this site"""
+        if self.serviceIDs and len(self.getSiteMachines()) == 0:
+            self.client.stop_instances(InstanceIds=self.serviceIDs)
 
     def terminateEC2Machine(self, state, mids):
         """
-        terminate machine on EC2 cloud site
-        :param mid: machine id in machine registry
+        stop/terminate machines on EC2 cloud site, batchSize machines per request
+        :param state: stop or terminate
+        :param mids: machine ids in machine registry
         """
 
-        if len(mids) > 0:
-            instance_ids = []
+        instance_ids = [self.mr.machines[mid][self.reg_site_server_id] for mid in mids]
 
-            for mid in mids:
-                instance_ids.append(self.mr.machines[mid][self.reg_site_server_id])
+        if state == self.stop:
+            request = self.client.stop_instances
+        elif state == self.terminate:
+            request = self.client.terminate_instances
+        else:
+            return
 
-            ec2 = boto3.resource(self.ec2)
-            if state == self.stop:
-                ec2.instances.filter(InstanceIds=instance_ids).stop()
-            elif state == self.terminate:
-                ec2.instances.filter(InstanceIds=instance_ids).terminate()
-                self.cleanupEC2()
+        for i in range(0, len(instance_ids), self.batchSize):
+            request(InstanceIds=instance_ids[i:i + self.batchSize])
 
         return
 
@@ -328,6 +443,7 @@ class Ec2SiteAdapter(SiteAdapterBase):
 
         machines_to_stop = list()
         machines_to_terminate = list()
+        machines_removed = False
 
         # if something fails while receiving response from EC2 a type "None" will be returned
         if ec2_machines_status is None:  # or (len(oao_machines) == 0):
@@ -354,7 +470,7 @@ class Ec2SiteAdapter(SiteAdapterBase):
                 if not machine[self.reg_site_server_id] in ec2_machines_list:
                     self.mr.removeMachine(mid)
                     # del ec2_machines_status[machine[self.reg_site_server_id]]
-                    self.cleanupEC2()
+                    machines_removed = True
                     continue
 
             elif machine[self.mr.regStatus] == self.mr.statusDisintegrated:
@@ -394,11 +510,14 @@ class Ec2SiteAdapter(SiteAdapterBase):
 
         self.terminateEC2Machine(self.stop, machines_to_stop)
         self.terminateEC2Machine(self.terminate, machines_to_terminate)
+        if machines_removed:
+            self.stopServiceMachines()
+        self.scheduleCleanup()
 
         # add all machines remaining in machine list from 1&1
         for machine in ec2_machines_status:
             # if machine is listed in the service machine section, skip it!
-            if not machine in self.getConfig(self.configServiceIDs):
+            if not machine in self.serviceIDs:
                 # create new machine in machine registry
                 mid = self.mr.newMachine()
                 self.mr.machines[mid][self.mr.regSite] = self.siteName
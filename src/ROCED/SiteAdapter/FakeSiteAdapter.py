@@ -44,7 +44,7 @@ class FakeSiteAdapter(SiteAdapterBase):
         self.bootTimeSigma = 2
 
     def init(self):
-        self.mr.registerListener(self)
+        self.mr.registerListener(self, eventTypes=(MachineRegistry.StatusChangedEvent,), site=self.siteName)
 
     def onEvent(self, evt):
         if (isinstance(evt, MachineRegistry.StatusChangedEvent) and
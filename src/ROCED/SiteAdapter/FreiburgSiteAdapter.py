@@ -22,12 +22,13 @@ from __future__ import unicode_literals, absolute_import
 
 import logging
 import re
-from xml.dom import minidom
+import threading
 import datetime
 import time
 
 from Core import MachineRegistry, Config
 from SiteAdapter.Site import SiteAdapterBase
+from Util import Moab
 from Util.Logging import JsonLog
 from Util.PythonTools import Caching, merge_dicts
 from Util.ScaleTools import Ssh
@@ -44,6 +45,8 @@ class FreiburgSiteAdapter(SiteAdapterBase):
     configMaxMachinesPerCycle = "max_machines_per_cycle"
     configIgnoreDrainingMachines = "ignore_draining_machines"
     configDrainWorkingMachines = "drain_working_machines"
+    configBatchSubmission = "batch_submission"
+    configDrainCommand = "drain_command"
     configVMNamePrefix = "vm_prefix"
     configIntegrationAdapterType = "IntegrationAdapterType"
 
@@ -84,6 +87,13 @@ class FreiburgSiteAdapter(SiteAdapterBase):
         self.addOptionalConfigKeys(self.configDrainWorkingMachines, Config.ConfigTypeBoolean,
                                    description="Should ROCED set working machines to drain mode, "
                                                "if it has to terminate machines?", default=False)
+        self.addOptionalConfigKeys(self.configBatchSubmission, Config.ConfigTypeBoolean,
+                                   description="Submit all batch jobs of a cycle with a single SSH call (True) "
+                                               "or one SSH call per batch job (False)", default=False)
+        self.addOptionalConfigKeys(self.configDrainCommand, Config.ConfigTypeString,
+                                   description="Command to drain a VM on the login node, %s is replaced by "
+                                               "the batch job id. Without it, draining is only logged.",
+                                   default=None)
         self.addCompulsoryConfigKeys(self.configVMNamePrefix, Config.ConfigTypeString,
                                      "prefix for VMs' hostname")
         self.addCompulsoryConfigKeys(self.configIntegrationAdapterType, Config.ConfigTypeString,
@@ -92,11 +102,19 @@ class FreiburgSiteAdapter(SiteAdapterBase):
 
         self.__default_machine = "vm-default"
 
+        # batch job ids to cancel/drain with the next flush of the termination queue
+        self.__cancelQueue = set()
+        self.__drainQueue = set()
+        self.__queueLock = threading.Lock()
+
     def init(self):
-        self.mr.registerListener(self)
+        self.mr.registerListener(self, site=self.siteName)
         self.logger = logging.getLogger(self.getConfig(self.configSiteLogger))
         self.__readVMNamePrefix()
         super(FreiburgSiteAdapter, self).init()
+        if self.getConfig(self.configDrainWorkingMachines) is True and self.getConfig(self.configDrainCommand) is None:
+            self.logger.warning("%s is set, but without %s working machines are not drained."
+                                % (self.configDrainWorkingMachines, self.configDrainCommand))
 
         self.logger.debug("Init() FreiburgSiteAdapter")
 
@@ -174,24 +192,54 @@ class FreiburgSiteAdapter(SiteAdapterBase):
         if count > maxMachinesPerCycle:
             self.logger.info("%d machines requested, limited to %d for this cycle." % (count, maxMachinesPerCycle))
             count = maxMachinesPerCycle
-        for i in range(count):
-            # send batch jobs to boot machines
-            result = self.__execCmdInFreiburg("msub -m p -l walltime=%s,mem=%s,nodes=1:ppn=%d %s" % (machineSettings["walltime"], machineSettings["memory"], machineSettings["cores"], self.__vmStartScript))
+        msub = "msub -m p -l walltime=%s,mem=%s,nodes=1:ppn=%d %s" % (
+            machineSettings["walltime"], machineSettings["memory"], machineSettings["cores"], self.__vmStartScript)
+        if self.getConfig(self.configBatchSubmission) is True:
+            jobIds = self.__submitBatchJobs(msub, count)
+        else:
+            jobIds = []
+            for i in range(count):
+                # send batch jobs to boot machines
+                result = self.__execCmdInFreiburg(msub)
+
+                # std_out = batch job id
+                if result[0] == 0 and result[1].strip().isdigit():
+                    jobIds.append(result[1].strip())
+                else:
+                    self.logger.warning("A problem occurred while requesting VMs. Stopping for now."
+                                        "RC: %d; stdout: %s; stderr: %s" % (result[0], result[1], result[2]))
+                    break
 
-            # std_out = batch job id
-            if result[0] == 0 and result[1].strip().isdigit():
+        with self.mr.batch():
+            for jobId in jobIds:
                 mid = self.mr.newMachine()
                 self.mr.machines[mid][self.mr.regSite] = self.siteName
                 self.mr.machines[mid][self.mr.regMachineType] = machineType
-                self.mr.machines[mid][self.regMachineJobId] = result[1].strip()
-                self.mr.machines[mid][self.reg_site_server_node_name] = self.__getVMName(
-                    result[1].strip())
+                self.mr.machines[mid][self.regMachineJobId] = jobId
+                self.mr.machines[mid][self.reg_site_server_node_name] = self.__getVMName(jobId)
                 self.mr.machines[mid][self.mr.regSiteType] = self.siteType
                 self.mr.updateMachineStatus(mid, self.mr.statusBooting)
-            else:
-                self.logger.warning("A problem occurred while requesting VMs. Stopping for now."
-                                    "RC: %d; stdout: %s; stderr: %s" % (result[0], result[1], result[2]))
-                break
+        # the new batch jobs are listed by the next query
+        self.__invalidateJobCache()
+
+    def __submitBatchJobs(self, msub, count):
+        # type: (str, int) -> List[str]
+        """Submit count batch jobs with a single SSH call, the submissions are executed one after another on
+        the login node. Failed submissions don't stop the remaining ones.
+
+        :param msub: submit command
+        :param count:
+        :return: batch job ids of the successful submissions
+        """
+        # msub prints the batch job id of each submission on a separate line
+        result = self.__execCmdInFreiburg("sh -c \"for i in \\$(seq %d); do %s; done\"" % (count, msub),
+                                          timeout=60 + 5 * count)
+        # submissions before a timeout are valid as well
+        jobIds = re.findall("^\s*(\d+)\s*$", result[1], re.MULTILINE)
+        if len(jobIds) < count:
+            self.logger.warning("A problem occurred while requesting VMs. %d of %d batch jobs submitted. "
+                                "RC: %d; stderr: %s" % (len(jobIds), count, result[0], result[2]))
+        return jobIds
 
     def terminateMachines(self, machineType, count):
         """Terminate machines in Freiburg.
@@ -235,8 +283,6 @@ class FreiburgSiteAdapter(SiteAdapterBase):
         # list of batch job ids to terminate/drain
         idsToTerminate = []
         idsToDrain = []
-        idsRemoved = []
-        idsInvalidated = []
 
         self.logger.debug("machinesToRemove=%s" % machinesToRemove)
 
@@ -244,27 +290,24 @@ class FreiburgSiteAdapter(SiteAdapterBase):
             if machine[self.mr.regStatus] == self.mr.statusBooting:
                 # booting machines can be terminated immediately
                 idsToTerminate.append(machine[self.regMachineJobId])
-            elif self.getConfig(self.configDrainWorkingMachines):
-                #if IntegrationAdapter.calcDrainStatus(mid)[1] is True:
-                #    continue
+            elif machine[self.mr.regStatus] != self.mr.statusPendingDisintegration:
                 # working machines should be set to drain mode
                 idsToDrain.append(machine[self.regMachineJobId])
 
+        # executed with the termination queue at the end of the phase, see applyMachineDecision
         self.logger.debug("Machines to terminate (%d): %s" % (len(idsToTerminate), ", ".join(idsToTerminate)))
-        if idsToTerminate:
-            idsRemoved, idsInvalidated = self.__cancelFreiburgMachines(idsToTerminate)
-
+        self.__queueCancel(idsToTerminate)
         self.logger.debug("Machines to drain (%d): %s" % (len(idsToDrain), ", ".join(idsToDrain)))
-        #if idsToDrain:
-        #    for mid, machine in self.getSiteMachines().items():
-                #if machine[self.regMachineJobId] in idsToDrain:
-                    #IntegrationAdapter.drainMachine(mid) 
-             
-        if len(idsRemoved + idsInvalidated) > 0:
-            # update status
-            for mid, machine in self.getSiteMachines().items():
-                if machine[self.regMachineJobId] in idsRemoved + idsInvalidated:
-                    self.mr.updateMachineStatus(mid, self.mr.statusDown)
+        self.__queueDrain(idsToDrain)
+
+    def applyMachineDecision(self, decision):
+        super(FreiburgSiteAdapter, self).applyMachineDecision(decision)
+        self.flushTerminationQueue()
+
+    def __invalidateJobCache(self):
+        """Drop the cached batch job lists after submitting or cancelling jobs."""
+        type(self).moabJobs.fget.invalidate(self)
+        type(self).completedMoabJobs.fget.invalidate(self)
 
     @property
     def runningMachinesCount(self):
@@ -320,10 +363,13 @@ class FreiburgSiteAdapter(SiteAdapterBase):
             self.logger.debug("Status Change Event: %s (%s->%s)" % (evt.id, evt.oldStatus, evt.newStatus))
             if evt.newStatus == self.mr.statusDisintegrated:
                 # Disintegrated information comes from integration adapter. Skipping state only happens with time out.
+                # The batch job is cancelled with the next flush of the termination queue, which sets the machine
+                # down.
                 try:
                     if (self.mr.machines[evt.id].get(self.regMachineJobId) in self.__runningJobs and
                                 evt.oldStatus != self.mr.statusDisintegrating):
-                        self.__cancelFreiburgMachines([self.mr.machines[evt.id].get(self.regMachineJobId)])
+                        self.__queueCancel([self.mr.machines[evt.id].get(self.regMachineJobId)])
+                        return
                 except Exception as err:
                     self.logger.warning("Canceling machine failed with exception %s" % err)
                 self.mr.updateMachineStatus(evt.id, self.mr.statusDown)
@@ -429,7 +475,7 @@ class FreiburgSiteAdapter(SiteAdapterBase):
                 # ROCED machine down, but job still running
                 frJobsRunning.pop(batchJobId)
                 if self.mr.calcLastStateChange(mid) > 5*60:
-                    self.__cancelFreiburgMachines(batchJobId)
+                    self.__queueCancel([batchJobId])
                 continue
 
             if mr[mid][self.mr.regStatus] == self.mr.statusBooting:
@@ -484,6 +530,7 @@ class FreiburgSiteAdapter(SiteAdapterBase):
 	    self.mr.updateMachineStatus(mid, self.mr.statusBooting)
 
 
+        self.flushTerminationQueue()
         self.logger.info("Machines using resources (Freiburg): %d" % self.cloudOccupyingMachinesCount)
 
         with JsonLog() as jsonLog:
@@ -496,54 +543,109 @@ class FreiburgSiteAdapter(SiteAdapterBase):
                             len(self.getSiteMachines(status=self.mr.statusUp)) +
                             len(self.getSiteMachines(status=self.mr.statusIntegrating)))
 
-    def __execCmdInFreiburg(self, cmd):
+    def __execCmdInFreiburg(self, cmd, timeout=60):
         """Execute command on Freiburg login node via SSH.
 
         :param cmd:
+        :param timeout:
         :return: Tuple: (return_code, std_out, std_err)
         """
         frSsh = Ssh(host=self.getConfig(self.configFreiburgServer),
                     username=self.getConfig(self.configFreiburgUser),
                     key=self.getConfig(self.configFreiburgKey))
-        return frSsh.handleSshCall(call=cmd, quiet=True)
+        return frSsh.handleSshCall(call=cmd, quiet=True, timeout=timeout)
 
-    def __cancelFreiburgMachines(self, batchJobIds):
-        """Cancel batch job (VM) in Freiburg.
+    def __streamCmdInFreiburg(self, cmd, consumer):
+        """Execute command on Freiburg login node via SSH, consumer reads stdout while it is received.
 
-        :param batchJobIds:
-        :type batchJobIds: list
-        :return: [idsRemoved], [idsInvalidated]
+        :param cmd:
+        :param consumer: function(stdout file object)
+        :return: Tuple: (return_code, result of consumer, std_err)
         """
-        # It is also possible to use just one single command with multiple ids, but no machine gets
-        # cancelled if a single id is invalid! This can happen when the VM fails to boot due to
-        # network problems.
-        command = ""
-        if not isinstance(batchJobIds, (list, tuple)):
-            batchJobIds = [batchJobIds]
-        for batchJobId in batchJobIds:
-            command += "mjobctl -c %s; " % batchJobId
-        result = self.__execCmdInFreiburg(command)
-
-        # catch 0:"successful" and 1:"invalid job id" return codes
-        # the return code of the first cancellation command is returned here, we can handle them
-        # both to remove cancelled and invalid machines
-        idsRemoved = []
-        idsInvalidated = []
-        if result[0] <= 1:
-            Ssh.debugOutput(self.logger, "FR-terminate", result)
-            idsRemoved += re.findall("\'(\d+)\'", result[1])
-            idsInvalidated += re.findall("invalid job specified \((\d+)", result[2])
-            if len(idsRemoved) > 0:
-                self.logger.info("Terminated machines (%d): %s" % (len(idsRemoved), ", ".join(idsRemoved)))
-            if len(idsInvalidated) > 0:
-                self.logger.warning("Removed invalid machines (%d): %s"
-                                    % (len(idsInvalidated), ", ".join(idsInvalidated)))
-            if (len(idsRemoved) + len(idsInvalidated)) == 0:
-                self.logger.warning("A problem occurred while canceling VMs (RC: %d)\n%s" % (result[0], result[2]))
-        else:
-            self.logger.warning("A problem occurred while canceling VMs (RC: %d)\n%s" % (result[0], result[2]))
-        return idsRemoved, idsInvalidated
+        frSsh = Ssh(host=self.getConfig(self.configFreiburgServer),
+                    username=self.getConfig(self.configFreiburgUser),
+                    key=self.getConfig(self.configFreiburgKey))
+        return frSsh.handleSshStream(call=cmd, consumer=consumer)
+
+    def __queueCancel(self, batchJobIds):
+        with self.__queueLock:
+            self.__cancelQueue.update(batchJobIds)
+            self.__drainQueue.difference_update(batchJobIds)
+
+    def __queueDrain(self, batchJobIds):
+        if self.getConfig(self.configDrainCommand) is None:
+            return
+        with self.__queueLock:
+            self.__drainQueue.update(set(batchJobIds) - self.__cancelQueue)
+
+    def flushTerminationQueue(self):
+        # type: () -> None
+        """Cancel/drain all queued batch jobs (VMs) in Freiburg with a single SSH call.
+
+        The return code of each command is reported separately (mjobctl -c: 0 "successful", 1 "invalid job id").
+        It's also possible to cancel multiple ids with one single mjobctl, but no machine gets cancelled if a
+        single id is invalid! This can happen when the VM fails to boot due to network problems.
+
+        Cancelled and invalid jobs -> down, drained jobs -> pending disintegration. Jobs without result (e.g.
+        SSH connection failed) stay queued until the next flush.
+        """
+        with self.__queueLock:
+            toCancel = sorted(self.__cancelQueue)
+            toDrain = sorted(self.__drainQueue)
+        if not toCancel and not toDrain:
+            return
 
+        commands = ["mjobctl -c %s >/dev/null; echo cancel %s $?" % (batchJobId, batchJobId)
+                    for batchJobId in toCancel]
+        commands += ["%s >/dev/null; echo drain %s $?" % (self.getConfig(self.configDrainCommand) % batchJobId,
+                                                         batchJobId)
+                     for batchJobId in toDrain]
+        result = self.__execCmdInFreiburg("; ".join(commands), timeout=60 + len(commands))
+        Ssh.debugOutput(self.logger, "FR-terminate", result)
+        results = {(action, batchJobId): int(rc) for action, batchJobId, rc in
+                   re.findall("^(cancel|drain) (\d+) (\d+)$", result[1], re.MULTILINE)}
+
+        with self.__queueLock:
+            for action, batchJobId in results:
+                queue = self.__cancelQueue if action == "cancel" else self.__drainQueue
+                queue.discard(batchJobId)
+
+        idsRemoved = [batchJobId for batchJobId in toCancel if results.get(("cancel", batchJobId)) == 0]
+        idsInvalidated = [batchJobId for batchJobId in toCancel if results.get(("cancel", batchJobId)) == 1]
+        idsFailed = [batchJobId for batchJobId in toCancel if results.get(("cancel", batchJobId), 0) > 1]
+        idsDrained = [batchJobId for batchJobId in toDrain if results.get(("drain", batchJobId)) == 0]
+        idsNotDrained = [batchJobId for batchJobId in toDrain if results.get(("drain", batchJobId), 0) != 0]
+
+        if idsRemoved:
+            self.logger.info("Terminated machines (%d): %s" % (len(idsRemoved), ", ".join(idsRemoved)))
+        if idsInvalidated:
+            self.logger.warning("Removed invalid machines (%d): %s"
+                                % (len(idsInvalidated), ", ".join(idsInvalidated)))
+        if idsDrained:
+            self.logger.info("Draining machines (%d): %s" % (len(idsDrained), ", ".join(idsDrained)))
+        if idsFailed or idsNotDrained:
+            self.logger.warning("A problem occurred while canceling (%s) / draining (%s) VMs\n%s"
+                                % (", ".join(idsFailed), ", ".join(idsNotDrained), result[2]))
+        if len(results) < len(commands):
+            self.logger.warning("No result for %d of %d commands (RC: %d), retrying with the next flush.\n%s"
+                                % (len(commands) - len(results), len(commands), result[0], result[2]))
+
+        # update status
+        # machines disintegrated by the integration adapter are down anyway, their batch jobs are cancelled
+        # again by manage if they are still running
+        if idsRemoved or idsInvalidated or idsFailed or idsDrained:
+            with self.mr.batch():
+                for mid, machine in self.getSiteMachines().items():
+                    batchJobId = machine[self.regMachineJobId]
+                    if batchJobId in idsRemoved or batchJobId in idsInvalidated:
+                        self.mr.updateMachineStatus(mid, self.mr.statusDown)
+                    elif batchJobId in idsFailed and machine[self.mr.regStatus] == self.mr.statusDisintegrated:
+                        self.mr.updateMachineStatus(mid, self.mr.statusDown)
+                    elif batchJobId in idsDrained and machine[self.mr.regStatus] in (self.mr.statusIntegrating,
+                                                                                     self.mr.statusWorking):
+                        self.mr.updateMachineStatus(mid, self.mr.statusPendingDisintegration)
+        if idsRemoved or idsInvalidated:
+            self.__invalidateJobCache()
 
     def __readVMNamePrefix(self):
         """Read VM name prefix from config file communication with
@@ -577,78 +679,51 @@ class FreiburgSiteAdapter(SiteAdapterBase):
     
     
     @property
-    @Caching(validityPeriod=-1, redundancyPeriod=300)
+    @Caching(validityPeriod=-1, redundancyPeriod=300, refreshInBackground=True)
     def moabJobs(self):
         """Get list of batch jobs (running,idle,blocked) as xml."""
-        cmd='checkjob ALL --xml'
-        frResult = self.__execCmdInFreiburg(cmd)
-        #proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-        #checkjob_xml = proc.communicate()[0].split(b'\n')
-        
-        jobsIdle = []
-        jobsRunning = {}
+        cmd = 'checkjob ALL --xml'
+        frResult = self.__streamCmdInFreiburg(cmd, self.__readMoabJobs)
 
         if frResult[0] == 0:
-            # returns a dict: {batch job id: return code/status, ..}
-            itemlist = minidom.parseString(frResult[1]).getElementsByTagName('job')
-            self.logger.info("Found {} lines in XML".format(len(itemlist)))
-
-            for line in itemlist:
-                if line.attributes['State'].value == "Idle":
-                    self.logger.debug( "Job is IDLE")
-                    self.logger.debug( "  JobID={}".format(   line.attributes['JobID'].value))
-                    jobsIdle.append(line.attributes['JobID'].value)
-                elif line.attributes['State'].value == "Running":
-                    self.logger.debug( "Job is Running")
-                    self.logger.debug( "  JobID={}" .format(  line.attributes['JobID'].value))
-                    self.logger.debug( "  StartTime={}".format(  line.attributes['StartTime'].value))
-                    self.logger.debug("  ReqAWDuration={}" .format( line.attributes['ReqAWDuration'].value))
-                    req = line.getElementsByTagName('req')[0]
-                    self.logger.debug( "  ReqProcs={}".format(  req.attributes['TPN'].value))
-                    self.logger.debug( "  User={}".format(line.attributes['User'].value) )
-                    var = line.getElementsByTagName('Variable')
-                    vmIP = ""
-                    for v in var:
-                        if v.getAttribute('name') == 'VM_IP':
-                            vmIP=str(v.childNodes[0].nodeValue)
-                            self.logger.debug( "  VM_IP={}".format( v.childNodes[0].nodeValue))
-                    jobsRunning[str(line.attributes['JobID'].value)] = {"walltime": str(datetime.timedelta(seconds=int(line.attributes['StartTime'].value)+int(line.attributes['ReqAWDuration'].value)-int(time.time()))), "cores": int(req.attributes['TPN'].value), "IP": vmIP, "User": line.attributes['User'].value }
-                else:
-                    self.logger.debug("ERROR")
-                    self.logger.debug( "Job is {}".format( line.attributes['State'].value))
-                    self.logger.debug("  JobID={}".format(  line.attributes['JobID'].value))
-                    self.logger.debug("  StartTime={}" .format(  line.attributes['StartTime'].value))
-                    self.logger.debug( "  ReqAWDuration={}" .format(  line.attributes['ReqAWDuration'].value))
-                    req = line.getElementsByTagName('req')[0]
-                    self.logger.debug("  ReqProcs={}".format( req.attributes['TPN'].value))
-                    self.logger.debug("  User={}".format( line.attributes['User'].value))
-                    var = line.getElementsByTagName('Variable')
-                    for v in var:
-                        if v.getAttribute('name') == 'VM_IP':
-                            self.logger.debug( "  VM_IP={}".format( v.childNodes[0].nodeValue))
-
-                    jobsIdle.append(line.attributes['JobID'].value)
-    
-    	self.logger.info("Found {} idle and {} running jobs in XML ({} total)".format(len(jobsIdle),len(jobsRunning),len(jobsIdle)+len(jobsRunning)))
+            jobsIdle, jobsRunning = frResult[1]
+        else:
+            jobsIdle, jobsRunning = [], {}
+
+        self.logger.info("Found {} idle and {} running jobs in XML ({} total)".format(
+            len(jobsIdle), len(jobsRunning), len(jobsIdle) + len(jobsRunning)))
         return {'jobsIdle': jobsIdle, 'jobsRunning': jobsRunning}
-    
+
+    def __readMoabJobs(self, stream):
+        """Sort the jobs of checkjob ALL --xml into idle (list) and running (dict) jobs while they are received."""
+        jobsIdle = []
+        jobsRunning = {}
+        now = int(time.time())
+        for job in Moab.iterJobs(stream):
+            if job.state == Moab.stateRunning:
+                remaining = job.remainingWalltime(now)
+                if remaining is None:
+                    self.logger.warning("Running job {} without StartTime/ReqAWDuration, skipped.".format(job.jobId))
+                    continue
+                jobsRunning[str(job.jobId)] = {
+                    "walltime": str(datetime.timedelta(seconds=remaining)),
+                    "cores": job.cores, "IP": job.vmIp, "User": job.user}
+            else:
+                if job.state != Moab.stateIdle:
+                    self.logger.debug("Job {} is {}".format(job.jobId, job.state))
+                jobsIdle.append(job.jobId)
+        return jobsIdle, jobsRunning
+
     @property
     @Caching(validityPeriod=-1, redundancyPeriod=300)
     def completedMoabJobs(self):
         """Get list of completed batch jobs as xml."""
-        cmd='checkjob ALL --xml --flags=COMPLETE'
-        frResult = self.__execCmdInFreiburg(cmd)
-        #proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-        #checkjob_xml = proc.communicate()[0].split(b'\n')
-        jobsCompleted = {}
+        cmd = 'checkjob ALL --xml --flags=COMPLETE'
+        # returns a dict: {batch job id: return code/status, ..}
+        frResult = self.__streamCmdInFreiburg(
+            cmd, lambda stream: {str(job.jobId): str(job.completionCode) for job in Moab.iterJobs(stream)})
         if frResult[0] == 0:
-            # returns a dict: {batch job id: return code/status, ..}
-            itemlist = minidom.parseString(frResult[1]).getElementsByTagName('job')
-           
-            for line in itemlist:
-                self.logger.debug("Job {} is {} w/ code {}" .format( line.attributes['JobID'].value, line.attributes['State'].value, line.attributes['CompletionCode'].value))
-                jobsCompleted[str(line.attributes['JobID'].value)] = str(line.attributes['CompletionCode'].value)
-           
+            jobsCompleted = frResult[1]
         elif frResult[0] == 255:
             jobsCompleted = {}
             self.logger.warning("SSH connection (showq -c) could not be established.")
@@ -658,7 +733,6 @@ class FreiburgSiteAdapter(SiteAdapterBase):
             self.logger.warning("Problem running remote command (showq -c) (RC %d):\n%s" % (frResult[0], frResult[2]))
             raise ValueError("Problem running remote command (showq -c) (RC %d):\n%s" % (frResult[0], frResult[2]))
 
-            #self.logger.debug("Completed jobs dictionary:\n%s" % jobsCompleted)
         return jobsCompleted
 
     @property
@@ -667,18 +741,11 @@ class FreiburgSiteAdapter(SiteAdapterBase):
         # type: () -> dict
         """Get list of running batch jobs, filtered by user ID."""
         cmd = "showq -r --xml %s" % self.__userString
-        frResult = self.__execCmdInFreiburg(cmd)
+        # returns a list containing all running batch jobs
+        # see http://docs.adaptivecomputing.com/maui/commands/showq.php#activeexample
+        frResult = self.__streamCmdInFreiburg(cmd, self.__readRunningJobs)
         if frResult[0] == 0:
-            # returns a list containing all running batch jobs
-            # see http://docs.adaptivecomputing.com/maui/commands/showq.php#activeexample
-            itemlist = minidom.parseString(frResult[1]).getElementsByTagName('job')
-
-            frJobsRunning = {}
-            for line in itemlist:
-                frJobsRunning.update(
-                    {str(line.attributes['JobID'].value): {
-                        "walltime": str(datetime.timedelta(seconds=int(line.attributes['StartTime'].value)+int(line.attributes['ReqAWDuration'].value)-int(time.time()))), 
-                        "cores": int(line.attributes['ReqProcs'].value)}})
+            frJobsRunning = frResult[1]
         elif frResult[0] == 255:
             frJobsRunning = {}
             self.logger.warning("SSH connection (showq -r) could not be established.")
@@ -691,6 +758,19 @@ class FreiburgSiteAdapter(SiteAdapterBase):
         self.logger.debug("Running:\n%s" % frJobsRunning)
         return frJobsRunning
 
+    def __readRunningJobs(self, stream):
+        """Running jobs of showq -r --xml, jobs without start time or walltime are skipped."""
+        frJobsRunning = {}
+        now = int(time.time())
+        for job in Moab.iterJobs(stream):
+            remaining = job.remainingWalltime(now)
+            if remaining is None:
+                self.logger.warning("Running job {} without StartTime/ReqAWDuration, skipped.".format(job.jobId))
+                continue
+            frJobsRunning[str(job.jobId)] = {"walltime": str(datetime.timedelta(seconds=remaining)),
+                                             "cores": job.cores}
+        return frJobsRunning
+
     @property
     @Caching(validityPeriod=-1, redundancyPeriod=300)
     def __idleJobs(self):
@@ -64,7 +64,7 @@ class NovaSiteAdapter(SiteAdapterBase):
 
     def init(self):
         # todo: see whats running as we start up
-        self.mr.registerListener(self)
+        self.mr.registerListener(self, eventTypes=(MachineRegistry.StatusChangedEvent,), site=self.siteName)
 
     def onEvent(self, evt):
         if isinstance(evt, MachineRegistry.StatusChangedEvent):
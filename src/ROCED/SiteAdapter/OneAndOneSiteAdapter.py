@@ -25,7 +25,6 @@ import datetime
 import logging
 import re
 import sys
-import time
 
 try:
     from oneandone.client import OneAndOneService, Server, Hdd
@@ -37,6 +36,7 @@ from Core import Config
 from SiteAdapter.Site import SiteAdapterBase
 from Util.PythonTools import Caching
 from Util.Logging import JsonLog
+from Util.RateLimit import RequestScheduler
 
 PY3 = sys.version_info > (3,)
 
@@ -71,6 +71,8 @@ class OneAndOneSiteAdapter(SiteAdapterBase):
     configMaxMachinesPerCycle = "max_machines_per_cycle"
     configMaxMachines = "max_machines"
     configPrefix = "prefix"
+    configApiRate = "api_rate"
+    configApiBurst = "api_burst"
     # -------------------------------------------------------------------------
 
     # keywords for machine registry
@@ -113,6 +115,9 @@ class OneAndOneSiteAdapter(SiteAdapterBase):
     # alternating index for load balancing between different data centers
     id_selector = 0
 
+    # all requests to this endpoint share the rate limit of 1&1's firewall, see RequestScheduler
+    api_endpoint = "cloudpanel-api.1and1.com"
+
     def __init__(self):
         """Init function
 
@@ -176,6 +181,16 @@ class OneAndOneSiteAdapter(SiteAdapterBase):
         self.addOptionalConfigKeys(self.configMaxMachines, Config.ConfigTypeInt,
                                    description="limit amount of machines",
                                    default=None)
+        self.addOptionalConfigKeys(self.configApiRate, Config.ConfigTypeFloat,
+                                   description="Maximum number of API requests per second (1&1 firewall)",
+                                   default=1.0)
+        self.addOptionalConfigKeys(self.configApiBurst, Config.ConfigTypeInt,
+                                   description="Maximum number of API requests sent at once",
+                                   default=1)
+
+        self.requestScheduler = None
+        # last request queued for a machine, {mid: request}, see submitMachineRequest
+        self.__machineRequests = {}
 
     def init(self):
         super(OneAndOneSiteAdapter, self).init()
@@ -192,6 +207,9 @@ class OneAndOneSiteAdapter(SiteAdapterBase):
         # set name of Site Adapter for ROCED output
         self.logger = logging.getLogger(self.getConfig(self.configSiteLogger))
 
+        self.requestScheduler = RequestScheduler.get(self.api_endpoint, self.getConfig(self.configApiRate),
+                                                     self.getConfig(self.configApiBurst))
+
     def getOneAndOneClient(self):
         """
         initialize 1and1 client
@@ -214,14 +232,14 @@ class OneAndOneSiteAdapter(SiteAdapterBase):
         # Try getting a list of all machines running on 1and1 and raise an exception if it fails
         try:
             client = self.getOneAndOneClient()
+            # queue both requests at once, they are paced by the request scheduler (1&1 firewall: 1 request/second),
+            # ahead of queued power/assign/delete/create requests
             # get a list of all running machines
-            machines = client.list_servers()
-            # wait 1 second to not getting blocked by the firewall (1 request/second)
-            time.sleep(1)
+            machines_request = self.requestScheduler.submitUrgent(client.list_servers)
             # get a list of all private networks
-            networks = client.list_private_networks()
-            # wait again 1 second due to 1&1's firewall settings
-            time.sleep(1)
+            networks_request = self.requestScheduler.submitUrgent(client.list_private_networks)
+            machines = machines_request.get()
+            networks = networks_request.get()
         except Exception as exception:
             self.logger.warning("Could not establish connection to 1&1 Cloud Site. ERROR: %s" % exception)
             raise exception
@@ -281,12 +299,12 @@ class OneAndOneSiteAdapter(SiteAdapterBase):
             oao_appliances = [
                 {self.id: appliance[self.id], self.datacenter: appliance[self.available_datacenter][0]}
                 for
-                appliance in client.list_appliances() if
+                appliance in self.requestScheduler.call(client.list_appliances) if
                 appliance[self.id] in self.getConfig(self.configApplianceID).split()]
             # the same for private networks
             oao_networks = [
                 {self.id: network[self.id], self.datacenter: network[self.datacenter][self.id]} for
-                network in client.list_private_networks()]
+                network in self.requestScheduler.call(client.list_private_networks)]
         except Exception as exception:
             self.logger.warning(exception)
             return
@@ -329,56 +347,89 @@ class OneAndOneSiteAdapter(SiteAdapterBase):
                     datacenter_id = id_dicts[appliance_id][self.datacenter]
         return appliance_id, datacenter_id, network_id
 
+    def submitRequest(self, description, function, **kwargs):
+        """
+        Queue a 1&1 API request function(**kwargs), paced by the rate limit. Failed requests are logged.
+
+        :param description: request description for the log
+        :param function: method of the 1&1 client
+        :return: request (multiprocessing.pool.AsyncResult)
+        """
+        def request():
+            try:
+                return function(**kwargs)
+            except Exception as exception:
+                self.logger.warning("%s failed: %s" % (description, exception))
+                raise
+
+        return self.requestScheduler.submit(request)
+
+    def submitMachineRequest(self, mid, description, function, **kwargs):
+        """
+        Queue a 1&1 API request for machine mid, see submitRequest. The request is skipped while the previous request
+        of this machine is still pending, as the 1&1 state of the machine doesn't change before.
+
+        :param mid:
+        :param description: request description for the log
+        :param function: method of the 1&1 client
+        :return: request or None, if skipped
+        """
+        request = self.__machineRequests.get(mid)
+        if request is not None and not request.ready():
+            self.logger.debug("%s skipped, the previous request is still pending." % description)
+            return None
+        self.__machineRequests[mid] = self.submitRequest(description, function, **kwargs)
+        return self.__machineRequests[mid]
+
     def modifyMachineStatus(self, mid, action, method=method_software):
         """
         This function modifies the machine status on 1and1 Cloud site.
 
+        The request is queued (see submitMachineRequest), the caller doesn't have to wait for it. Its result is checked
+        by the next management cycle.
+
         :param mid:
         :param action: shut down or delete
         :param method: hardware method or software method
-        :return:
+        :return: request or None, if no request was queued
         """
 
         # get 1and1 client
         client = self.getOneAndOneClient()
+        try:
+            server_id = self.mr.machines[mid][self.reg_site_server_id]
+        except KeyError:
+            self.logger.warning("Server id of %s unknown, could not %s it." % (mid, action))
+            return None
 
         # check if machine status is on or off, if so shut down the machine
         if action in [self.command_power_on, self.command_power_off]:
-            try:
-                client.modify_server_status(server_id=self.mr.machines[mid][self.reg_site_server_id], action=action,
-                                            method=method)
-            except Exception as exception:
-                self.logger.warning(exception)
-                raise exception
+            return self.submitMachineRequest(mid, "Changing status of %s to %s" % (mid, action),
+                                             client.modify_server_status,
+                                             server_id=server_id, action=action, method=method)
         # check if machine should be deleted
-        if action is self.command_delete:
-            try:
-                client.delete_server(server_id=self.mr.machines[mid][self.reg_site_server_id])
-            except Exception as exception:
-                self.logger.warning(exception)
-                raise exception
-        time.sleep(1)
-        return
+        if action == self.command_delete:
+            return self.submitMachineRequest(mid, "Deleting %s" % mid, client.delete_server, server_id=server_id)
 
     def assignPrivateNetwork(self, mid):
         """ Assign VM to a private network
         The VMs have to be assigned to a private network manually due to the missing possibility to assign it while
-        requesting the VM.
+        requesting the VM. The request is queued, see submitMachineRequest.
         :param mid:
         :param netw_id:
-        :return:
+        :return: request or None, if no request was queued
         """
 
         # get 1and1 client
         client = self.getOneAndOneClient()
         try:
-            client.assign_private_network(server_id=self.mr.machines[mid][self.reg_site_server_id],
-                                          private_network_id=self.mr.machines[mid][self.reg_site_server_network])
-        except Exception as exception:
-            self.logger.warning(exception)
-            raise exception
-
-        return
+            server_id = self.mr.machines[mid][self.reg_site_server_id]
+            network_id = self.mr.machines[mid][self.reg_site_server_network]
+        except KeyError:
+            self.logger.warning("Server id or network of %s unknown, could not assign the private network." % mid)
+            return None
+        return self.submitMachineRequest(mid, "Assigning private network to %s" % mid, client.assign_private_network,
+                                         server_id=server_id, private_network_id=network_id)
 
     @property
     def runningMachines(self):
@@ -424,14 +475,11 @@ class OneAndOneSiteAdapter(SiteAdapterBase):
             requested = len(machines_down)
         for mid in list(machines_down.keys())[0:requested]:
             # start the machine
-            try:
-                vm = machines_down[mid]
-                self.modifyMachineStatus(mid, self.command_power_on)
-                self.mr.updateMachineStatus(mid, self.mr.statusBooting)
-                vm[self.reg_site_server_status] = self.state_powered_off
-            except Exception as excpetion:
-                self.logger.info(excpetion)
-                return
+            vm = machines_down[mid]
+            if self.modifyMachineStatus(mid, self.command_power_on) is None:
+                continue
+            self.mr.updateMachineStatus(mid, self.mr.statusBooting)
+            vm[self.reg_site_server_status] = self.state_powered_off
             requested -= 1
 
         # check if any other machines are needed
@@ -447,14 +495,23 @@ class OneAndOneSiteAdapter(SiteAdapterBase):
                 self.getConfig(self.configMaxMachines) - self.cloudOccupyingMachinesCount)
             requested = self.getconfig(self.configMaxMachines) - self.cloudOccupyingMachinesCount
 
-        # get a list of unused indices
+        # get a list of unused indices, including the names of machines still being created
         try:
             oao_machines = self.getOneAndOneMachines()
         except Exception as exception:
             return
+        for mid, machine in self.mr.getMachines(self.siteName).items():
+            if self.reg_site_server_id not in machine:
+                oao_machines[mid] = {self.name: machine[self.reg_site_server_name]}
         free_index = self.getFreeIndex(oao_machines, requested)
 
-        # request new machines
+        client = self.getOneAndOneClient()
+        if client is None:
+            return
+
+        # request new machines, all requests are queued at once
+        # The machines are added to the machine registry right away (status booting), the server id is added by the
+        # next management cycle once the create request is done, see __checkCreateRequest.
         for count in range(requested):
             # assign vm name based on the generated free index list
             vm_name = self.getConfig(self.configPrefix) + free_index.pop(0)
@@ -475,13 +532,7 @@ class OneAndOneSiteAdapter(SiteAdapterBase):
             hdd = Hdd(size=self.getConfig(self.configHddSize), is_main=True)
             hdds = [hdd]
             # request machine at 1and1
-            try:
-                client = self.getOneAndOneClient()
-                vm = client.create_server(server=server, hdds=hdds)
-            except Exception as exception:
-                self.logger.warning("Could not start server on OneAndOne Cloud Service:\n%s\nTrying again next cycle."
-                                    % exception)
-                return
+            request = self.requestScheduler.submit(client.create_server, server=server, hdds=hdds)
 
             # create new machine in machine registry
             mid = self.mr.newMachine()
@@ -490,18 +541,40 @@ class OneAndOneSiteAdapter(SiteAdapterBase):
             self.mr.machines[mid][self.mr.regSite] = self.siteName
             self.mr.machines[mid][self.mr.regSiteType] = self.siteType
             self.mr.machines[mid][self.mr.regMachineType] = machineType
-            self.mr.machines[mid][self.reg_site_server_name] = vm[self.name]
-            self.mr.machines[mid][self.reg_site_server_id] = vm[self.id]
-            self.mr.machines[mid][self.reg_site_server_status] = vm[self.status][self.state]
+            self.mr.machines[mid][self.reg_site_server_name] = vm_name
             self.mr.machines[mid][self.reg_site_server_datacenter] = datacenter_id
             self.mr.machines[mid][self.reg_site_server_network] = network_id
             self.mr.machines[mid][self.reg_site_server_condor_name] = str()
+            self.__machineRequests[mid] = request
 
             # update machine status
             self.mr.updateMachineStatus(mid, self.mr.statusBooting)
 
         return
 
+    def __checkCreateRequest(self, mid):
+        """
+        Add the server id of a machine spawned by spawnMachines, once its create request is done. Machines whose
+        request failed are removed from the machine registry.
+        :param mid:
+        :return:
+        """
+        request = self.__machineRequests.get(mid)
+        if request is None or not request.ready():
+            return
+        try:
+            vm = request.get()
+        except Exception as exception:
+            self.logger.warning("Could not start server on OneAndOne Cloud Service:\n%s\nTrying again next cycle."
+                                % exception)
+            self.mr.removeMachine(mid)
+            self.__machineRequests.pop(mid, None)
+            return
+
+        self.mr.machines[mid][self.reg_site_server_name] = vm[self.name]
+        self.mr.machines[mid][self.reg_site_server_id] = vm[self.id]
+        self.mr.machines[mid][self.reg_site_server_status] = vm[self.status][self.state]
+
     def terminateMachines(self, machineType, count):
         pass
 
@@ -510,6 +583,11 @@ class OneAndOneSiteAdapter(SiteAdapterBase):
         managing machine states that change dependant of the state changes on 1and1 cloud site run once per cycle
         :return:
         """
+        # before listing the servers, so the listing contains the servers created so far
+        for mid, machine in self.mr.getMachines(self.siteName).items():
+            if self.reg_site_server_id not in machine:
+                self.__checkCreateRequest(mid)
+
         try:
             oao_machines = self.getOneAndOneMachines()
         except Exception:
@@ -519,11 +597,16 @@ class OneAndOneSiteAdapter(SiteAdapterBase):
         for mid in self.mr.getMachines(self.siteName):
             machine = self.mr.machines[mid]
 
+            # wait for the create request of the machine
+            if self.reg_site_server_id not in machine and mid in self.__machineRequests:
+                continue
+
             # remove the corresponding machine from the 1and1 machine list
             try:
                 oao_machine = oao_machines.pop(machine[self.reg_site_server_id])
             except KeyError:
                 self.mr.removeMachine(mid)
+                self.__machineRequests.pop(mid, None)
                 continue
 
             # check for status which is handled by integration adapter
@@ -537,19 +620,13 @@ class OneAndOneSiteAdapter(SiteAdapterBase):
                     # check if a private network is assigned
                     # if not then assign the right network
                     if self.network not in oao_machine:
-                        try:
-                            self.assignPrivateNetwork(mid=mid)
-                        except Exception:
-                            break
+                        self.assignPrivateNetwork(mid=mid)
                     # if the private network is assigned to the 1and1 machine, add it to the machine registry
                     elif self.reg_site_server_network not in machine:
                         machine[self.reg_site_server_network] = machine[self.network]
                     # if everything is done, start the machine
                     else:
-                        try:
-                            self.modifyMachineStatus(mid=mid, action=self.command_power_on)
-                        except Exception:
-                            break
+                        self.modifyMachineStatus(mid=mid, action=self.command_power_on)
                         machine[self.reg_site_server_status] = self.state_powering_on
 
                 # it the 1and1machine is powered on, update the ip address, state and the condor name
@@ -581,10 +658,7 @@ class OneAndOneSiteAdapter(SiteAdapterBase):
             elif machine[self.mr.regStatus] == self.mr.statusDisintegrating:
                 # if the machine is still powered on, shut it off
                 if oao_machine[self.status][self.state] == self.state_powered_on:
-                    try:
-                        self.modifyMachineStatus(mid=mid, action=self.command_power_off)
-                    except Exception:
-                        break
+                    self.modifyMachineStatus(mid=mid, action=self.command_power_off)
                     machine[self.reg_site_server_status] = self.state_powering_off
 
             # manage machine in status disintegrated
@@ -599,17 +673,18 @@ class OneAndOneSiteAdapter(SiteAdapterBase):
                 # if the 1and1 machine is powered off, and the delete option is enabled, delete the 1and1 machine
                 if oao_machine[self.status][self.state] == self.state_powered_off:
                     if self.getConfig(self.configDelete) is True:
-                        try:
-                            self.modifyMachineStatus(mid=mid, action=self.command_delete)
-                        except Exception:
-                            break
+                        self.modifyMachineStatus(mid=mid, action=self.command_delete)
                         machine[self.reg_site_server_status] = self.state_deleting
 
         # add all machines remaining in machine list from 1&1
+        site_machines = self.mr.getMachines(self.siteName).values()
+        # servers whose create request finished after the check above are added by the next cycle
+        creating = [machine[self.reg_site_server_name] for machine in site_machines
+                    if self.reg_site_server_id not in machine]
         for oao_machine in oao_machines:
             # check if machine is already in machine registry
-            if oao_machine in [machine[self.reg_site_server_id] for machine in \
-                               self.mr.getMachines(self.siteName).values()]:
+            if oao_machine in [machine.get(self.reg_site_server_id) for machine in site_machines] or \
+                    oao_machines[oao_machine][self.name] in creating:
                 continue
 
             # create new machine in machine registry
@@ -24,7 +24,7 @@ import datetime
 import hashlib
 import logging
 import socket
-from xml.dom import minidom
+from xml.etree import ElementTree
 
 import xmlrpc.client
 
@@ -41,6 +41,7 @@ class OneSiteAdapter(SiteAdapterBase):
     ConfigUser = "oneUser"
     ConfigPass = "onePass"
     ConfigUID = "oneUID"
+    ConfigNicIpAsPublic = "oneNicIpAsPublic"
 
     reg_site_one_vmid = "one_vmid"
     reg_gridengine_node_name = "gridengine_node_name"
@@ -57,13 +58,16 @@ class OneSiteAdapter(SiteAdapterBase):
         self.addCompulsoryConfigKeys(self.ConfigPass, Config.ConfigTypeString)
         self.addCompulsoryConfigKeys(self.ConfigUID, Config.ConfigTypeString)
         self.addCompulsoryConfigKeys(self.ConfigServerProxy, Config.ConfigTypeString)
+        self.addOptionalConfigKeys(self.ConfigNicIpAsPublic, Config.ConfigTypeBoolean,
+                                   description="Use the IP of the first NIC if a VM has no IP_PUBLIC. This may be "
+                                               "a private address.", default=False)
 
         self.hostname_prefix = "cloud-"
 
         self.reg_site_one_first_dead_check = "site_one_first_dead_check"
 
     def init(self):
-        self.mr.registerListener(self)
+        self.mr.registerListener(self, eventTypes=(MachineRegistry.StatusChangedEvent,), site=self.siteName)
 
     def getProxy(self):
         """helper method which returns xmlrpc proxy instance """
@@ -116,18 +120,41 @@ class OneSiteAdapter(SiteAdapterBase):
         logging.debug(vm_action)
         return vm_action
 
-    def ParseVmInfo(self, response):
+    info_elements = ["ID", "UID", "NAME", "STATE", "LCM_STATE"]
+    nic_elements = ["IP_PUBLIC", "MAC"]
 
-        info_elements = ["ID", "UID", "NAME", "STATE", "LCM_STATE", "IP_PUBLIC", "MAC"]
-        info = dict()
-        xmldoc = minidom.parseString(response[1])
+    @staticmethod
+    def parseXml(data):
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        return ElementTree.fromstring(data)
 
-        for element in info_elements:
-            data = xmldoc.getElementsByTagName(element)[0].firstChild.data
-            info[element] = str(data)
+    def ParseVmElement(self, vm):
+        """parses a single <VM> element (of vm.info or vmpool.info) in one pass.
+        "IP_PUBLIC" is taken from anywhere in the vm (usually TEMPLATE/CONTEXT), the IP of the first NIC is only used
+        if oneNicIpAsPublic is set. "MAC" is taken from the first NIC. Both are missing if not part of the element,
+        other missing elements are None"""
+
+        info = dict()
+        for element in self.info_elements:
+            value = vm.findtext(element)
+            info[element] = str(value) if value is not None else None
+
+        nic = vm.find("TEMPLATE/NIC")
+        ip = vm.findtext(".//IP_PUBLIC")
+        if not ip and nic is not None and self.getConfig(self.ConfigNicIpAsPublic) is True:
+            ip = nic.findtext("IP")
+        if ip:
+            info["IP_PUBLIC"] = str(ip)
+        if nic is not None and nic.findtext("MAC"):
+            info["MAC"] = str(nic.findtext("MAC"))
 
         return info
 
+    def ParseVmInfo(self, response):
+
+        return self.ParseVmElement(self.parseXml(response[1]))
+
     def VMInfo(self, vm_id):
         """implements the info method of the one xmlrpc server and returns already parsed
         info as a dictionary
@@ -137,7 +164,7 @@ class OneSiteAdapter(SiteAdapterBase):
             vm_info = self.getProxy().one.vm.info(self.getOneSessionString(), vm_id)
         except socket.error:
             logging.debug("Failed to connect to ONE RPC server %s!" % self.getConfig(self.ConfigServerProxy))
-            vm_info[0] = False
+            vm_info = [False]
 
         if vm_info[0] is True:
             info = [True, self.ParseVmInfo(vm_info)]
@@ -146,30 +173,44 @@ class OneSiteAdapter(SiteAdapterBase):
 
         return info
 
-    def ParseVMPoolInfo(self, vm_pool_info):
+    def VMInfoMulti(self, vm_ids):
+        """calls vm.info for several vms in a single request (system.multicall)
+        returns a dictionary vm id -> parsed info of the successful calls"""
 
-        xmldoc = minidom.parseString(vm_pool_info)
-        number_machines = len(xmldoc.getElementsByTagName("VM"))
+        multicall = xmlrpc.client.MultiCall(self.getProxy())
+        for vm_id in vm_ids:
+            multicall.one.vm.info(self.getOneSessionString(), vm_id)
 
-        info_elements = ["ID", "UID", "NAME", "STATE", "LCM_STATE"]
-        parsed_pool_info = []
-
-        for machine in range(0, number_machines):
-            info = dict()
-            for element in info_elements:
-                data = xmldoc.getElementsByTagName(element)[machine].firstChild.data
-                info[element] = str(data)
-
-            # vm.pool.info doesn't contain "IP_PUBLIC" and "MAC" in its response and have to be obtained via the vm.info method
-            vm_info = self.VMInfo(int(info["ID"]))
+        infos = dict()
+        try:
+            results = list(multicall())
+        except (socket.error, xmlrpc.client.Fault) as err:
+            logging.debug("vm.info multicall to ONE RPC server %s failed: %s" %
+                          (self.getConfig(self.ConfigServerProxy), err))
+            return infos
 
+        for vm_id, vm_info in zip(vm_ids, results):
             if vm_info[0] is True:
-                info["IP_PUBLIC"] = vm_info[1]["IP_PUBLIC"]
-                info["MAC"] = vm_info[1]["MAC"]
+                infos[vm_id] = self.ParseVmInfo(vm_info)
+        return infos
 
-            parsed_pool_info.append(info)
+    def ParseVMPoolInfo(self, vm_pool_info):
+
+        parsed_pool_info = [self.ParseVmElement(vm)
+                            for vm in self.parseXml(vm_pool_info).findall("VM")]
+
+        # without extended info (or IP_PUBLIC/nic in the template), "IP_PUBLIC" and "MAC" have to be obtained via
+        # vm.info, which is batched into one request
+        incomplete = [info for info in parsed_pool_info
+                      if any(element not in info for element in self.nic_elements)]
+        if incomplete:
+            vm_infos = self.VMInfoMulti([int(info["ID"]) for info in incomplete])
+            for info in incomplete:
+                vm_info = vm_infos.get(int(info["ID"]), {})
+                for element in self.nic_elements:
+                    if element in vm_info:
+                        info[element] = vm_info[element]
 
-        # print parsed_pool_info
         # [{'NAME': 'ubuntu_server', 'MAC': '02:00:8d:34:d0:a6', 'STATE': '3', 'IP_PUBLIC': '141.52.208.166', 'LCM_STATE': '3', 'ID': '863', 'UID': '14'}, {'NAME': 'ubuntu_server', 'MAC': '02:00:8d:34:d0:bd', 'STATE': '3', 'IP_PUBLIC': '141.52.208.189', 'LCM_STATE': '3', 'ID': '1129', 'UID': '14'}]
         return parsed_pool_info
 
@@ -183,6 +224,7 @@ class OneSiteAdapter(SiteAdapterBase):
                                                            state)
         except socket.error:
             logging.debug("Failed to connect to ONE RPC server %s!" % self.getConfig(self.ConfigServerProxy))
+            vm_pool_info = [False]
 
         if vm_pool_info[0] is True:
             info = [True, self.ParseVMPoolInfo(vm_pool_info[1])]
@@ -237,48 +279,57 @@ class OneSiteAdapter(SiteAdapterBase):
         # print myMachines
         # {'8e661aac-fc4e-450f-9cbb-e57ec6e4adb2': {'status': 'working', 'site_type': 'one', 'hostname': '141.52.208.174', 'ssh_key': 'one_host_key', 'one_vmid': 910, 'status_last_update': datetime.datetime(2011, 1, 13, 15, 48, 39, 328084), 'machine_type': 'euca-default', 'site': 'one_site_scc'}}
 
-        for mid in myMachines:
-            if myMachines[mid]["status"] == "booting":
-                vm_info = self.VMInfo(myMachines[mid]["one_vmid"])
-                logging.debug(myMachines[mid]["vpn_ip"])
-                logging.debug(myMachines[mid]["vpn_cert_is_valid"])
-                logging.debug(myMachines[mid]["vpn_cert"])
-                if vm_info[0] is True:
-
-                    if vm_info[1]["STATE"] == "3" and vm_info[1]["LCM_STATE"] == "3":
-                        if self.checkIfMachineIsUp(mid):
-                            vpn = ScaleTools.Vpn()
-
-                            if myMachines[mid]["vpn_cert_is_valid"] is None:
-                                if vpn.makeCertificate(myMachines[mid]["vpn_cert"]) == 0:
-                                    myMachines[mid]["vpn_cert_is_valid"] = True
-
-                            if myMachines[mid]["vpn_cert_is_valid"] is True and \
-                                            myMachines[mid]["vpn_ip"] is None:
-                                if (vpn.copyCertificate(myMachines[mid]["vpn_cert"],
-                                                        myMachines[mid]) == 0):
-                                    if (vpn.connectVPN(myMachines[mid]["vpn_cert"],
-                                                       myMachines[mid]) == 0):
-                                        (res, ip) = vpn.getIP(myMachines[mid])
-                                        logging.debug(res)
-                                        logging.debug(ip)
-                                        if res == 0 and ip != "":
-                                            myMachines[mid]["vpn_ip"] = ip
-                                        else:
-                                            logging.debug("getting VPN IP failed!!")
-
-                            if (myMachines[mid]["vpn_cert_is_valid"] is True and myMachines[mid][
-                                "vpn_ip"] is not None):
-                                # if( vpn.revokeCertificate(myMachines[k]["vpn_cert"]) == 0):
-                                #    myMachines[k]["vpn_cert_is_valid"] = False
-                                self.mr.updateMachineStatus(mid, self.mr.statusUp)
-
-                            logging.debug(myMachines[mid]["vpn_ip"])
-                            logging.debug(myMachines[mid]["vpn_cert_is_valid"])
-                            logging.debug(myMachines[mid]["vpn_cert"])
-
-                        else:
-                            self.checkForDeadMachine(mid)
+        booting = [mid for mid in myMachines if myMachines[mid]["status"] == "booting"]
+        if not booting:
+            return
+
+        # one request for all vms instead of vm.info per booting machine
+        vm_pool = self.VMPoolInfo()
+        if vm_pool[0] is not True:
+            return
+        vm_infos = dict((int(info["ID"]), info) for info in vm_pool[1])
+
+        for mid in booting:
+            vm_info = vm_infos.get(int(myMachines[mid]["one_vmid"]))
+            logging.debug(myMachines[mid]["vpn_ip"])
+            logging.debug(myMachines[mid]["vpn_cert_is_valid"])
+            logging.debug(myMachines[mid]["vpn_cert"])
+            if vm_info is not None:
+
+                if vm_info["STATE"] == "3" and vm_info["LCM_STATE"] == "3":
+                    if self.checkIfMachineIsUp(mid):
+                        vpn = ScaleTools.Vpn()
+
+                        if myMachines[mid]["vpn_cert_is_valid"] is None:
+                            if vpn.makeCertificate(myMachines[mid]["vpn_cert"]) == 0:
+                                myMachines[mid]["vpn_cert_is_valid"] = True
+
+                        if myMachines[mid]["vpn_cert_is_valid"] is True and \
+                                        myMachines[mid]["vpn_ip"] is None:
+                            if (vpn.copyCertificate(myMachines[mid]["vpn_cert"],
+                                                    myMachines[mid]) == 0):
+                                if (vpn.connectVPN(myMachines[mid]["vpn_cert"],
+                                                   myMachines[mid]) == 0):
+                                    (res, ip) = vpn.getIP(myMachines[mid])
+                                    logging.debug(res)
+                                    logging.debug(ip)
+                                    if res == 0 and ip != "":
+                                        myMachines[mid]["vpn_ip"] = ip
+                                    else:
+                                        logging.debug("getting VPN IP failed!!")
+
+                        if (myMachines[mid]["vpn_cert_is_valid"] is True and myMachines[mid][
+                            "vpn_ip"] is not None):
+                            # if( vpn.revokeCertificate(myMachines[k]["vpn_cert"]) == 0):
+                            #    myMachines[k]["vpn_cert_is_valid"] = False
+                            self.mr.updateMachineStatus(mid, self.mr.statusUp)
+
+                        logging.debug(myMachines[mid]["vpn_ip"])
+                        logging.debug(myMachines[mid]["vpn_cert_is_valid"])
+                        logging.debug(myMachines[mid]["vpn_cert"])
+
+                    else:
+                        self.checkForDeadMachine(mid)
 
     """
         Possible VM States @ ONE:
@@ -308,7 +359,9 @@ class OneSiteAdapter(SiteAdapterBase):
                 self.mr.machines[mid][self.reg_site_one_vmid] = info[1]  # ONE VM ID
                 self.mr.machines[mid][self.reg_gridengine_node_name] = node_name
                 # hostname = ip - if you use scale tools you better not mix up the definitions otherwise ssh can't connect for instance
-                self.mr.machines[mid][self.mr.regHostname] = self.VMInfo(info[1])[1]["IP_PUBLIC"]
+                vm_info = self.VMInfo(info[1])
+                self.mr.machines[mid][self.mr.regHostname] = \
+                    vm_info[1].get("IP_PUBLIC") if vm_info[0] is True else None
                 self.mr.machines[mid][self.mr.regSshKey] = "one_host_key"
                 self.mr.updateMachineStatus(mid, self.mr.statusBooting)
                 self.mr.machines[mid][self.mr.regVpnCert] = node_name
@@ -22,10 +22,13 @@ from __future__ import unicode_literals, absolute_import
 
 import datetime
 import logging
+import threading
 import uuid
+from multiprocessing.pool import ThreadPool
 
 try:
     from novaclient.client import Client
+    from novaclient.exceptions import Unauthorized
     from novaclient.v1_1.hypervisors import HypervisorManager
 except ImportError as e:
     print(e)
@@ -33,6 +36,7 @@ except ImportError as e:
 from Core import MachineRegistry, Config
 from SiteAdapter.Site import SiteAdapterBase
 from Util.Logging import JsonLog
+from Util.PythonTools import Caching
 
 
 class OpenStackSiteAdapter(SiteAdapterBase):
@@ -73,6 +77,8 @@ class OpenStackSiteAdapter(SiteAdapterBase):
     configKeypair = "openstack_keypair_id"
     configNetwork = "openstack_network_id"
     configUserData = "user_data"
+    configBulkCreate = "openstack_bulk_create"
+    configTeardownWorkers = "openstack_teardown_workers"
 
     # name, id and status of VMs at OpenStack
     reg_site_server_name = "reg_site_server_name"
@@ -88,6 +94,10 @@ class OpenStackSiteAdapter(SiteAdapterBase):
 
     reg_status_change_history = "state_change_history"
 
+    # authenticated Nova clients, shared by all adapters using the same credentials, see __getNovaApi
+    __novaClients = {}
+    __novaClientsLock = threading.Lock()
+
     def __init__(self):
         """
         Load config keys from config files
@@ -158,6 +168,18 @@ class OpenStackSiteAdapter(SiteAdapterBase):
         self.addOptionalConfigKeys(self.configUserData, Config.ConfigTypeString,
                                    description="Defines the storage path of user data scripts for cloud-init",
                                    default=None)
+        self.addOptionalConfigKeys(self.configBulkCreate, Config.ConfigTypeBoolean,
+                                   description="Spawn all machines of a cycle with a single create request",
+                                   default=True)
+        self.addOptionalConfigKeys(self.configTeardownWorkers, Config.ConfigTypeInt,
+                                   description="Number of parallel stop/delete requests", default=10)
+
+        self.__teardownPool = None
+        # stop/delete requests which have not finished yet, {mid: (action, AsyncResult)}
+        self.__pendingTeardowns = {}
+        self.__pendingTeardownsLock = threading.RLock()
+        # bulk create requests whose servers were not all listed yet, {name: (machine type, requested)}
+        self.__pendingBulkCreates = {}
 
     def init(self):
         super(OpenStackSiteAdapter, self).init()
@@ -174,10 +196,19 @@ class OpenStackSiteAdapter(SiteAdapterBase):
         urllib3_logger = logging.getLogger("requests.packages.urllib3.connectionpool")
         urllib3_logger.setLevel(logging.CRITICAL)
 
-        self.mr.registerListener(self)
+        self.mr.registerListener(self, eventTypes=(MachineRegistry.StatusChangedEvent,), site=self.siteName)
 
         self._machineType = list(self.getConfig(self.configMachines).keys())[0]
 
+        self.__teardownPool = ThreadPool(processes=self.getConfig(self.configTeardownWorkers))
+
+    def shutdown(self):
+        """wait for queued stop/delete requests, see __teardown"""
+        if self.__teardownPool is not None:
+            self.__teardownPool.close()
+            self.__teardownPool.join()
+            self.__teardownPool = None
+
     def getMaxMachines(self):
         """
         Get maximum number of allowed VMs on site
@@ -232,17 +263,19 @@ class OpenStackSiteAdapter(SiteAdapterBase):
             return 0
 
         try:
-            nova = self.__getNovaApi()
-
             # important to give a specifc network due to bug in nova api:
             netw = self.getConfig(self.configNetwork)
             fls = self.getConfig(self.configFlavor)  # nova.flavors.find(name=self.getConfig(self.configFlavor))
             img = self.getConfig(self.configImage)  # nova.images.find(name=self.getConfig(self.configImage))
             key = self.getConfig(self.configKeypair)  # nova.keypairs.list()
             name_prefix = str(self.siteName + "-")
-            print self.getConfig(self.configUserData)
-            user_data = open(self.getConfig(self.configUserData), "r")
-            print user_data
+            create_args = {"nics": [{"net-id": netw}]}
+            if key is not None:
+                create_args["key_name"] = key
+            if self.getConfig(self.configUserData) is not None:
+                # read once, shared by all machines
+                with open(self.getConfig(self.configUserData), "r") as user_data:
+                    create_args["userdata"] = user_data.read()
             daytime = datetime.datetime.strptime(self.getConfig(self.configDay), "%H:%M")
             nighttime = datetime.datetime.strptime(self.getConfig(self.configNight), "%H:%M")
 
@@ -276,46 +309,98 @@ class OpenStackSiteAdapter(SiteAdapterBase):
             ###
             # spawn machines
             ###
-            for count in range(requested):
-                # init new machine in machine registry
-                mid = name_prefix + str(uuid.uuid4())
-                self.mr.newMachine(mid)
-                # spawn machine at site
-                if not key is None:
-                    vm = nova.servers.create(mid, img, fls, nics=[{"net-id": netw}], userdata=user_data,
-                                             key_name=key)
-                else:
-                    vm = nova.servers.create(mid, img, fls, nics=[{"net-id": netw}], userdata=user_data)
-
-                # set some machine information in machine registry
-                self.mr.machines[mid][self.mr.regSite] = self.siteName
-                self.mr.machines[mid][self.mr.regSiteType] = self.siteType
-                self.mr.machines[mid][self.mr.regMachineType] = machineType
-                self.mr.machines[mid][self.reg_site_server_id] = vm.id
-                self.mr.machines[mid][self.reg_site_server_status] = vm.status
-                self.mr.machines[mid][self.reg_site_server_condor_name] = mid
-                self.mr.machines[mid][self.reg_site_server_name] = mid
-                # if admin account is set, also set the hypervisor
-                if self.getConfig(self.configUseTime):
-                    # time.sleep(1)
+            if requested <= 0:
+                return 0
+            if self.getConfig(self.configBulkCreate) is True:
+                spawned, pending = self.__bulkCreate(machineType, requested, name_prefix, img, fls, create_args)
+            else:
+                spawned, pending = [], 0
+                for count in range(requested):
+                    mid = name_prefix + str(uuid.uuid4())
+                    # spawn machine at site, the machines spawned so far are kept if a request fails
+                    try:
+                        vm = self.__novaCall(lambda nova: nova.servers.create(mid, img, fls, **create_args))
+                    except Exception as e:
+                        self.logger.warning("Spawned %d of %d machines. Exception: %s" % (len(spawned), requested, e))
+                        break
+                    self.__registerMachine(mid, vm.id, vm.status, machineType)
+                    spawned.append(mid)
+
+            # if admin account is set, also set the hypervisor (single lookup for all new machines)
+            if self.getConfig(self.configUseTime) and spawned:
+                type(self).hypervisorIndex.fget.invalidate(self)
+                for mid in spawned:
                     self.mr.machines[mid][self.reg_site_server_hypervisor] = self.__getHypervisor(
-                        vm.id)
-
-                # TODO: set machine information, like openstack id
-                self.mr.updateMachineStatus(mid, self.mr.statusBooting)
+                        self.mr.machines[mid][self.reg_site_server_id])
 
-            # all machines booted
-            return requested
+            # servers of a bulk create request which are not listed yet are added by manage
+            return len(spawned) + pending
 
         # if spawning fails, do nothing
         except Exception as e:
             self.logger.warning("Spawning machines failed. Exception: %s" % e)
+            return 0
+
+    def __bulkCreate(self, machineType, requested, name_prefix, image, flavor, create_args):
+        """Spawn machines with a single create request
+
+        Nova names the servers of a multi-create request after the template "<name>-<n>"
+        (multi_instance_display_name_template), a single server gets the plain name. The servers are listed by this
+        common name afterwards and added to the machine registry. Servers which are not listed yet are added by the
+        next manage, see __reconcileBulkCreates. Nova creates as many servers as possible (quota).
+
+        :param machineType:
+        :param requested: requested number of machines
+        :return: ids of spawned machines, number of machines not listed yet
+        """
+        name = name_prefix + str(uuid.uuid4())
+        self.__novaCall(lambda nova: nova.servers.create(name, image, flavor, min_count=1, max_count=requested,
+                                                         **create_args))
+        servers = self.__novaCall(lambda nova: nova.servers.list(search_opts={"name": "^%s" % name}))
+        if len(servers) < requested:
+            self.logger.info("%d of %d machines listed after create, the others are added in the next cycle." %
+                             (len(servers), requested))
+            self.__pendingBulkCreates[name] = (machineType, requested)
+
+        with self.mr.batch():
+            for vm in servers:
+                self.__registerMachine(vm.name, vm.id, vm.status, machineType)
+        return [vm.name for vm in servers], max(0, requested - len(servers))
+
+    def __reconcileBulkCreates(self, nova_machines):
+        """Add the servers of bulk create requests which were not listed right after the create request
+
+        :param nova_machines: machines listed in OpenStack, see __getNovaMachines
+        """
+        for name, (machineType, requested) in list(self.__pendingBulkCreates.items()):
+            spawned = [mid for mid in nova_machines if mid.startswith(name)]
+            for mid in spawned:
+                if mid not in self.mr.machines:
+                    self.__registerMachine(mid, nova_machines[mid][self.reg_site_server_id],
+                                           nova_machines[mid][self.reg_site_server_status], machineType)
+            if len(spawned) < requested:
+                self.logger.warning("Only %d of %d machines could be spawned." % (len(spawned), requested))
+            del self.__pendingBulkCreates[name]
+
+    def __registerMachine(self, mid, server_id, server_status, machineType):
+        """Add a newly spawned machine to the machine registry (status booting)."""
+        self.mr.newMachine(mid)
+        # set some machine information in machine registry
+        self.mr.machines[mid][self.mr.regSite] = self.siteName
+        self.mr.machines[mid][self.mr.regSiteType] = self.siteType
+        self.mr.machines[mid][self.mr.regMachineType] = machineType
+        self.mr.machines[mid][self.reg_site_server_id] = server_id
+        self.mr.machines[mid][self.reg_site_server_status] = server_status
+        self.mr.machines[mid][self.reg_site_server_condor_name] = mid
+        self.mr.machines[mid][self.reg_site_server_name] = mid
+        self.mr.updateMachineStatus(mid, self.mr.statusBooting)
 
     def __openstackTerminateMachines(self, mid):
         """Terminate machines in OpenStack
 
         This function will terminate/delete the machine in OpenStack, which means it will clean up
-        the used resources in OpenStack, and remove the machine from the machine registry.
+        the used resources in OpenStack. The request is sent in the background (teardown pool), using the server id
+        from the machine registry. The machine is removed from the machine registry by manage once it is down.
 
         If terminating the machine fails, for example due to connection failures, nothing happens
         until the next management cycle.
@@ -323,15 +408,7 @@ class OpenStackSiteAdapter(SiteAdapterBase):
         :param mid: id of machine to terminate
         :return:
         """
-        try:
-            # initialize the NovaAPI
-            nova = self.__getNovaApi()
-            # send terminate/delete command
-            nova.servers.find(id=self.mr.machines[mid.id][self.reg_site_server_id]).delete()
-            # remove from machine registry
-            self.mr.removeMachine(mid)
-        except Exception:
-            pass
+        self.__teardown(mid, "delete", lambda nova, server_id: nova.servers.delete(server_id))
 
     def __openstackStopMachine(self, mid):
         """Stop machines in OpenStack
@@ -346,13 +423,45 @@ class OpenStackSiteAdapter(SiteAdapterBase):
         :param mid: id of machine to stop
         :return:
         """
+        self.__teardown(mid, "stop", lambda nova, server_id: nova.servers.stop(server_id))
+
+    def __teardown(self, mid, action, call):
+        """Send a stop/delete request for machine mid in the background, at most openstack_teardown_workers
+        requests run in parallel. The same request is not sent again while it is pending.
+
+        :param mid: id of machine
+        :param action: name of the request (log)
+        :param call: function(NovaClient, server id)
+        """
         try:
-            # initialize the NovaAPI
-            nova = self.__getNovaApi()
-            # send the stop command for shutting down
-            nova.servers.find(id=self.mr.machines[mid][self.reg_site_server_id]).stop()
-        except Exception:
-            pass
+            server_id = self.mr.machines[mid][self.reg_site_server_id]
+        except KeyError:
+            return
+
+        def request():
+            try:
+                self.__novaCall(lambda nova: call(nova, server_id))
+            except Exception as e:
+                self.logger.warning("Failed to %s machine %s: %s" % (action, mid, e))
+
+        with self.__pendingTeardownsLock:
+            if self.__pendingTeardowns.get(mid, (None,))[0] == action and self.__teardownPending(mid):
+                return
+            if self.__teardownPool is None:
+                request()
+            else:
+                self.__pendingTeardowns[mid] = (action, self.__teardownPool.apply_async(request))
+
+    def __teardownPending(self, mid):
+        """Check whether a stop/delete request of machine mid is queued or running, finished requests are dropped.
+
+        :param mid: id of machine
+        :return: bool
+        """
+        with self.__pendingTeardownsLock:
+            if mid in self.__pendingTeardowns and self.__pendingTeardowns[mid][1].ready():
+                del self.__pendingTeardowns[mid]
+            return mid in self.__pendingTeardowns
 
     def __openstackTimeDepStopMachine(self):
         """
@@ -427,7 +536,10 @@ class OpenStackSiteAdapter(SiteAdapterBase):
 
         :return:
         """
+        # the hypervisors of all machines are listed (at most) once per cycle
+        type(self).hypervisorIndex.fget.invalidate(self)
         nova_machines = self.__getNovaMachines()
+        self.__reconcileBulkCreates(nova_machines)
 
         # Look for each machine in machine registry and perform necessary status change(s).
         #
@@ -438,6 +550,11 @@ class OpenStackSiteAdapter(SiteAdapterBase):
         # This can happen, if (somehow) machines boot up at OpenStack without being requested...
 
         for mid in self.mr.getMachines(self.siteName):
+            # wait for a stop/delete request, the machine must neither be removed nor added again before it finished
+            if self.__teardownPending(mid):
+                nova_machines.pop(mid, None)
+                continue
+
             # machine not listed in OpenStack -> remove from machine registry
             if len(nova_machines) == 0 or mid not in nova_machines:
                 self.mr.removeMachine(mid)
@@ -518,7 +635,7 @@ class OpenStackSiteAdapter(SiteAdapterBase):
         #  requested machines, nodes, draining nodes.
         ###
         self.logger.info("Current machines running at %s: %d" %
-                         (self.siteName, self.runningMachinesCount[self.getConfig(self.configMachines).keys()[0]]))
+                         (self.siteName, self.runningMachinesCount[self._machineType]))
         json_log = JsonLog()
         json_log.addItem(self.siteName, "machines_requested",
                          int(len(self.getSiteMachines(status=self.mr.statusBooting)) +
@@ -547,7 +664,7 @@ class OpenStackSiteAdapter(SiteAdapterBase):
                         self.__openstackStopMachine(mid.id)
                     # if new status is disintegrated, machine is already shut down, so kill it
                     if mid.newStatus == self.mr.statusDisintegrated:
-                        self.__openstackTerminateMachines(mid)
+                        self.__openstackTerminateMachines(mid.id)
                         self.mr.updateMachineStatus(mid.id, self.mr.statusDown)
 
     def __getHypervisor(self, id_):
@@ -556,27 +673,59 @@ class OpenStackSiteAdapter(SiteAdapterBase):
 
         :return:vm_hypervisor
         """
+        hypervisor_index = self.hypervisorIndex
+        if hypervisor_index is None:
+            return None
+        return hypervisor_index.get(str(id_))
 
-        nova = self.__getNovaApi(self.getConfig(self.configUseTime))
-        nova_machines = [(vm.id, vm.__dict__["OS-EXT-SRV-ATTR:host"]) for vm in
-                         nova.servers.list(search_opts={"all_tenants": True})]
+    @property
+    @Caching(validityPeriod=0, redundancyPeriod=-1)
+    def hypervisorIndex(self):
+        """Hypervisor of every VM (all tenants), {server id: hypervisor}.
 
-        # return the corresponding hypervisor
-        for (vm_id, vm_hypervisor) in nova_machines:
-            if str(vm_id) == str(id_):
-                # if vm_hypervisor == "None":
+        Listed with a single (admin) API call and kept until manage/spawnMachines drop it.
 
-                return vm_hypervisor
+        :return: hypervisor_index
+        """
+        servers = self.__novaCall(lambda nova: nova.servers.list(detailed=True, search_opts={"all_tenants": True}),
+                                  self.getConfig(self.configUseTime))
+        return {str(vm.id): getattr(vm, "OS-EXT-SRV-ATTR:host", None) for vm in servers}
 
     def __getNovaApi(self, admin_access=False):
         """Nova Client API
 
-        initialize the Nova Client API with the specified settings
+        Return the Nova Client API with the specified settings. Clients are created once per set of credentials and
+        reuse their authentication token, see __novaCall for expired tokens.
 
         :rtype: Client
         :return: NovaClient
         """
-
+        credentials = self.__novaCredentials(admin_access)
+        with self.__novaClientsLock:
+            if credentials not in self.__novaClients:
+                user, password, tenant, keystone, time_out = credentials
+                self.__novaClients[credentials] = Client(2, user, password, tenant, keystone, timeout=time_out)
+            return self.__novaClients[credentials]
+
+    def __novaCall(self, call, admin_access=False):
+        """Call function call(nova) with the (cached) Nova Client API.
+
+        If the authentication token was rejected (e.g. expired), the client is replaced by a newly authenticated one
+        and the call is repeated once.
+
+        :param call: function(NovaClient)
+        :param admin_access:
+        :return: result of call
+        """
+        try:
+            return call(self.__getNovaApi(admin_access))
+        except Unauthorized:
+            self.logger.info("OpenStack authentication expired, logging in again.")
+            with self.__novaClientsLock:
+                self.__novaClients.pop(self.__novaCredentials(admin_access), None)
+            return call(self.__getNovaApi(admin_access))
+
+    def __novaCredentials(self, admin_access=False):
         # login in data to OpenStack
         if admin_access:
             user = self.getConfig(self.configAdmin)
@@ -588,9 +737,7 @@ class OpenStackSiteAdapter(SiteAdapterBase):
             tenant = self.getConfig(self.configTenant)
         keystone = self.getConfig(self.configKeystoneServer)
         time_out = self.getConfig(self.configTimeout)
-
-        # client = __import__("novaclient", globals(), locals(), [], 0)
-        return Client(2, user, password, tenant, keystone, timeout=time_out)
+        return user, password, tenant, keystone, time_out
 
     def __getNovaMachines(self):
         """Get list of machines from OpenStack
@@ -598,12 +745,9 @@ class OpenStackSiteAdapter(SiteAdapterBase):
         :return: nova_machines
         """
 
-        # init NovaClient
-        nova = self.__getNovaApi()
-
         # get list of servers
         try:
-            nova_results = [(x.id, x.name, x.status) for x in nova.servers.list()]
+            nova_results = [(x.id, x.name, x.status) for x in self.__novaCall(lambda nova: nova.servers.list())]
             # except Exception:
             #    pass
 
@@ -27,6 +27,7 @@ import logging
 
 from Core import MachineRegistry, Config
 from Core.Adapter import AdapterBase, AdapterBoxBase
+from Util.PythonTools import merge_dicts
 
 
 class SiteInformation(object):
@@ -56,6 +57,15 @@ class SiteAdapterBase(AdapterBase):
 
     mr = MachineRegistry.MachineRegistry()
 
+    # status of machines counted as running (runningMachines) and as occupying cloud resources (cloudOccupyingMachines)
+    runningStatuses = (MachineRegistry.MachineRegistry.statusBooting,
+                       MachineRegistry.MachineRegistry.statusUp,
+                       MachineRegistry.MachineRegistry.statusIntegrating,
+                       MachineRegistry.MachineRegistry.statusWorking,
+                       MachineRegistry.MachineRegistry.statusPendingDisintegration)
+    cloudOccupyingStatuses = runningStatuses + (MachineRegistry.MachineRegistry.statusDisintegrating,
+                                                MachineRegistry.MachineRegistry.statusDisintegrated)
+
     # Override the following for your custom cloud implementation
     @abc.abstractmethod
     def __init__(self):
@@ -192,18 +202,18 @@ class SiteAdapterBase(AdapterBase):
         if statusFilter is None:
             statusFilter = []
 
-        myMachines = self.getSiteMachines()
+        if statusFilter:  # empty list returns false in this statement
+            # (site, status) index lookups instead of filtering all site machines
+            myMachines = merge_dicts(*(self.getSiteMachines(status=status) for status in statusFilter))
+        else:
+            myMachines = self.getSiteMachines()
         machineList = dict()
 
         for i in self.getConfig(self.ConfigMachines):
             machineList[i] = []
 
         for mid, machine in myMachines.items():
-            if statusFilter:  # empty list returns false in this statement
-                if machine.get(self.mr.regStatus) in statusFilter:
-                    machineList[machine[self.mr.regMachineType]].append(mid)
-            else:
-                machineList[machine[self.mr.regMachineType]].append(mid)
+            machineList[machine[self.mr.regMachineType]].append(mid)
 
         return machineList
 
@@ -213,23 +223,19 @@ class SiteAdapterBase(AdapterBase):
 
         :return dictionary {machine_type: [machine ID, machine ID, ...], ...} :
         """
-        statusFilter = [self.mr.statusBooting,
-                        self.mr.statusUp,
-                        self.mr.statusIntegrating,
-                        self.mr.statusWorking,
-                        self.mr.statusPendingDisintegration]
-        return self.getSiteMachinesAsDict(statusFilter)
+        return self.getSiteMachinesAsDict(list(self.runningStatuses))
 
     @property
     def runningMachinesCount(self):
-        """Dictionary of number of machine types running at a site.
+        """Dictionary of number of machine types running at a site (from the registry's count index).
 
         :return {machine_type: integer, ...}:
         """
-        running_machines = self.runningMachines
         running_machines_count = dict()
-        for (machine_type, midList) in running_machines.items():
-            running_machines_count[machine_type] = len(midList)
+        for machine_type in self.getConfig(self.ConfigMachines):
+            running_machines_count[machine_type] = sum(
+                self.mr.countMachines(site=self.siteName, status=status, machineType=machine_type)
+                for status in self.runningStatuses)
         return running_machines_count
 
     @property
@@ -241,22 +247,12 @@ class SiteAdapterBase(AdapterBase):
 
         :return dictionary {machine_type: [machine ID, machine ID, ...], ...} :
         """
-        statusFilter = [self.mr.statusBooting,
-                        self.mr.statusUp,
-                        self.mr.statusIntegrating,
-                        self.mr.statusWorking,
-                        self.mr.statusPendingDisintegration,
-                        self.mr.statusDisintegrating,
-                        self.mr.statusDisintegrated]
-        return self.getSiteMachinesAsDict(statusFilter)
+        return self.getSiteMachinesAsDict(list(self.cloudOccupyingStatuses))
 
     @property
     def cloudOccupyingMachinesCount(self):
-        """Total number of machines occupying computing resources on a site."""
-        sum_ = 0
-        for (machineType, midList) in self.cloudOccupyingMachines.items():
-            sum_ += len(midList)
-        return sum_
+        """Total number of machines occupying computing resources on a site (from the registry's count index)."""
+        return sum(self.mr.countMachines(site=self.siteName, status=status) for status in self.cloudOccupyingStatuses)
 
     def isMachineTypeSupported(self, machineType):
         return machineType in self.getConfig(self.ConfigMachines)
@@ -334,7 +330,8 @@ class SiteBox(AdapterBoxBase):
             return None
 
     def applyMachineDecision(self, decision):
-        [x.applyMachineDecision(decision.get(x.siteName, dict())) for x in self._adapterList]
+        self.callAdapters(lambda site: site.applyMachineDecision(decision.get(site.siteName, dict())),
+                          phase="applyMachineDecision")
 
     def modServiceMachineDecision(self, decision):
         # type: (dict) -> dict
@@ -20,6 +20,13 @@
 # ===============================================================================
 from __future__ import unicode_literals, absolute_import
 
+import logging
+import sys
+import threading
+import time
+
+import configparser
+
 from Core import ScaleTest
 
 
@@ -362,4 +369,334 @@ class EucaSiteAdapterTest:  # (ScaleTest.ScaleTestBase):
 
 
 class ONESiteAdapterTest(ScaleTest.ScaleTestBase):
-    pass
+    poolInfo = """<VM_POOL>
+<VM><ID>863</ID><UID>14</UID><NAME>cloud-1</NAME><STATE>3</STATE><LCM_STATE>3</LCM_STATE>
+<TEMPLATE><NIC><IP>141.52.208.166</IP><MAC>02:00:8d:34:d0:a6</MAC></NIC></TEMPLATE></VM>
+<VM><ID>1129</ID><NAME>cloud-2</NAME><STATE>1</STATE><LCM_STATE>0</LCM_STATE></VM>
+<VM><ID>1130</ID><UID>14</UID><NAME>cloud-3</NAME><STATE>3</STATE><LCM_STATE>3</LCM_STATE>
+<TEMPLATE><CONTEXT><IP_PUBLIC>141.52.208.190</IP_PUBLIC></CONTEXT><NIC><IP>10.0.0.5</IP><MAC>02:00:8d:34:d0:be</MAC>
+</NIC></TEMPLATE></VM>
+</VM_POOL>"""
+
+    class MockProxy(object):
+        vmInfo = {863: "<VM><ID>863</ID><UID>14</UID><NAME>cloud-1</NAME><STATE>3</STATE><LCM_STATE>3</LCM_STATE>"
+                       "<TEMPLATE><NIC><IP>141.52.208.166</IP><MAC>02:00:8d:34:d0:a6</MAC></NIC></TEMPLATE></VM>",
+                  1129: "<VM><ID>1129</ID><UID>14</UID><NAME>cloud-2</NAME><STATE>3</STATE><LCM_STATE>3</LCM_STATE>"
+                        "<TEMPLATE><CONTEXT><IP_PUBLIC>141.52.208.189</IP_PUBLIC></CONTEXT><NIC><IP>10.0.0.6</IP>"
+                        "<MAC>02:00:8d:34:d0:bd</MAC></NIC></TEMPLATE></VM>"}
+
+        def __init__(self):
+            self.multicalls = []
+            self.system = self
+
+        def multicall(self, calls):
+            self.multicalls.append(calls)
+            return [[[True, self.vmInfo[call["params"][1]]]] for call in calls]
+
+    def getSite(self, nicIpAsPublic):
+        from SiteAdapter.OneSiteAdapter import OneSiteAdapter
+
+        site = OneSiteAdapter()
+        site.proxy = self.MockProxy()
+        site.getOneSessionString = lambda: "user:hash"
+        site.setConfig(OneSiteAdapter.ConfigNicIpAsPublic, nicIpAsPublic)
+        return site
+
+    def test_parseVMPoolInfo(self):
+        site = self.getSite(False)
+
+        info = site.ParseVMPoolInfo(self.poolInfo)
+        # the nic ip may be private, IP_PUBLIC is missing without one in vm.info
+        self.assertEqual(info[0], {"ID": "863", "UID": "14", "NAME": "cloud-1", "STATE": "3", "LCM_STATE": "3",
+                                   "MAC": "02:00:8d:34:d0:a6"})
+        self.assertEqual((info[1]["IP_PUBLIC"], info[1]["MAC"]), ("141.52.208.189", "02:00:8d:34:d0:bd"))
+        self.assertEqual((info[1]["STATE"], info[1]["UID"]), ("1", None))
+        # IP_PUBLIC from the context
+        self.assertEqual((info[2]["IP_PUBLIC"], info[2]["MAC"]), ("141.52.208.190", "02:00:8d:34:d0:be"))
+        # vm.info only for the vms without IP_PUBLIC or nic, in one request
+        self.assertEqual(len(site.proxy.multicalls), 1)
+        self.assertEqual([call["params"][1] for call in site.proxy.multicalls[0]], [863, 1129])
+
+    def test_parseVMPoolInfoNicIp(self):
+        site = self.getSite(True)
+
+        info = site.ParseVMPoolInfo(self.poolInfo)
+        self.assertEqual(info[0]["IP_PUBLIC"], "141.52.208.166")
+        self.assertEqual(info[1]["IP_PUBLIC"], "141.52.208.189")
+        self.assertEqual(info[2]["IP_PUBLIC"], "141.52.208.190")
+        self.assertEqual([call["params"][1] for call in site.proxy.multicalls[0]], [1129])
+
+
+class Ec2SiteAdapterTest(ScaleTest.ScaleTestBase):
+    class FakeEc2Client(object):
+        """Stand-in for the boto3 EC2 client: instances {id: tags}, running ones have a status, 2 results per page."""
+
+        def __init__(self, instances, running):
+            self.instances = instances
+            self.running = running
+            self.calls = []
+
+        def get_paginator(self, operation):
+            client = self
+
+            class Paginator(object):
+                def paginate(self, **kwargs):
+                    client.calls.append((operation, kwargs))
+                    results = getattr(client, operation)(**kwargs)
+                    for i in range(0, len(results), 2):
+                        if operation == "describe_instances":
+                            yield {"Reservations": [{"Instances": results[i:i + 2]}]}
+                        else:
+                            yield {{"describe_instance_status": "InstanceStatuses", "describe_volumes": "Volumes",
+                                    "describe_snapshots": "Snapshots"}[operation]: results[i:i + 2]}
+
+            return Paginator()
+
+        def describe_instances(self, Filters):
+            instances = sorted(self.instances)
+            for filter_ in Filters:
+                if filter_["Name"] == "instance-id":
+                    instances = [id_ for id_ in instances if id_ in filter_["Values"]]
+                else:
+                    key = filter_["Name"][len("tag:"):]
+                    instances = [id_ for id_ in instances if self.instances[id_].get(key) in filter_["Values"]]
+            return [{"InstanceId": id_} for id_ in instances]
+
+        def describe_instance_status(self, InstanceIds=None):
+            return [{"InstanceId": id_, "InstanceState": {"Name": "running"}, "InstanceStatus": {"Status": "ok"},
+                     "AvailabilityZone": "eu-central-1a", "SystemStatus": {"Status": "ok"}}
+                    for id_ in sorted(self.running) if InstanceIds is None or id_ in InstanceIds]
+
+        def terminate_instances(self, InstanceIds):
+            self.calls.append(("terminate_instances", InstanceIds))
+
+        def describe_volumes(self, Filters):
+            return [{"VolumeId": "vol-1"}]
+
+        def describe_images(self, Owners):
+            return {"Images": [{"ImageId": "ami-1"}]}
+
+        def describe_snapshots(self, OwnerIds):
+            return [{"SnapshotId": "snap-1", "Description": "ami-1"}, {"SnapshotId": "snap-2", "Description": "ami-2"}]
+
+        def delete_volume(self, VolumeId):
+            self.calls.append(("delete_volume", VolumeId))
+
+        def delete_snapshot(self, SnapshotId):
+            self.calls.append(("delete_snapshot", SnapshotId))
+
+    def getSite(self, client):
+        from SiteAdapter.Ec2SiteAdapter import Ec2SiteAdapter
+
+        site = Ec2SiteAdapter()
+        site.getEc2Client = lambda region=None: client
+        site.setConfig(Ec2SiteAdapter.configInstanceTag, "roced=ec2-site")
+        site.setConfig(Ec2SiteAdapter.configServiceIDs, "i-squid")
+        return site
+
+    def test_getEC2Machines(self):
+        client = self.FakeEc2Client({"i-1": {"roced": "ec2-site"}, "i-2": {"roced": "ec2-site"},
+                                     "i-3": {"roced": "ec2-site"}, "i-other": {}, "i-squid": {}},
+                                    running=["i-1", "i-3", "i-other", "i-squid"])
+        site = self.getSite(client)
+
+        status, machines = site.getEC2Machines()
+        self.assertEqual(sorted(machines), ["i-1", "i-2", "i-3", "i-squid"])
+        self.assertEqual(sorted(status), ["i-1", "i-3", "i-squid"])
+        self.assertEqual(status["i-1"]["InstanceStatus"]["Status"], "ok")
+        self.assertEqual(client.calls[0], ("describe_instances",
+                                           {"Filters": [{"Name": "tag:roced", "Values": ["ec2-site"]}]}))
+
+        # service machines only
+        status, machines = site.getEC2Machines(instance_ids=site.serviceIDs)
+        self.assertEqual((list(status), machines), (["i-squid"], ["i-squid"]))
+
+    def test_terminateEC2Machine(self):
+        from SiteAdapter.Ec2SiteAdapter import Ec2SiteAdapter
+
+        client = self.FakeEc2Client({}, running=[])
+        site = self.getSite(client)
+        site.batchSize = 2
+
+        mids = []
+        for i in range(3):
+            mid = site.mr.newMachine()
+            site.mr.machines[mid][site.reg_site_server_id] = "i-%d" % i
+            mids.append(mid)
+
+        site.terminateEC2Machine(Ec2SiteAdapter.terminate, mids)
+        self.assertEqual(client.calls, [("terminate_instances", ["i-0", "i-1"]), ("terminate_instances", ["i-2"])])
+        for mid in mids:
+            site.mr.removeMachine(mid)
+
+    def test_cleanup(self):
+        from SiteAdapter.Ec2SiteAdapter import Ec2SiteAdapter
+
+        client = self.FakeEc2Client({}, running=[])
+        site = self.getSite(client)
+        site.setConfig(Ec2SiteAdapter.configMachines, {"ec2": None})
+        site.setConfig(Ec2SiteAdapter.configOwnerID, "123")
+        site.setConfig(Ec2SiteAdapter.configCleanupInterval, 3600)
+        site.init()
+
+        # once per interval, in the background
+        site.scheduleCleanup()
+        site.scheduleCleanup()
+        site.shutdown()
+        self.assertEqual([call for call in client.calls if call[0].startswith("delete")],
+                         [("delete_volume", "vol-1"), ("delete_snapshot", "snap-2")])
+        # no cleanup after shutdown
+        site.scheduleCleanup()
+
+
+class OpenStackSiteAdapterTest(ScaleTest.ScaleTestBase):
+    class FakeNova(object):
+        """Stand-in for the nova client. The last unlisted servers of a create request are not listed until they are
+        shown, stop/delete requests wait for release."""
+
+        class Server(object):
+            def __init__(self, name):
+                self.id = "id-" + name
+                self.name = name
+                self.status = "BUILD"
+
+        def __init__(self):
+            self.servers = self
+            self.vms = {}
+            self.unlisted = 0
+            self.hidden = set()
+            self.calls = []
+            self.release = threading.Event()
+            self.release.set()
+
+        def create(self, name, image, flavor, min_count=1, max_count=1, **kwargs):
+            names = [name] if max_count == 1 else ["%s-%d" % (name, n + 1) for n in range(max_count)]
+            for name_ in names:
+                self.vms[name_] = self.Server(name_)
+            self.hidden.update(names[len(names) - self.unlisted:])
+
+        def list(self, search_opts=None, detailed=True):
+            prefix = (search_opts or {}).get("name", "^")[1:]
+            return [vm for name, vm in sorted(self.vms.items()) if name.startswith(prefix) and name not in self.hidden]
+
+        def stop(self, server_id):
+            self.release.wait()
+            self.calls.append(("stop", server_id))
+
+        def delete(self, server_id):
+            self.release.wait()
+            self.calls.append(("delete", server_id))
+            self.vms = {name: vm for name, vm in self.vms.items() if vm.id != server_id}
+
+    def test_bulkCreate(self):
+        from SiteAdapter.OpenStackSiteAdapter import OpenStackSiteAdapter
+
+        nova = self.FakeNova()
+        site = OpenStackSiteAdapter()
+        site._OpenStackSiteAdapter__getNovaApi = lambda admin_access=False: nova
+        config = configparser.RawConfigParser()
+        config.add_section("openstack")
+        site.loadConfigValue(site.optionalConfigKeys, config, True, "openstack", site)
+        site.setConfig(OpenStackSiteAdapter.ConfigSiteName, "openstack")
+        site.setConfig(OpenStackSiteAdapter.configMachines, {"vm": None})
+        site.init()
+        mr = site.mr
+        try:
+            # one server is not listed right after the create request, it's still counted
+            nova.unlisted = 1
+            self.assertEqual(site.spawnMachines("vm", 3), 3)
+            self.assertEqual(len(mr.getMachines("openstack")), 2)
+
+            # ... and added by the next manage
+            nova.hidden.clear()
+            site.manage()
+            self.assertEqual([machine[mr.regStatus] for machine in mr.getMachines("openstack").values()],
+                             [mr.statusBooting] * 3)
+
+            for vm in nova.vms.values():
+                vm.status = "ACTIVE"
+            site.manage()
+            mid = sorted(mr.getMachines("openstack"))[0]
+            self.assertEqual(mr.machines[mid][mr.regStatus], mr.statusUp)
+
+            # pending stop request: not sent again
+            nova.release.clear()
+            mr.updateMachineStatus(mid, mr.statusDisintegrating)
+            site.manage()
+            self.assertEqual(mr.machines[mid][mr.regStatus], mr.statusDisintegrating)
+            nova.release.set()
+            while site._OpenStackSiteAdapter__teardownPending(mid):
+                time.sleep(0.01)
+            self.assertEqual(nova.calls, [("stop", "id-" + mid)])
+
+            # pending delete request: the machine is neither removed nor added again
+            nova.vms[mid].status = "SHUTOFF"
+            nova.release.clear()
+            site.manage()
+            self.assertEqual(mr.machines[mid][mr.regStatus], mr.statusDown)
+            site.manage()
+            self.assertEqual(mr.machines[mid][mr.regStatus], mr.statusDown)
+            nova.release.set()
+            site.shutdown()
+            site.manage()
+            self.assertFalse(mid in mr.machines)
+            self.assertEqual([call for call in nova.calls if call[0] == "delete"], [("delete", "id-" + mid)])
+            self.assertEqual(len(mr.getMachines("openstack")), 2)
+        finally:
+            nova.release.set()
+            site.shutdown()
+            mr.clear()
+
+
+class FreiburgSiteAdapterTest(ScaleTest.ScaleTestBase):
+    def setUp(self):
+        super(FreiburgSiteAdapterTest, self).setUp()
+        if sys.version_info[0] > 2:
+            self.skipTest("FreiburgSiteAdapter is python 2 only")
+
+    def test_flushTerminationQueue(self):
+        from SiteAdapter.FreiburgSiteAdapter import FreiburgSiteAdapter
+
+        site = FreiburgSiteAdapter()
+        site.logger = logging.getLogger("FRSite")
+        site.setConfig(FreiburgSiteAdapter.ConfigSiteName, "freiburg")
+        site.setConfig(FreiburgSiteAdapter.configDrainCommand, "drain %s")
+        commands = []
+
+        def execCmd(cmd, timeout=60):
+            commands.append(cmd)
+            # 13 (cancel) and 16 (drain) have no result, e.g. the connection dropped
+            return 255, "cancel 10 0\ncancel 11 1\ncancel 12 2\ncancel 14 2\ndrain 15 0\n", "error"
+
+        site._FreiburgSiteAdapter__execCmdInFreiburg = execCmd
+
+        statuses = {"10": site.mr.statusBooting, "11": site.mr.statusBooting, "12": site.mr.statusDisintegrated,
+                    "13": site.mr.statusBooting, "14": site.mr.statusBooting, "15": site.mr.statusWorking,
+                    "16": site.mr.statusWorking}
+        mids = {}
+        try:
+            for batchJobId, status in sorted(statuses.items()):
+                mid = site.mr.newMachine()
+                site.mr.machines[mid][site.mr.regSite] = "freiburg"
+                site.mr.machines[mid][site.regMachineJobId] = batchJobId
+                site.mr.updateMachineStatus(mid, status)
+                mids[batchJobId] = mid
+            site._FreiburgSiteAdapter__queueCancel(["10", "11", "12", "13", "14"])
+            site._FreiburgSiteAdapter__queueDrain(["15", "16"])
+
+            site.flushTerminationQueue()
+            self.assertEqual(commands[0].count("mjobctl -c"), 5)
+            self.assertTrue("drain 15 >/dev/null; echo drain 15 $?" in commands[0])
+            status = {batchJobId: site.mr.machines[mid][site.mr.regStatus] for batchJobId, mid in mids.items()}
+            # rc 0 and 1 -> down, rc > 1 -> down only if already disintegrated
+            self.assertEqual((status["10"], status["11"], status["12"]), (site.mr.statusDown,) * 3)
+            self.assertEqual(status["14"], site.mr.statusBooting)
+            self.assertEqual(status["15"], site.mr.statusPendingDisintegration)
+            # no result -> unchanged and queued again
+            self.assertEqual((status["13"], status["16"]), (site.mr.statusBooting, site.mr.statusWorking))
+
+            site.flushTerminationQueue()
+            self.assertEqual(commands[1], "mjobctl -c 13 >/dev/null; echo cancel 13 $?; "
+                                          "drain 16 >/dev/null; echo drain 16 $?")
+        finally:
+            site.mr.clear()
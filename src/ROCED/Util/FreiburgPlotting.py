@@ -22,7 +22,6 @@
 from __future__ import print_function, division
 
 import argparse
-import json
 import matplotlib
 import matplotlib.dates as mdates
 import matplotlib.gridspec as mgridspec
@@ -34,6 +33,7 @@ from os import path
 
 import numpy as np
 
+from Logging import JsonLog
 from Rrd import Rrd
 
 
@@ -175,8 +175,7 @@ class FrPlotting(object):
                 print("Skipping %s (unknown format)" % input_file)
                 continue
 
-            with open(input_file, "r") as json_file:
-                logs.update(json.load(json_file))
+            logs.update(JsonLog.readLog(input_file))
         ###
         # RRD Processing
         ###
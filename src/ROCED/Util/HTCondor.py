@@ -24,9 +24,9 @@ try:
     import htcondor
 except ImportError:
     # This packet is optional and only available on python 2.7
-    pass
+    htcondor = None
 import logging
-import re
+import threading
 import time
 import types
 from collections import defaultdict
@@ -46,55 +46,95 @@ class HTCondorPy(object):
     __q_requirement_string = "RoutedToJobId =?= undefined && ( JobStatus == %d || JobStatus == %d )" % (
                               jobStatusIdle, jobStatusRunning)
 
+    # shared instances (one per collector address), see get()
+    instances = {}
+    __instancesLock = threading.Lock()
+    # seconds until the list of schedds is queried again from the collector
+    scheddUpdateInterval = 300
+
     def __init__(self, collector=None):
         """Helper class to query HTCondor via python bindings."""
         if collector is None:
             self.collector = htcondor.Collector()
         else:
-            self.collector = htcondor.Collector(collector)
+            self.collector = htcondor.Collector(str(collector))
         """Central collector."""
-        self.schedds = [htcondor.Schedd(classAd) for classAd in self.collector.query(htcondor.AdTypes.Schedd)]
+        self.schedds = []
         """List of schedd objects, retrieved from collector."""
+        self.__scheddUpdate = 0
+        # queries of background refresh threads share this instance, see get()
+        self.__scheddLock = threading.Lock()
+        self.updateSchedds(force=True)
+
+    @classmethod
+    def get(cls, collector=None):
+        # type: (str) -> HTCondorPy
+        """Return the shared instance for a collector, reusing collector and schedd objects across queries."""
+        with cls.__instancesLock:
+            if collector not in cls.instances:
+                cls.instances[collector] = cls(collector)
+            return cls.instances[collector]
+
+    def updateSchedds(self, force=False):
+        # type: (bool) -> List[htcondor.Schedd]
+        """Query the schedds from the collector, at most once per scheddUpdateInterval unless forced.
+
+        :return: current list of schedds
+        """
+        with self.__scheddLock:
+            if force is True or time.time() > self.__scheddUpdate + self.scheddUpdateInterval:
+                self.schedds = [htcondor.Schedd(classAd) for classAd in self.collector.query(htcondor.AdTypes.Schedd)]
+                self.__scheddUpdate = time.time()
+            return self.schedds
 
     def status(self, constraint=True):
         # type: Union[bool, str] -> defaultdict
-        """Return condor machine status (CLI condor_status)."""
+        """Return condor machine status (CLI condor_status).
+
+        Format: {machine name: [[state, activity], [state, activity], ..]}, machine name without domain
+        """
         condor_machines = defaultdict(list)
         result = self.collector.query(ad_type=htcondor.AdTypes.Startd,
-                                      projection=["Name", "State", "Activity"],
-                                      constraint=constraint)
-
-        regex = re.compile("slot[\d_]+@([\w-]+).+")
+                                      projection=["Machine", "State", "Activity"],
+                                      constraint=str(constraint))
 
         for slot in result:
-            condor_machines[regex.search(slot["Name"]).group(1)].append([slot["State"], slot["Activity"]])
+            condor_machines[slot["Machine"].split(".")[0]].append([slot["State"], slot["Activity"]])
 
         return condor_machines
 
+    def jobs(self, constraint=True, projection=("ClusterId", "ProcId", "RequestCpus", "JobStatus")):
+        # type: (Union[bool, str], Iterable[str]) -> Iterator[htcondor.ClassAd]
+        """Iterate over running and idle jobs of all schedds (CLI condor_q -global).
+
+        The schedds are queried in parallel and only the projected attributes are transferred.
+        """
+        queries = [schedd.xquery(requirements=str("%s && ( %s )" % (self.__q_requirement_string, constraint)),
+                                 projection=[str(attribute) for attribute in projection])
+                   for schedd in self.updateSchedds()]
+
+        for query in htcondor.poll(queries):
+            for ads in query.nextAdsNonBlocking():
+                yield ads
+
     def q(self, constraint=True):
         # type: Union[bool, str] -> defaultdict
         """Return list of running and idle condor jobs (CLI condor_q)."""
         condor_q = defaultdict(list)
-        queries = [schedd.xquery(requirements="%s && %s" % (self.__q_requirement_string, constraint),
-                                 projection=["ClusterId", "ProcId", "RequestCpus", "JobStatus"])
-                   for schedd in self.schedds]
 
-        for query in htcondor.poll(queries):
-            for ads in query.nextAdsNonBlocking():
-                key = "%s.%s" % (ads.get("ClusterId"), ads.get("ProcId"))
-                condor_q[key].append(int(ads.get("RequestCpus")))
-                condor_q[key].append(int(ads.get("JobStatus")))
+        for ads in self.jobs(constraint):
+            key = "%s.%s" % (ads.get("ClusterId"), ads.get("ProcId"))
+            condor_q[key].append(int(ads.get("RequestCpus")))
+            condor_q[key].append(int(ads.get("JobStatus")))
 
         return condor_q
 
 
 class CondorPyTest(ScaleTest.ScaleTestBase):
     def setUp(self):
-        try:
-            isinstance(htcondor, types.ModuleType)
-        except NameError:
+        if not isinstance(htcondor, types.ModuleType):
             self.skipTest("htcondor module missing")
-        self.condor = HTCondorPy()
+        self.condor = HTCondorPy.get()
 
     def test_CondorStatus(self):
         logging.debug("===Condor Status (Python)===")
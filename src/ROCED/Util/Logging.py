@@ -22,12 +22,20 @@
 from __future__ import print_function, unicode_literals, absolute_import
 
 import csv
+import glob
 import json
 import logging
 import os
 import shutil
 import sys
+import threading
 import time
+from collections import deque
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 from datetime import datetime
 
 PY3 = sys.version_info > (3,)
@@ -36,11 +44,134 @@ PY3 = sys.version_info > (3,)
 # TODO: Use config file "logfolder"
 
 
+class MachineRegistryJournal(object):
+    def __init__(self, prefix, default=None, object_hook=None):
+        # type: (str, Callable, Callable) -> None
+        """Append-only (write-ahead) journal of machine registry changes, stored as JSON lines.
+
+        The journal is split into numbered segment files (prefix.1, prefix.2, ...). A snapshot covers all segments
+        before a certain number, so older segments can be deleted after a snapshot was written.
+
+        Records:
+        {"op": "new", "mid": id, "machine": {..}}
+        {"op": "update", "mid": id, "set": {key: value, ..}, "append": {key: value, ..}, "delete": [key, ..]}
+        {"op": "remove", "mid": id}
+        """
+        self.__prefix = prefix
+        self.__default = default
+        self.__objectHook = object_hook
+        self.__lock = threading.Lock()
+        self.__file = None
+        segments = self.segments()
+        self.__segment = segments[-1] + 1 if segments else 1
+
+    @property
+    def segment(self):
+        """Number of the segment currently written to."""
+        return self.__segment
+
+    def segments(self):
+        # type: () -> List[int]
+        """Numbers of all existing segment files, in ascending order."""
+        numbers = []
+        for fileName in glob.glob("%s.*" % self.__prefix):
+            try:
+                numbers.append(int(fileName.rsplit(".", 1)[1]))
+            except ValueError:
+                pass
+        return sorted(numbers)
+
+    def append(self, record):
+        # type: (dict) -> None
+        with self.__lock:
+            try:
+                if self.__file is None:
+                    self.__file = open("%s.%d" % (self.__prefix, self.__segment), "a")
+                self.__file.write(json.dumps(record, default=self.__default) + "\n")
+                self.__file.flush()
+            except IOError:
+                logging.error("Machine registry journal could not be written!")
+
+    def rotate(self):
+        # type: () -> int
+        """Continue with a new segment. Returns the new segment number."""
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+            self.__segment += 1
+            return self.__segment
+
+    def close(self):
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+
+    def removeSegments(self, below):
+        # type: (int) -> None
+        for number in self.segments():
+            if number < below:
+                try:
+                    os.remove("%s.%d" % (self.__prefix, number))
+                except OSError:
+                    logging.warning("Journal segment %s.%d could not be removed." % (self.__prefix, number))
+
+    def replay(self, state, firstSegment=0):
+        # type: (dict, int) -> dict
+        """Apply all records of the segments >= firstSegment to state {mid: machine}."""
+        nRecords = 0
+        for number in self.segments():
+            if number < firstSegment:
+                continue
+            with open("%s.%d" % (self.__prefix, number), "r") as file_:
+                for line in file_:
+                    try:
+                        record = json.loads(line, object_hook=self.__objectHook)
+                    except ValueError:
+                        # Incomplete last line, e.g. after a crash.
+                        logging.warning("Skipping invalid journal record in segment %d." % number)
+                        continue
+                    self.applyRecord(state, record)
+                    nRecords += 1
+        logging.info("Replayed %d machine registry journal records." % nRecords)
+        return state
+
+    @staticmethod
+    def applyRecord(state, record):
+        # type: (dict, dict) -> None
+        if record["op"] == "new":
+            state[record["mid"]] = record.get("machine", {})
+        elif record["op"] == "remove":
+            state.pop(record["mid"], None)
+        elif record["op"] == "update" and record["mid"] in state:
+            machine = state[record["mid"]]
+            machine.update(record.get("set", {}))
+            for key, value in record.get("append", {}).items():
+                machine.setdefault(key, []).append(value)
+            for key in record.get("delete", []):
+                machine.pop(key, None)
+
+
 class MachineRegistryLogger(object):
-    """Save/load machine registry to/from JSON file."""
+    """Save/load machine registry to/from JSON file.
+
+    In journal mode, every change is appended to a journal (see MachineRegistryJournal). Only every
+    "snapshotInterval" dumps a compacted snapshot is written, in a background thread.
+    """
     __logger = logging.getLogger("Core")
     __filename = "log/machine_registry.json"
     __backup_file = "log/old_machine_registry.json"
+    __snapshot_file = "log/machine_registry_snapshot.json"
+    __journal_prefix = "log/machine_registry.journal"
+
+    # dump the status change history of the machines in the old format (list of dictionaries with strings)
+    legacyHistory = False
+
+    __journal = None
+    __snapshotInterval = 1
+    __nDumps = 0
+    __snapshotThread = None
 
     @staticmethod
     def __toJson(python_object):
@@ -50,6 +181,14 @@ class MachineRegistryLogger(object):
                     "__value__": python_object.strftime("%Y-%m-%d %H:%M:%S:%f")}
         elif isinstance(python_object, bytes) is True:
             return python_object.decode()
+        elif isinstance(python_object, Mapping) is True:
+            # MachineRegistry.MachineRecord
+            return dict(python_object.items())
+        elif isinstance(python_object, deque) is True:
+            # MachineRegistry.StatusHistory
+            if MachineRegistryLogger.legacyHistory is True and hasattr(python_object, "export"):
+                return python_object.export()
+            return list(python_object)
         raise TypeError("%s is not JSON serializable" % repr(python_object))
 
     @staticmethod
@@ -62,10 +201,50 @@ class MachineRegistryLogger(object):
                 raise NotImplementedError("Unknown class type %s can not be serialized" % json_object["__class__"])
         return json_object
 
+    @classmethod
+    def enableJournal(cls, snapshotInterval=60):
+        # type: (int) -> MachineRegistryJournal
+        """Switch to journal mode. Returns the journal, which has to be attached to the machine registry (after
+        loading the previous state)."""
+        if os.path.isdir(os.path.dirname(cls.__journal_prefix)) is False:
+            try:
+                os.makedirs(os.path.dirname(cls.__journal_prefix))
+            except OSError:
+                cls.__logger.error("Error when creating %s folder" % os.path.dirname(cls.__journal_prefix))
+        cls.__journal = MachineRegistryJournal(cls.__journal_prefix, default=cls.__toJson,
+                                               object_hook=cls.__fromJson)
+        cls.__snapshotInterval = max(1, snapshotInterval)
+        cls.__nDumps = 0
+        return cls.__journal
+
+    @classmethod
+    def disableJournal(cls):
+        """Leave journal mode (after writing pending snapshots)."""
+        cls.waitForSnapshot()
+        if cls.__journal is not None:
+            cls.__journal.close()
+        cls.__journal = None
+
+    @classmethod
+    def waitForSnapshot(cls):
+        """Block until a snapshot being written in background is complete."""
+        if cls.__snapshotThread is not None:
+            cls.__snapshotThread.join()
+
     @classmethod
     def dump(cls, machineRegistry):
         # type: (dict) -> None
-        """Dump machine registry to JSON file."""
+        """Dump machine registry to JSON file.
+
+        In journal mode, the state is already persisted. Every "snapshotInterval" calls, a snapshot is written and
+        the journal is compacted. The caller has to make sure the registry doesn't change during this call.
+        """
+        if cls.__journal is not None:
+            cls.__nDumps += 1
+            if cls.__nDumps % cls.__snapshotInterval == 0:
+                cls.__writeSnapshot(machineRegistry)
+            return
+
         try:
             shutil.move(cls.__filename, cls.__backup_file)
         except IOError:
@@ -77,13 +256,54 @@ class MachineRegistryLogger(object):
         except IOError:
             cls.__logger.error("JSON file could not be opened for dumping state!")
 
+    @classmethod
+    def __writeSnapshot(cls, machineRegistry):
+        if cls.__snapshotThread is not None and cls.__snapshotThread.is_alive():
+            cls.__logger.warning("Previous machine registry snapshot is still being written. Skipping.")
+            return
+
+        # Copy (lists are the only values changed in place) & start a new journal segment, then write in background.
+        state = {mid: {key: list(value) if isinstance(value, (list, deque)) else value
+                       for key, value in machine.items()}
+                 for mid, machine in machineRegistry.items()}
+        segment = cls.__journal.rotate()
+
+        def write():
+            try:
+                with open(cls.__snapshot_file + ".tmp", "w") as file_:
+                    json.dump({"segment": segment, "machines": state}, file_, default=cls.__toJson)
+                    file_.flush()
+                    os.fsync(file_.fileno())
+                # atomic replacement: a crash never leaves a partially written snapshot
+                os.rename(cls.__snapshot_file + ".tmp", cls.__snapshot_file)
+                cls.__journal.removeSegments(below=segment)
+            except (IOError, OSError):
+                cls.__logger.error("Machine registry snapshot could not be written!")
+
+        cls.__snapshotThread = threading.Thread(target=write, name="RegistrySnapshot")
+        cls.__snapshotThread.start()
+
     @classmethod
     def load(cls):
         # type: () -> dict
         """Load machine registry from JSON file.
 
-        Will fall back on backup file, if an error occurs.
+        Will fall back on backup file, if an error occurs. In journal mode, the latest snapshot (if there is none:
+        the regular JSON file) plus all following journal records are loaded.
         """
+        if cls.__journal is not None:
+            try:
+                with open(cls.__snapshot_file, "r") as file_:
+                    snapshot = json.load(file_, object_hook=cls.__fromJson)
+                cls.__logger.info("Previous snapshot loaded!")
+                return cls.__journal.replay(snapshot["machines"], snapshot["segment"])
+            except (IOError, ValueError, KeyError):
+                cls.__logger.warning("Snapshot could not be opened for loading state! Trying JSON file.")
+                return cls.__journal.replay(cls.__load())
+        return cls.__load()
+
+    @classmethod
+    def __load(cls):
         try:
             with open(cls.__filename, "r") as file_:
                 state = json.load(file_, object_hook=cls.__fromJson)
@@ -106,6 +326,14 @@ class JsonLog(object):
     # use class variables to share log among instances
     __jsonLog = {}
     __fileName = ""
+    # JSON-lines mode: append one line per management cycle instead of rewriting the whole file
+    __jsonLines = False
+    __maxBytes = 0
+    __dir = "log"
+    __prefix = "monitoring"
+    __suffix = ""
+    __linesDate = ""
+    __linesPart = 0
 
     @classmethod
     def __init__(cls, dir_="log", prefix="monitoring", suffix=""):
@@ -120,6 +348,7 @@ class JsonLog(object):
         if not cls.__fileName:
             cls.__fileName = ("%s/%s_%s%s.json"
                               % (dir_, prefix, datetime.today().strftime("%Y-%m-%d"), suffix))
+            cls.__dir, cls.__prefix, cls.__suffix = dir_, prefix, suffix
 
     @classmethod
     def __enter__(cls):
@@ -131,6 +360,19 @@ class JsonLog(object):
         # Raise exception(s) that appear along the way
         return False
 
+    @classmethod
+    def enableJsonLines(cls, maxBytes=0):
+        """Append one JSON object per line and cycle (*.jsonl) instead of rewriting the daily JSON file.
+
+        Files are rotated daily and, if maxBytes > 0, whenever a file exceeds maxBytes.
+        """
+        cls.__jsonLines = True
+        cls.__maxBytes = maxBytes
+
+    @classmethod
+    def disableJsonLines(cls):
+        cls.__jsonLines = False
+
     @classmethod
     def addItem(cls, site, key, value):
         if site not in cls.__jsonLog:
@@ -140,6 +382,11 @@ class JsonLog(object):
     @classmethod
     def writeLog(cls):
         """Write current log into JSON file."""
+        if cls.__jsonLines is True:
+            cls.__writeJsonLines()
+            cls.__jsonLog = {}
+            return
+
         oldLog = {}
         if os.path.isfile(cls.__fileName):
             try:
@@ -164,6 +411,56 @@ class JsonLog(object):
         # clear jsonLog for next cycle
         cls.__jsonLog = {}
 
+    @classmethod
+    def __jsonLinesFileName(cls):
+        """Current JSON-lines file, rotated by date and size.
+
+        Format: <dir>/<prefix>_<date><suffix>[.<part>].jsonl
+        """
+        date = datetime.today().strftime("%Y-%m-%d")
+        if date != cls.__linesDate:
+            cls.__linesDate = date
+            cls.__linesPart = 0
+
+        while True:
+            part = ".%d" % cls.__linesPart if cls.__linesPart > 0 else ""
+            fileName = "%s/%s_%s%s%s.jsonl" % (cls.__dir, cls.__prefix, date, cls.__suffix, part)
+            if cls.__maxBytes <= 0 or not os.path.isfile(fileName) or \
+                    os.path.getsize(fileName) < cls.__maxBytes:
+                return fileName
+            cls.__linesPart += 1
+
+    @classmethod
+    def __writeJsonLines(cls):
+        try:
+            with open(cls.__jsonLinesFileName(), "a") as jsonFile:
+                jsonFile.write(json.dumps({int(time.time()): cls.__jsonLog}) + "\n")
+        except IOError:
+            logging.error("JSON file could not be opened for logging!")
+
+    @staticmethod
+    def readLog(fileName):
+        """Iterate over the management cycles stored in a monitoring log.
+
+        JSON-lines files (*.jsonl) are streamed line by line, regular JSON files are loaded at once.
+        Lines which can not be parsed (e.g. the last line of a log that is still written) are skipped.
+
+        :param fileName: path of a *.json or *.jsonl monitoring log
+        :return: generator of (timestamp, {site/machine type: {key: value}})
+        """
+        with open(fileName, "r") as jsonFile:
+            if fileName.endswith(".jsonl"):
+                for line in jsonFile:
+                    try:
+                        cycle = json.loads(line)
+                    except ValueError:
+                        continue
+                    for timestamp, entry in cycle.items():
+                        yield timestamp, entry
+            else:
+                for timestamp, entry in json.load(jsonFile).items():
+                    yield timestamp, entry
+
     @classmethod
     def printLog(cls):
         """Print log to output device.
@@ -280,34 +577,72 @@ class UnicodeWriter(object):
         self.writer.writerow(dictrow)
 
 
-class CsvStats(object):
-    __csvStats = []
-    # [{"site":"site_name", "mid":"machine_id", "old_status":"old status",
-    #   "new_status":"new status", "timestamp":"date.date.now()",
-    #   "time_diff":"datetime.timediff()"},{},{},...]
-    __fileName = ""
-    __fieldnames = ["site", "mid", "old_status", "new_status", "timestamp", "time_diff"]
+class CsvStatsSink(object):
+    fieldnames = ["site", "mid", "old_status", "new_status", "timestamp", "time_diff"]
 
-    @classmethod
-    def __init__(cls, dir_="log", prefix="stats", suffix=""):
-        """CSV statistics, logging Machine Registry timing information."""
-        # Existence check for log folder [log file creation requires existing folder]
+    def __init__(self, dir_="log", prefix="stats", suffix=""):
+        """Write statistics records to a daily CSV file."""
         if os.path.isdir(dir_) is False:
             try:
                 os.makedirs("%s/" % dir_)
             except OSError:
                 logging.error("Error when creating %s folder" % dir_)
-        if not cls.__fileName:
-            cls.__fileName = ("%s/%s_%s%s.csv"
-                              % (dir_, prefix, datetime.today().strftime("%Y-%m-%d"), suffix))
+        self.fileName = "%s/%s_%s%s.csv" % (dir_, prefix, datetime.today().strftime("%Y-%m-%d"), suffix)
 
         # Existence check for log file
-        if not os.path.isfile(cls.__fileName):
-            # with open(cls.__fileName, "w", newline="") as stats_file:
-            #     writer = UnicodeWriter(stats_file, fieldnames=cls.__fieldnames)
-            with UnicodeWriter(cls.__fileName, fieldnames=cls.__fieldnames) as writer:
+        if not os.path.isfile(self.fileName):
+            with UnicodeWriter(self.fileName, fieldnames=self.fieldnames) as writer:
                 writer.writeheader()
 
+    def write(self, records):
+        with UnicodeWriter(self.fileName, fieldnames=self.fieldnames) as writer:
+            for record in records:
+                writer.writerow(record)
+
+
+class JsonLinesStatsSink(object):
+    def __init__(self, dir_="log", prefix="stats", suffix=""):
+        """Write statistics records to a daily JSON-lines file, one record per line."""
+        if os.path.isdir(dir_) is False:
+            try:
+                os.makedirs("%s/" % dir_)
+            except OSError:
+                logging.error("Error when creating %s folder" % dir_)
+        self.fileName = "%s/%s_%s%s.jsonl" % (dir_, prefix, datetime.today().strftime("%Y-%m-%d"), suffix)
+
+    def write(self, records):
+        with open(self.fileName, "a") as statsFile:
+            for record in records:
+                statsFile.write(json.dumps(record) + "\n")
+
+
+class MemoryStatsSink(object):
+    def __init__(self, maxItems=1000):
+        """Keep the last maxItems statistics records in memory (e.g. for tests)."""
+        self.records = deque(maxlen=maxItems)
+
+    def write(self, records):
+        self.records.extend(records)
+
+
+class CsvStats(object):
+    __csvStats = []
+    # [{"site":"site_name", "mid":"machine_id", "old_status":"old status",
+    #   "new_status":"new status", "timestamp":"date.date.now()",
+    #   "time_diff":"datetime.timediff()"},{},{},...]
+    __sink = None
+    # records are buffered and written once per management cycle or if one of the limits is reached
+    __maxItems = 1000
+    __flushInterval = 60
+    __lastFlush = time.time()
+    __lock = threading.RLock()
+
+    @classmethod
+    def __init__(cls, dir_="log", prefix="stats", suffix=""):
+        """CSV statistics, logging Machine Registry timing information."""
+        if cls.__sink is None:
+            cls.__sink = CsvStatsSink(dir_, prefix, suffix)
+
     @classmethod
     def __enter__(cls):
         return cls
@@ -318,19 +653,51 @@ class CsvStats(object):
         # Throw exception, if a problem occurred
         return False
 
+    @classmethod
+    def setSink(cls, sink):
+        """Replace the output of the statistics, e.g. CsvStatsSink, JsonLinesStatsSink or MemoryStatsSink.
+
+        :param sink: object providing write(records); None restores the CSV default
+        """
+        with cls.__lock:
+            cls.write_stats()
+            cls.__sink = sink
+
+    @classmethod
+    def setLimits(cls, maxItems=None, flushInterval=None):
+        """Write buffered records once maxItems are collected or the last write is older than flushInterval seconds.
+
+        Independent of the limits, ScaleCore writes the statistics once per management cycle.
+        """
+        if maxItems is not None:
+            cls.__maxItems = maxItems
+        if flushInterval is not None:
+            cls.__flushInterval = flushInterval
+
     @classmethod
     def add_item(cls, site, mid, old_status, new_status, timestamp, time_diff):
-        cls.__csvStats.append(
-            {"site": site, "mid": mid, "old_status": old_status, "new_status": new_status,
-             "timestamp": timestamp, "time_diff": time_diff})
+        with cls.__lock:
+            cls.__csvStats.append(
+                {"site": site, "mid": mid, "old_status": old_status, "new_status": new_status,
+                 "timestamp": timestamp, "time_diff": time_diff})
+            if (len(cls.__csvStats) >= cls.__maxItems or
+                    time.time() - cls.__lastFlush >= cls.__flushInterval):
+                cls.write_stats()
 
     @classmethod
     def write_stats(cls):
-        with UnicodeWriter(cls.__fileName, fieldnames=cls.__fieldnames) as writer:
-            # with open(cls.__fileName, "a") as stats_file:
-            #     writer = UnicodeWriter(stats_file, fieldnames=cls.__fieldnames)
-            for stat in range(len(cls.__csvStats)):
-                writer.writerow(cls.__csvStats.pop())
+        """Write all buffered records to the sink."""
+        with cls.__lock:
+            cls.__lastFlush = time.time()
+            if not cls.__csvStats or cls.__sink is None:
+                return
+            try:
+                cls.__sink.write(cls.__csvStats)
+                cls.__csvStats = []
+            except (IOError, OSError) as err:
+                # keep the buffer bounded, drop the oldest records
+                del cls.__csvStats[:-cls.__maxItems]
+                logging.error("Statistics could not be written: %s" % err)
 
     @classmethod
     def printLog(cls):
@@ -0,0 +1,256 @@
+# ===============================================================================
+#
+# Copyright (c) 2010-2016
+# by Frank Fischer, Georg Fleig, Thomas Hauth and Stephan Riedel
+#
+# This file is part of ROCED.
+#
+# ROCED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ROCED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ROCED.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ===============================================================================
+"""Incremental parser for the XML output of the Moab commands checkjob and showq.
+
+Run this module to compare the parser with a minidom based one (as used by the Freiburg site adapter before) on
+recorded output ("checkjob ALL --xml > checkjob.xml") or on generated data:
+
+    python -m Util.Moab checkjob.xml
+    python -m Util.Moab --generate 50000
+"""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import argparse
+import io
+import time
+from collections import namedtuple
+from xml.etree import ElementTree
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2.7
+    tracemalloc = None
+
+from Core import ScaleTest
+
+stateIdle = "Idle"
+stateRunning = "Running"
+stateCompleted = "Completed"
+
+
+class MoabJob(namedtuple("MoabJob", "jobId state startTime wallDuration cores vmIp user completionCode")):
+    """Compact job record, attributes which are not part of the output are None (vmIp: "")."""
+    __slots__ = ()
+
+    def remainingWalltime(self, now):
+        # type: (int) -> Optional[int]
+        """Seconds until the requested walltime of a running job ends, None if start time or walltime are missing."""
+        if self.startTime is None or self.wallDuration is None:
+            return None
+        return self.startTime + self.wallDuration - now
+
+
+def iterJobs(source):
+    # type: (IO[bytes]) -> Iterator[MoabJob]
+    """Parse the output of checkjob/showq --xml incrementally and yield one MoabJob per job element.
+
+    The output is read from the (binary) file object source while it is parsed, elements of jobs already yielded
+    are discarded. Memory usage is therefore independent of the number of jobs.
+    """
+    parents = []
+    for event, elem in ElementTree.iterparse(source, events=("start", "end")):
+        if event == "start":
+            parents.append(elem)
+            continue
+        parents.pop()
+        if elem.tag != "job":
+            continue
+
+        yield _jobRecord(elem)
+
+        elem.clear()
+        if parents:
+            parents[-1].remove(elem)
+
+
+def parseJobs(data):
+    # type: (Union[str, bytes]) -> List[MoabJob]
+    """Parse complete (already received) output, see iterJobs."""
+    if not isinstance(data, bytes):
+        data = data.encode("utf-8")
+    return list(iterJobs(io.BytesIO(data)))
+
+
+def _jobRecord(elem):
+    # type: (ElementTree.Element) -> MoabJob
+    attributes = elem.attrib
+    req = elem.find("req")
+    if req is not None and "TPN" in req.attrib:
+        cores = _int(req.get("TPN"))
+    else:
+        # showq
+        cores = _int(attributes.get("ReqProcs"))
+    vmIp = ""
+    for variable in elem.iter("Variable"):
+        if variable.get("name") == "VM_IP":
+            vmIp = (variable.text or "").strip()
+    return MoabJob(jobId=attributes.get("JobID"),
+                   state=attributes.get("State"),
+                   startTime=_int(attributes.get("StartTime")),
+                   wallDuration=_int(attributes.get("ReqAWDuration")),
+                   cores=cores,
+                   vmIp=vmIp,
+                   user=attributes.get("User"),
+                   completionCode=attributes.get("CompletionCode"))
+
+
+def _int(value):
+    return None if value is None else int(value)
+
+
+###
+# Benchmark
+###
+def sampleOutput(jobs, runningFraction=0.5, completed=False):
+    # type: (int, float, bool) -> bytes
+    """Generate checkjob ALL --xml like output with the given number of jobs."""
+    startTime = int(time.time()) - 3600
+    lines = ["<Data>"]
+    for i in range(jobs):
+        if completed is True:
+            state = stateCompleted
+        elif i < jobs * runningFraction:
+            state = stateRunning
+        else:
+            state = stateIdle
+        lines.append(
+            "<job AWDuration=\"3600\" Account=\"roced\" Class=\"express\" CompletionCode=\"%d\" "
+            "EEDuration=\"12\" EffPAL=\"[nemo]\" Flags=\"RESTARTABLE\" Group=\"roced\" JobID=\"%d\" "
+            "PAL=\"[nemo]\" ReqAWDuration=\"86400\" StartTime=\"%d\" State=\"%s\" SubmissionTime=\"%d\" "
+            "User=\"roced\"><req AllocNodeList=\"n%04d\" ReqMem=\"%d\" ReqNodeFeature=\"[vm]\" TPN=\"20\">"
+            "</req><Messages><message>default message</message></Messages>"
+            "<Variables><Variable name=\"VM_IP\">10.0.%d.%d</Variable><Variable name=\"OS\">sl6</Variable>"
+            "</Variables></job>" % (i % 3, 1000000 + i, startTime, state, startTime - 60, i % 1000,
+                                    100000, i // 250, i % 250))
+    lines.append("</Data>")
+    return "\n".join(lines).encode("utf-8")
+
+
+def minidomJobs(data):
+    # type: (bytes) -> List[MoabJob]
+    """Reference implementation with xml.dom.minidom, as used before by the Freiburg site adapter."""
+    from xml.dom import minidom
+
+    jobs = []
+    for line in minidom.parseString(data).getElementsByTagName("job"):
+        req = line.getElementsByTagName("req")
+        vmIp = ""
+        for v in line.getElementsByTagName("Variable"):
+            if v.getAttribute("name") == "VM_IP":
+                vmIp = str(v.childNodes[0].nodeValue)
+        jobs.append(MoabJob(jobId=line.getAttribute("JobID"), state=line.getAttribute("State"),
+                            startTime=_int(line.getAttribute("StartTime") or None),
+                            wallDuration=_int(line.getAttribute("ReqAWDuration") or None),
+                            cores=_int(req[0].getAttribute("TPN") or None) if req else None,
+                            vmIp=vmIp, user=line.getAttribute("User") or None,
+                            completionCode=line.getAttribute("CompletionCode") or None))
+    return jobs
+
+
+def benchmark(data, repeat=3):
+    # type: (bytes, int) -> Dict[str, Tuple[float, Optional[int]]]
+    """Best time (seconds) and peak memory (bytes, python 3 only) of both parsers for the given output."""
+    parsers = (("minidom", minidomJobs),
+               ("iterparse", lambda data_: list(iterJobs(io.BytesIO(data_)))))
+    results = {}
+    reference = None
+    for name, parser in parsers:
+        bestTime = None
+        for _ in range(repeat):
+            startTime = time.time()
+            jobs = parser(data)
+            duration = time.time() - startTime
+            bestTime = duration if bestTime is None else min(bestTime, duration)
+        peakMemory = None
+        if tracemalloc is not None:
+            # separate run, tracing slows down the parsers considerably
+            tracemalloc.start()
+            parser(data)
+            peakMemory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        if reference is None:
+            reference = jobs
+        elif jobs != reference:
+            raise ValueError("Parser %s returned a different result." % name)
+        results[name] = (bestTime, peakMemory)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark parsers of Moab XML output.")
+    parser.add_argument("input_files", nargs="*", help="recorded output of checkjob ALL --xml")
+    parser.add_argument("--generate", type=int, default=0, metavar="JOBS",
+                        help="benchmark generated output with the given number of jobs")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs, the best one is reported")
+    args = parser.parse_args()
+
+    samples = []
+    for fileName in args.input_files:
+        with open(fileName, "rb") as file_:
+            samples.append((fileName, file_.read()))
+    if args.generate > 0:
+        samples.append(("generated (%d jobs)" % args.generate, sampleOutput(args.generate)))
+    if not samples:
+        parser.error("no input files and nothing to generate")
+
+    for name, data in samples:
+        print("%s: %.1f MB" % (name, len(data) / 1e6))
+        for parserName, (duration, peakMemory) in sorted(benchmark(data, args.repeat).items()):
+            memory = "n/a" if peakMemory is None else "%.1f MB" % (peakMemory / 1e6)
+            print("  %-10s %8.3f s  peak memory %s" % (parserName, duration, memory))
+
+
+class MoabTest(ScaleTest.ScaleTestBase):
+    def test_iterJobs(self):
+        jobs = parseJobs("""<Data>
+<job JobID="101" State="Running" StartTime="1500000000" ReqAWDuration="3600" User="roced">
+<req TPN="4"></req><Variables><Variable name="OS">sl6</Variable><Variable name="VM_IP">10.0.0.1</Variable>
+</Variables></job>
+<job JobID="102" State="Idle" ReqAWDuration="3600" User="roced"><req TPN="4"></req></job>
+<job JobID="103" State="Completed" CompletionCode="CNCLD" User="roced"></job>
+<job JobID="104" State="Running" ReqAWDuration="3600" User="roced"><req TPN="4"></req></job>
+</Data>""")
+        self.assertEqual(len(jobs), 4)
+        self.assertEqual(jobs[0], MoabJob("101", stateRunning, 1500000000, 3600, 4, "10.0.0.1", "roced", None))
+        self.assertEqual(jobs[1].startTime, None)
+        self.assertEqual(jobs[1].vmIp, "")
+        self.assertEqual(jobs[2].completionCode, "CNCLD")
+        self.assertEqual(jobs[0].remainingWalltime(1500000600), 3000)
+        # running job without start time
+        self.assertEqual(jobs[3].startTime, None)
+        self.assertEqual(jobs[3].remainingWalltime(1500000600), None)
+
+        # showq: jobs are nested in queues, cores are given as ReqProcs
+        jobs = parseJobs("""<Data><Object>queue</Object><queue option="active" count="2">
+<job JobID="201" ReqProcs="8" StartTime="1500000000" ReqAWDuration="60" State="Running"></job>
+<job JobID="202" ReqProcs="2" StartTime="1500000000" ReqAWDuration="60" State="Running"></job>
+</queue></Data>""")
+        self.assertEqual([(job.jobId, job.cores) for job in jobs], [("201", 8), ("202", 2)])
+
+    def test_minidomReference(self):
+        data = sampleOutput(20)
+        self.assertEqual(parseJobs(data), minidomJobs(data))
+
+
+if __name__ == "__main__":
+    main()
@@ -26,7 +26,6 @@ Plots useful information from HTCondorRequirementAdapter and OpenStackSiteAdapte
 """
 
 import argparse
-import json
 import numpy as np
 import pandas as pd
 import sys
@@ -35,6 +34,8 @@ from os import path
 import matplotlib
 import matplotlib.pyplot as plt
 
+from Logging import JsonLog
+
 try:
     pass
     # import seaborn as sns
@@ -103,30 +104,33 @@ def load_style(style):
     return plot_dict
 
 
-def load_log(input_files, correction_period, plot_dict):
+def read_log(input_files):
+    """Read (timestamp, entry) pairs from JSON and JSON-lines logs, later entries replace duplicate timestamps."""
     tmp = {}
     for input_file in input_files:
         if ".json" in input_file:
-            with open(input_file, "r") as json_file:
-                tmp.update(json.load(json_file))
+            tmp.update(JsonLog.readLog(input_file))
+    return tmp.items()
 
+
+def load_log(input_files, correction_period, plot_dict):
     logs_ = {}
-    for timestamp in tmp:
-        for site in tmp[timestamp]:
+    for timestamp, entry in read_log(input_files):
+        for site in entry:
             values = np.array([])
             columns = np.array([])
             values = np.append(values, int(timestamp))
             columns = np.append(columns, "timestamps")
 
             for key in plot_dict.index:
-                if key not in tmp[timestamp][site]:
+                if key not in entry[site]:
                     values = np.append(values, np.NaN)
                 elif key == "jobs_idle":
                     values = np.append(values,
-                                       int(tmp[timestamp][site][key]) + int(
-                                           tmp[timestamp][site]["jobs_running"]))
+                                       int(entry[site][key]) + int(
+                                           entry[site]["jobs_running"]))
                 else:
-                    values = np.append(values, int(tmp[timestamp][site][key]))
+                    values = np.append(values, int(entry[site][key]))
                 columns = np.append(columns, key)
 
             if site in logs_:
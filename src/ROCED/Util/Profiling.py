@@ -0,0 +1,165 @@
+# ===============================================================================
+#
+# Copyright (c) 2010-2016
+# by Frank Fischer, Georg Fleig, Thomas Hauth and Stephan Riedel
+#
+# This file is part of ROCED.
+#
+# ROCED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ROCED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ROCED.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ===============================================================================
+from __future__ import unicode_literals, absolute_import
+
+import cProfile
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+from Util.Logging import JsonLog
+
+
+class CycleProfiler(object):
+    """Wall time per phase of a management cycle, SSH call statistics and rolling percentiles.
+
+    Phases are recorded with "with CycleProfiler.phase(name):" and summed up per cycle. Phases of adapters running
+    concurrently overlap, therefore their sum may exceed the cycle time. Phases recorded between two cycles (e.g.
+    writing the logs of the previous cycle) are added to the next cycle.
+    """
+    enabled = False
+    # number of cycles used for the percentiles
+    window = 100
+    # write a cProfile dump every n cycles (0: never)
+    dumpInterval = 0
+    dumpDir = "log"
+    percentiles = (50, 90, 99)
+
+    __lock = threading.Lock()
+    __cycle = 0
+    __cycleStart = None
+    __phases = defaultdict(float)
+    __sshCalls = 0
+    __sshBytes = 0
+    __history = defaultdict(deque)
+    __profile = None
+
+    @classmethod
+    def enable(cls, window=100, dumpInterval=0, dumpDir="log"):
+        cls.window = window
+        cls.dumpInterval = dumpInterval
+        cls.dumpDir = dumpDir
+        cls.__history = defaultdict(lambda: deque(maxlen=cls.window))
+        cls.__phases = defaultdict(float)
+        cls.enabled = True
+
+    @classmethod
+    def disable(cls):
+        cls.enabled = False
+
+    @classmethod
+    def startCycle(cls):
+        if cls.enabled is False:
+            return
+        with cls.__lock:
+            cls.__cycle += 1
+            cls.__sshCalls = 0
+            cls.__sshBytes = 0
+            cls.__cycleStart = time.time()
+        if cls.dumpInterval > 0 and cls.__cycle % cls.dumpInterval == 0:
+            # only the calling thread is profiled, not concurrently managed adapters
+            cls.__profile = cProfile.Profile()
+            cls.__profile.enable()
+
+    @classmethod
+    @contextmanager
+    def phase(cls, name):
+        """Add the wall time of the enclosed block to phase "name" of the current cycle."""
+        if cls.enabled is False:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            with cls.__lock:
+                cls.__phases[name] += time.time() - start
+
+    @classmethod
+    def countSsh(cls, nBytes):
+        # type: (int) -> None
+        """Count a single SSH call transferring nBytes (command and output)."""
+        if cls.enabled is False:
+            return
+        with cls.__lock:
+            cls.__sshCalls += 1
+            cls.__sshBytes += nBytes
+
+    @classmethod
+    def endCycle(cls):
+        # type: () -> Optional[dict]
+        """Finish the current cycle, log the summary and add it to the JSON log.
+
+        :return: {phase: seconds, "cycle": seconds, "ssh_calls": n, "ssh_bytes": n}
+        """
+        if cls.enabled is False or cls.__cycleStart is None:
+            return None
+        if cls.__profile is not None:
+            cls.__profile.disable()
+            fileName = os.path.join(cls.dumpDir, "profile_cycle_%d.prof" % cls.__cycle)
+            try:
+                cls.__profile.dump_stats(fileName)
+                logging.info("cProfile dump written to %s." % fileName)
+            except (IOError, OSError):
+                logging.error("cProfile dump %s could not be written." % fileName)
+            cls.__profile = None
+
+        with cls.__lock:
+            phases = sorted(cls.__phases)
+            summary = dict(cls.__phases)
+            summary["cycle"] = time.time() - cls.__cycleStart
+            summary["ssh_calls"] = cls.__sshCalls
+            summary["ssh_bytes"] = cls.__sshBytes
+            cls.__cycleStart = None
+            cls.__phases = defaultdict(float)
+            for name, value in summary.items():
+                cls.__history[name].append(value)
+
+        logging.info("Cycle %d: %.2fs (%s); SSH: %d calls, %d bytes; cycle %s" % (
+            cls.__cycle, summary["cycle"],
+            ", ".join("%s %.2fs" % (name, summary[name]) for name in phases),
+            summary["ssh_calls"], summary["ssh_bytes"],
+            ", ".join("p%d %.2fs" % (p, value) for p, value in sorted(cls.getPercentiles("cycle").items()))))
+
+        with JsonLog() as jsonLog:
+            for name, value in summary.items():
+                jsonLog.addItem("profiler", name, value)
+            for p, value in cls.getPercentiles("cycle").items():
+                jsonLog.addItem("profiler", "cycle_p%d" % p, value)
+        return summary
+
+    @classmethod
+    def getPercentiles(cls, name):
+        # type: (str) -> dict
+        """Rolling percentiles of a phase (or "cycle", "ssh_calls", "ssh_bytes") over the last "window" cycles.
+
+        :return: {percentile: value}
+        """
+        with cls.__lock:
+            values = sorted(cls.__history.get(name, ()))
+        if not values:
+            return {}
+        return {p: values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+                for p in cls.percentiles}
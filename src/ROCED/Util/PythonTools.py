@@ -20,10 +20,14 @@
 # ===============================================================================
 from __future__ import unicode_literals, absolute_import
 
-import collections
 import functools
 import logging
+import random
+import threading
 import time
+from collections import OrderedDict
+
+from Core import ScaleTest
 
 
 def merge_dicts(*dict_args):
@@ -72,9 +76,21 @@ class Singleton(object):
         pass
 
 
-class Caching(dict):
-    def __init__(self, validityPeriod=-1, redundancyPeriod=0):
-        # type: (int, int)
+class _CacheEntry(object):
+    __slots__ = ("value", "queryTime", "refreshTime")
+
+    def __init__(self, value, queryTime, refreshTime):
+        self.value = value
+        self.queryTime = queryTime
+        self.refreshTime = refreshTime
+
+
+class Caching(object):
+    # Global switch for the stale-while-revalidate mode of methods decorated with refreshInBackground=True.
+    backgroundRefresh = False
+
+    def __init__(self, validityPeriod=-1, redundancyPeriod=0, refreshInBackground=False, jitter=0.0, maxSize=128):
+        # type: (int, int, bool, float, Optional[int])
         """ Decorator class to cache a method's/function's return value. Handles maximum age and errors.
 
         As long as data is "valid", the currently stored data will be returned. If none exists so far, it will be
@@ -97,9 +113,30 @@ class Caching(dict):
         Caching(0,-1)                   Read once w/o error caching [regular memoization]
         Caching(x,0)|(x,y[>x])|(x,-1)   Read (valid for x seconds); /w error caching (for y seconds) or w/o
         Caching(-1,0)|(-1,y)            Read always; /w error caching (for y seconds)
+
+        Every set of arguments (including the instance of a method) has its own entry and timeout. Concurrent calls
+        with the same arguments share a single query. At most maxSize entries (None: unlimited) are kept, the least
+        recently used ones are evicted. Entries which can't be returned anymore (neither valid nor usable on errors)
+        are dropped when accessed.
+
+        The decorated function provides invalidate(*args) and clear() to drop entries, e.g. after changing the queried
+        state. For methods, the bound method's invalidate/clear only affect the entries of its instance; for
+        properties, use type(obj).name.fget.invalidate(obj).
+
+        refreshInBackground=True:       Stale-while-revalidate (if Caching.backgroundRefresh is enabled): Instead of
+                                        querying, return the stored value (as long as it may be used on errors) and
+                                        query a new one in a background thread.
+        jitter:                         Randomize the validity of each entry by +- this fraction, to spread queries.
         """
         super(Caching, self).__init__()
-        self.__lastQueryTime = 0
+        self.__entries = OrderedDict()
+        self.__maxSize = maxSize
+        self.__lock = threading.RLock()
+        # arguments -> threading.Event of the running query
+        self.__queries = {}
+        self.__refreshInBackground = refreshInBackground
+        self.__jitter = jitter
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "errors": 0}
 
         if redundancyPeriod > 0:
             self.__redundancy = redundancyPeriod
@@ -109,6 +146,8 @@ class Caching(dict):
         else:
             # No error caching.
             self.__redundancy = None
+            if refreshInBackground is True:
+                raise ValueError("refreshInBackground requires error caching (redundancyPeriod >= 0).")
 
         if 0 < redundancyPeriod <= validityPeriod:
             # Error caching only makes sense, if it's longer than a single validity cycle.
@@ -130,55 +169,242 @@ class Caching(dict):
             self.__validity = None
 
     def __call__(self, function):
-        # type: (Callable[..., ...]) -> Callable[..., ...]
+        # type: (Callable[..., ...]) -> CachedFunction
         """Since __init__ has import arguments, __call__ is only called once and receives the function!"""
         self.__function = function
+        return CachedFunction(self, function)
+
+    def lookup(self, args):
+        # type: (tuple) -> Any
+        """Return the (cached) result of function(*args)."""
+        try:
+            hash(args)
+        except TypeError:
+            # unhashable argument, e.g.: list
+            return self.__function(*args)
+
+        entry = self.__get(args)
+        now = time.time()
+        if entry is not None and self.__isValid(entry, now):
+            # Cache forever or timeout not yet reached.
+            self.__count("hits")
+            return entry.value
+        elif (entry is not None and self.__refreshInBackground is True and Caching.backgroundRefresh is True and
+                self.__isUsableOnError(entry, now)):
+            self.__count("stale")
+            self.__refresh(args)
+            return entry.value
+
+        # Intentionally querying new value(s).
+        self.__count("misses")
+        result = self.__query(args)
+        logging.debug("Queried new values. Result: %s" % (result,))
+        if result is not None:
+            return result
+
+        entry = self.__get(args)
+        if entry is not None and self.__isUsableOnError(entry, time.time()):
+            logging.info("%s did not return values. Using cached values." % self.__function.__name__)
+            return entry.value
+        # This includes passing the timeout or not having a value stored at all
+        return result
+
+    def peek(self, *args):
+        """Cached value for args (None if there is none), without querying."""
+        entry = self.__entries.get(args)
+        return entry.value if entry is not None else None
+
+    def invalidate(self, *args):
+        """Drop the entry of args, the next call queries a new value."""
+        with self.__lock:
+            self.__entries.pop(args, None)
+
+    def clear(self, *prefix):
+        """Drop all entries (whose arguments start with prefix, e.g. the instance of a method)."""
+        with self.__lock:
+            if not prefix:
+                self.__entries.clear()
+                return
+            for args in [args for args in self.__entries if args[:len(prefix)] == prefix]:
+                del self.__entries[args]
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __get(self, args):
+        """Entry of args (marked as recently used) or None. Expired entries are dropped."""
+        with self.__lock:
+            entry = self.__entries.pop(args, None)
+            if entry is None:
+                return None
+            if not self.__isValid(entry, time.time()) and not self.__isUsableOnError(entry, time.time()):
+                return None
+            self.__entries[args] = entry
+            return entry
+
+    def __put(self, args, entry):
+        with self.__lock:
+            self.__entries.pop(args, None)
+            self.__entries[args] = entry
+            while self.__maxSize is not None and len(self.__entries) > self.__maxSize:
+                self.__entries.popitem(last=False)
+
+    def __isValid(self, entry, now):
+        if self.__validity is True:
+            return True
+        return self.__validity is not None and now < entry.refreshTime
+
+    def __isUsableOnError(self, entry, now):
+        if self.__redundancy is None:
+            return False
+        return self.__redundancy is True or now < entry.queryTime + self.__redundancy
+
+    def __count(self, name):
+        with self.__lock:
+            self.stats[name] += 1
 
-        def wrapped_function(*args):
-            """This is the wrapped function which "replaces" the original."""
-            if not isinstance(args, collections.Hashable):
-                # unhashable argument, e.g.: list
-                return self.__function(*args)
-            if (args in self and self.__validity is True or
-                    (self.__validity is not None and time.time() < self.__lastQueryTime + self.__validity)):
-                # Cache forever or timeout not yet reached.
-                return self[args]
+    def __query(self, args, wait=True):
+        """Query new value(s) and store them. Only one query per set of arguments runs at a time, other callers wait
+        for its result (wait=False: return None immediately)."""
+        with self.__lock:
+            running = self.__queries.get(args)
+            if running is None:
+                running = self.__queries[args] = threading.Event()
+                running.result = None
+                owner = True
             else:
-                # Intentionally querying new value(s).
-                result = self.__missing__(args)
-                logging.debug("Queried new values. Result: %s" % result)
-                if result is not None:
-                    self[args] = result
-                    return self[args]
-                else:
-                    if self.__redundancy is None:
-                        return result
-                    elif self.__redundancy is True and args in self:
-                        logging.info("%s did not return values. Using cached values." % self.__function.__name__)
-                        return self[args]
-                    elif time.time() < self.__lastQueryTime + self.__redundancy and args in self:
-                        logging.info("%s did not return values. Using cached values." % self.__function.__name__)
-                        return self[args]
-                    else:
-                        # This includes passing the timeout or not having a value stored at all
-                        return result
-
-        return wrapped_function
-
-    def __missing__(self, key):
-        """Method is called internally (if necessary), since we're inheriting from a dictionary."""
+                owner = False
+        if owner is False:
+            if wait is True:
+                running.wait()
+            return running.result if wait is True else None
+
+        try:
+            result = self.__queryFunction(args)
+            if result is not None:
+                now = time.time()
+                validity = self.__validity if isinstance(self.__validity, int) else 0
+                validity *= 1 + random.uniform(-self.__jitter, self.__jitter)
+                self.__put(args, _CacheEntry(result, now, now + validity))
+            running.result = result
+        finally:
+            with self.__lock:
+                del self.__queries[args]
+            running.set()
+        return result
+
+    def __refresh(self, args):
+        """Query new value(s) in a background thread, unless a query is already running."""
+        if args in self.__queries:
+            return
+        thread = threading.Thread(target=self.__query, args=(args, False),
+                                  name="Refresh-%s" % self.__function.__name__)
+        thread.daemon = True
+        thread.start()
+
+    def __queryFunction(self, args):
+        """Query the function. Errors are logged and result in None."""
         try:
-            ret = self.__function(*key)
-            self.__lastQueryTime = time.time()
+            return self.__function(*args)
         except Exception as e:
+            self.__count("errors")
             logging.warning("%s raised exception '%s' when querying for new values." % (self.__function.__str__(), e))
-            ret = None
-        return ret
+            return None
 
     def __repr__(self):
         """Return the function's docstring."""
-        return self.__function.__doc__()
+        return self.__function.__doc__
+
 
-    def __get__(self, obj, objtype):
+class CachedFunction(object):
+    def __init__(self, cache, function, instance=None):
+        # type: (Caching, Callable[..., ...], object) -> None
+        """Function decorated with Caching. Bound to an instance, if it's a method."""
+        functools.update_wrapper(self, function)
+        self.cache = cache
+        self.__function = function
+        self.__instance = instance
+
+    def __call__(self, *args):
+        if self.__instance is not None:
+            args = (self.__instance,) + args
+        return self.cache.lookup(args)
+
+    def __get__(self, obj, objtype=None):
         """Support instance methods."""
-        return functools.partial(self.__call__, obj)
+        if obj is None:
+            return self
+        return CachedFunction(self.cache, self.__function, obj)
+
+    def invalidate(self, *args):
+        if self.__instance is not None:
+            args = (self.__instance,) + args
+        self.cache.invalidate(*args)
+
+    def clear(self):
+        if self.__instance is not None:
+            self.cache.clear(self.__instance)
+        else:
+            self.cache.clear()
+
+
+class CachingTest(ScaleTest.ScaleTestBase):
+    def setUp(self):
+        Caching.backgroundRefresh = True
+
+    def tearDown(self):
+        Caching.backgroundRefresh = False
+
+    def test_staleWhileRevalidate(self):
+        logging.debug("=======Testing Caching (stale-while-revalidate)=======")
+        calls = []
+        release = threading.Event()
+
+        class Source(object):
+            @Caching(validityPeriod=-1, redundancyPeriod=0, refreshInBackground=True)
+            def query(self):
+                calls.append(time.time())
+                if len(calls) == 3:
+                    release.wait(5)
+                return len(calls)
+
+        source = Source()
+        self.assertEqual(source.query(), 1)
+        # entries are kept per instance
+        self.assertEqual(Source().query(), 2)
+
+        # stale value returned immediately, a single background refresh for concurrent callers
+        self.assertEqual(source.query(), 1)
+        self.assertEqual(source.query(), 1)
+        release.set()
+        for _ in range(100):
+            if Source.query.cache.peek(source) == 3:
+                break
+            time.sleep(0.01)
+        self.assertEqual(source.query(), 3)
+        self.assertEqual(Source.query.cache.stats["misses"], 2)
+        self.assertEqual(Source.query.cache.stats["stale"], 3)
+
+    def test_eviction(self):
+        logging.debug("=======Testing Caching (eviction, invalidation)=======")
+        calls = []
+
+        class Source(object):
+            @Caching(validityPeriod=60, redundancyPeriod=-1, maxSize=2)
+            def query(self, key):
+                calls.append(key)
+                return key
+
+        source = Source()
+        [source.query(key) for key in (1, 2, 1, 3)]
+        # 2 was the least recently used entry
+        self.assertEqual(len(Source.query.cache), 2)
+        self.assertEqual(Source.query.cache.peek(source, 2), None)
+        self.assertEqual(calls, [1, 2, 3])
+
+        source.query.invalidate(1)
+        source.query(1)
+        self.assertEqual(calls, [1, 2, 3, 1])
+        Source().query(4)
+        source.query.clear()
+        self.assertEqual(len(Source.query.cache), 1)
@@ -0,0 +1,230 @@
+# ===============================================================================
+#
+# Copyright (c) 2010-2016
+# by Frank Fischer, Georg Fleig, Thomas Hauth and Stephan Riedel
+#
+# This file is part of ROCED.
+#
+# ROCED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ROCED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ROCED.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ===============================================================================
+from __future__ import unicode_literals, absolute_import
+
+import logging
+import threading
+import time
+from collections import deque
+from multiprocessing import TimeoutError
+
+from Core import ScaleTest
+
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity=1):
+        # type: (float, int) -> None
+        """Token bucket rate limiter: at most capacity requests at once, refilled with rate tokens per second.
+
+        :param rate: tokens (requests) per second
+        :param capacity: maximum number of tokens (burst size)
+        """
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.__tokens = float(capacity)
+        self.__lastRefill = time.time()
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        # type: () -> float
+        """Take one token, wait until one is available.
+
+        :return: time waited (seconds)
+        """
+        waited = 0.0
+        while True:
+            with self.__lock:
+                now = time.time()
+                self.__tokens = min(self.capacity, self.__tokens + (now - self.__lastRefill) * self.rate)
+                self.__lastRefill = now
+                if self.__tokens >= 1:
+                    self.__tokens -= 1
+                    return waited
+                delay = (1 - self.__tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class Request(object):
+    def __init__(self, function, args, kwargs):
+        """Queued request function(*args, **kwargs), with the interface of multiprocessing.pool.AsyncResult."""
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.__done = threading.Event()
+        self.__result = None
+        self.__error = None
+
+    def ready(self):
+        # type: () -> bool
+        return self.__done.is_set()
+
+    def wait(self, timeout=None):
+        self.__done.wait(timeout)
+
+    def get(self, timeout=None):
+        """Wait for the result, exceptions of the request are re-raised."""
+        if not self.__done.wait(timeout):
+            raise TimeoutError()
+        if self.__error is not None:
+            raise self.__error
+        return self.__result
+
+    def run(self):
+        try:
+            self.__result = self.function(*self.args, **self.kwargs)
+        except Exception as error:
+            self.__error = error
+        finally:
+            self.__done.set()
+
+
+class RequestScheduler(object):
+    # shared instances (one per API endpoint), see get()
+    instances = {}
+    __instancesLock = threading.Lock()
+
+    def __init__(self, rate, capacity=1):
+        # type: (float, int) -> None
+        """Execute API requests one after another in a background thread, paced by a TokenBucket.
+
+        Requests are submitted as functions and return a Request ("future"), the caller only blocks when waiting for
+        the result. Exceptions of a request are re-raised by Request.get(). Urgent requests (submitUrgent, call) are
+        executed before the regular ones, e.g. listings a management cycle waits for.
+        """
+        self.bucket = TokenBucket(rate, capacity)
+        # urgent and regular requests
+        self.__queues = (deque(), deque())
+        self.__condition = threading.Condition()
+        self.__closed = False
+        self.__thread = threading.Thread(target=self.__run, name="RequestScheduler")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    @classmethod
+    def get(cls, endpoint, rate=1.0, capacity=1):
+        # type: (str, float, int) -> RequestScheduler
+        """Scheduler shared by all users of endpoint, so their requests share the rate limit.
+
+        The rate/capacity of the first call for an endpoint are used.
+        """
+        with cls.__instancesLock:
+            if endpoint not in cls.instances:
+                cls.instances[endpoint] = cls(rate, capacity)
+            return cls.instances[endpoint]
+
+    def submit(self, function, *args, **kwargs):
+        # type: (Callable[..., Any], ...) -> Request
+        """Queue the request function(*args, **kwargs)."""
+        return self.__enqueue(self.__queues[1], Request(function, args, kwargs))
+
+    def submitUrgent(self, function, *args, **kwargs):
+        # type: (Callable[..., Any], ...) -> Request
+        """Queue the request function(*args, **kwargs) ahead of the regular requests."""
+        return self.__enqueue(self.__queues[0], Request(function, args, kwargs))
+
+    def call(self, function, *args, **kwargs):
+        """Queue the request ahead of the regular requests and wait for its result."""
+        return self.submitUrgent(function, *args, **kwargs).get()
+
+    def __enqueue(self, queue, request):
+        # type: (deque, Request) -> Request
+        with self.__condition:
+            if self.__closed is True:
+                raise ValueError("Request scheduler is closed.")
+            queue.append(request)
+            self.__condition.notify()
+        return request
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                while not any(self.__queues) and self.__closed is False:
+                    self.__condition.wait()
+                if not any(self.__queues):
+                    return
+                request = (self.__queues[0] or self.__queues[1]).popleft()
+            waited = self.bucket.acquire()
+            if waited > 0:
+                logging.debug("Request delayed by %.1fs (rate limit)." % waited)
+            request.run()
+
+    def close(self):
+        """Execute the queued requests, don't accept new ones."""
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify()
+        self.__thread.join()
+
+
+class RequestSchedulerTest(ScaleTest.ScaleTestBase):
+    def test_rateLimit(self):
+        scheduler = RequestScheduler(rate=50, capacity=2)
+        calls = []
+
+        def request(i):
+            calls.append((i, time.time()))
+            if i == 3:
+                raise ValueError("request failed")
+            return i
+
+        startTime = time.time()
+        futures = [scheduler.submit(request, i) for i in range(6)]
+        # submitting does not block
+        self.assertLess(time.time() - startTime, 0.02)
+
+        self.assertEqual(futures[5].get(5), 5)
+        self.assertEqual([i for i, _ in calls], list(range(6)))
+        self.assertRaises(ValueError, futures[3].get)
+        # 2 requests right away (burst), 4 more at 50 requests/s
+        self.assertGreaterEqual(calls[-1][1] - startTime, 0.07)
+        scheduler.close()
+
+    def test_urgent(self):
+        scheduler = RequestScheduler(rate=1000)
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def block():
+            started.set()
+            return release.wait(5)
+
+        blocking = scheduler.submit(block)
+        self.assertTrue(started.wait(5))
+        for i in range(3):
+            scheduler.submit(calls.append, i)
+        listing = scheduler.submitUrgent(calls.append, "urgent")
+        self.assertFalse(listing.ready())
+        self.assertRaises(TimeoutError, listing.get, 0.01)
+
+        release.set()
+        listing.get(5)
+        scheduler.close()
+        self.assertTrue(blocking.get())
+        # executed after the running request, before the regular ones queued earlier
+        self.assertEqual(calls, ["urgent", 0, 1, 2])
+        self.assertRaises(ValueError, scheduler.submit, calls.append, 3)
+
+    def test_shared(self):
+        self.assertIs(RequestScheduler.get("test", 10), RequestScheduler.get("test", 1))
+        self.assertIsNot(RequestScheduler.get("test"), RequestScheduler.get("other"))
@@ -20,11 +20,12 @@
 # ===============================================================================
 from __future__ import print_function
 
-import json
 import logging
 from datetime import datetime
 from os import path
 
+from Logging import JsonLog
+
 try:
     # Install rrdtool, librrd-dev and python(3)-rrdtool
     import rrdtool
@@ -140,8 +141,8 @@ class Rrd(object):
 
         for input_file in file_list:
             if ".json" in input_file:
-                with open(input_file, "r") as json_file:
-                    result.extend(self._dict_to_update_string_list(json.load(json_file), processed_keys))
+                for timestamp, entry in JsonLog.readLog(input_file):
+                    result.extend(self._dict_to_update_string_list({timestamp: entry}, processed_keys))
             else:
                 raise NotImplementedError("%s can not be parsed. File type not yet implemented." % input_file)
 
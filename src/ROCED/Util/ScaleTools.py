@@ -21,17 +21,25 @@
 from __future__ import unicode_literals, absolute_import
 
 import getpass
+import hashlib
 import logging
+import os
+import shutil
 import subprocess
+import tempfile
+import threading
+import time
 
 from Core import MachineRegistry
 from Core import ScaleTest
+from Util.Profiling import CycleProfiler
 
 
 class ChangeNotifier(object):
     def __init__(self, machineReg):
         self.mr = machineReg
-        self.mr.registerListener(self)
+        # notifications only need the final status of a machine
+        self.mr.registerListener(self, coalesce=True)
         self.cached = []
 
     def onEvent(self, evt):
@@ -107,6 +115,134 @@ class Shell(object):
         return p.returncode, stdout, stderr
 
 
+class SshConnectionPool(object):
+    """Keep SSH connections alive across management cycles using OpenSSH multiplexing.
+
+    One master connection per (host, user, key, gateway) is started in the background
+    (ControlMaster) and shared by all subsequent SSH calls. Masters exit on their own after being idle for
+    idleTimeout seconds (ControlPersist) and are health checked at most every checkInterval seconds.
+    If a master can not be started, calls fall back to plain connections for checkInterval seconds.
+    """
+    enabled = False
+    idleTimeout = 300
+    checkInterval = 60
+    controlDir = None
+    __lastCheck = {}
+    __lastFailure = {}
+    __locks = {}
+    __lock = threading.Lock()
+
+    @classmethod
+    def enable(cls, idleTimeout=300, checkInterval=60, controlDir=None):
+        if controlDir is None:
+            controlDir = os.path.join(tempfile.gettempdir(), "roced-ssh-%s" % getpass.getuser())
+        if os.path.isdir(controlDir) is False:
+            try:
+                os.makedirs(controlDir, 0o700)
+            except OSError:
+                logging.error("Error when creating %s folder, SSH connections are not pooled." % controlDir)
+                return
+        cls.controlDir = controlDir
+        cls.idleTimeout = idleTimeout
+        cls.checkInterval = checkInterval
+        cls.enabled = True
+
+    @classmethod
+    def disable(cls):
+        cls.closeAll()
+        cls.enabled = False
+
+    @classmethod
+    def controlPath(cls, host, username, key, gateway=None):
+        # Unix socket paths are limited to ~100 characters, use a hash of the pool key.
+        poolKey = "%s|%s|%s|%s" % (host, username, key, gateway)
+        return os.path.join(cls.controlDir, hashlib.sha1(poolKey.encode("utf-8")).hexdigest()[:20])
+
+    @classmethod
+    def getOptions(cls, host, username, key, gateway=None, sshOptions=()):
+        # type: (str, str, str, str, Iterable[str]) -> List[str]
+        """SSH options to run a command over the pooled connection; empty if no master is available.
+
+        :param sshOptions: options used to establish the master connection (timeout, key, ...)
+        """
+        if cls.enabled is False:
+            return []
+        path = cls.controlPath(host, username, key, gateway)
+        with cls.__lock:
+            lock = cls.__locks.setdefault(path, threading.Lock())
+        with lock:
+            if cls.__checkMaster(path, username, host) is False:
+                if time.time() - cls.__lastFailure.get(path, 0) < cls.checkInterval or \
+                        cls.__startMaster(path, username, host, sshOptions) is False:
+                    return []
+        return ["-o ControlMaster=no", "-o ControlPath=" + path]
+
+    @classmethod
+    def __control(cls, path, target, command):
+        with open(os.devnull, "w") as devnull:
+            return subprocess.call(["ssh", "-O", command, "-o ControlPath=" + path, target],
+                                   stdin=devnull, stdout=devnull, stderr=devnull)
+
+    @classmethod
+    def __checkMaster(cls, path, username, host):
+        """Health check of a master connection, removes stale control sockets."""
+        if not os.path.exists(path):
+            return False
+        if time.time() - cls.__lastCheck.get(path, 0) < cls.checkInterval:
+            return True
+        if cls.__control(path, "%s@%s" % (username, host), "check") == 0:
+            cls.__lastCheck[path] = time.time()
+            return True
+        logging.debug("SSH master connection to %s@%s is dead, removing %s." % (username, host, path))
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return False
+
+    @classmethod
+    def __startMaster(cls, path, username, host, sshOptions):
+        # The master runs detached (-f) with its output discarded, otherwise it would keep the pipes of the
+        # first call open.
+        with open(os.devnull, "w") as devnull:
+            rc = subprocess.call(["ssh", "-f", "-N",
+                                  "-o ControlMaster=yes",
+                                  "-o ControlPath=" + path,
+                                  "-o ControlPersist=%d" % cls.idleTimeout] +
+                                 list(sshOptions) + ["%s@%s" % (username, host)],
+                                 stdin=devnull, stdout=devnull, stderr=devnull)
+        if rc == 0:
+            cls.__lastCheck[path] = time.time()
+            logging.debug("Started SSH master connection to %s@%s." % (username, host))
+            return True
+        cls.__lastFailure[path] = time.time()
+        logging.debug("SSH master connection to %s@%s could not be started (RC %i)." % (username, host, rc))
+        return False
+
+    @classmethod
+    def closeAll(cls):
+        """Stop all master connections started by this process."""
+        with cls.__lock:
+            paths = list(cls.__lastCheck)
+            cls.__lastCheck = {}
+        for path in paths:
+            if os.path.exists(path):
+                cls.__control(path, "localhost", "exit")
+
+
+class _CountingStream(object):
+    """Read-only file object wrapper, counting the bytes read (see CycleProfiler.countSsh)."""
+
+    def __init__(self, stream):
+        self.__stream = stream
+        self.bytesRead = 0
+
+    def read(self, size=-1):
+        data = self.__stream.read(size)
+        self.bytesRead += len(data)
+        return data
+
+
 class Ssh(object):
     local_host_list = frozenset(("localhost", "127.0.0.1", "::1", "", " ", None))
 
@@ -175,7 +311,7 @@ class Ssh(object):
         :return res: SSH call result. Consists of return-code, output, error
         :rtype res: Tuple(int, str, str)
         """
-        if self.__gatewayIp is None and self.__host in self.local_host_list and self.__username == getpass.getuser():
+        if self.__isLocal():
             logging.debug("Redirecting SSH call to local shell.")
             # Perform "quiet", since this method will already generate output.
             res = Shell.executeCommand(command=call, quiet=True, timeout=timeout)
@@ -204,6 +340,66 @@ class Ssh(object):
 
         return res
 
+    def handleSshStream(self, call, consumer, timeout=60):
+        # type: (Union[str, unicode], Callable[[IO[bytes]], Any], int) -> Tuple[int, Any, str]
+        """Perform SSH command on remote server and pass its output to consumer while it is received.
+
+        Unlike handleSshCall, the output is never held in memory as a whole. The consumer reads the (binary) stdout
+        file object, e.g. with xml.etree.ElementTree.iterparse. If the consumer raises an exception while the command
+        failed, this is expected (incomplete output) and the result is None.
+
+        :param call:
+        :param consumer: function(stdout), its return value is passed on
+        :param timeout:
+        :return res: return-code, result of consumer, error
+        :rtype res: Tuple(int, Any, str)
+        """
+        local = self.__isLocal()
+        if not local and self.__gatewayIp is not None:
+            # wrap SSH command in another SSH call
+            call = "ssh -i %s %s@%s '%s'" % (self.__gatewayKey, self.__gatewayUser, self.__gatewayIp, call)
+        command = "timeout %ds %s" % (timeout, call) if timeout else call
+        if local:
+            logging.debug("Redirecting SSH call to local shell.")
+            p = subprocess.Popen(command, bufsize=-1, shell=True, stdin=None,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        else:
+            p = subprocess.Popen(self.__sshCommand(command), bufsize=-1, stdin=None,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        # stderr is read in parallel, a full pipe would block the command otherwise
+        stderr = []
+        stderrReader = threading.Thread(target=lambda: stderr.append(p.stderr.read()))
+        stderrReader.daemon = True
+        stderrReader.start()
+
+        stdout = _CountingStream(p.stdout)
+        result = None
+        error = None
+        try:
+            result = consumer(stdout)
+        except Exception as err:
+            error = err
+        # the consumer may stop early, discard the rest of the output
+        while stdout.read(65536):
+            pass
+        p.wait()
+        stderrReader.join()
+        CycleProfiler.countSsh(len(command) + stdout.bytesRead + len(stderr[0]))
+
+        stderr = stderr[0].decode(encoding="utf-8").strip()
+        if p.returncode == 124:
+            stderr = "SSH command '%s' on host %s timed out" % (call, self.__host)
+        if error is not None:
+            if p.returncode == 0:
+                raise error
+            logging.debug("Output of failed SSH command '%s' could not be processed: %s" % (call, error))
+        return p.returncode, result, stderr
+
+    def __isLocal(self):
+        return (self.__gatewayIp is None and self.__host in self.local_host_list and
+                self.__username == getpass.getuser())
+
     @staticmethod
     def getSshOnMachine(machine):
         ip = machine.get(MachineRegistry.MachineRegistry.regHostname)
@@ -233,24 +429,29 @@ class Ssh(object):
         initial_command = command
         if timeout:
             command = "timeout %ds %s" % (timeout, command)
-        p = subprocess.Popen(["ssh",
-                              "-o ConnectTimeout=" + str(self.__timeout),
-                              "-o UserKnownHostsFile=/dev/null",
-                              "-o StrictHostKeyChecking=no",
-                              "-o PasswordAuthentication=no",
-                              "-o LogLevel=quiet",
-                              "-i", self.__key,
-                              self.__username + "@" + self.__host,
-                              command],
+        p = subprocess.Popen(self.__sshCommand(command),
                              bufsize=0, executable=None, stdin=None, stdout=subprocess.PIPE,
                              stderr=subprocess.PIPE)
         stdout, stderr = p.communicate()
+        CycleProfiler.countSsh(len(command) + len(stdout) + len(stderr))
         stdout = stdout.decode(encoding="utf-8").strip()
         stderr = stderr.decode(encoding="utf-8").strip()
         if p.returncode == 124:
             stderr = ("SSH command '%s' on host %s timed out" % (initial_command, self.__host))
         return p.returncode, stdout, stderr
 
+    def __sshCommand(self, command):
+        # type: (str) -> List[str]
+        sshOptions = ["-o ConnectTimeout=" + str(self.__timeout),
+                      "-o UserKnownHostsFile=/dev/null",
+                      "-o StrictHostKeyChecking=no",
+                      "-o PasswordAuthentication=no",
+                      "-o LogLevel=quiet",
+                      "-i", self.__key]
+        gateway = (self.__gatewayIp, self.__gatewayUser, self.__gatewayKey) if self.__gatewayIp else None
+        poolOptions = SshConnectionPool.getOptions(self.__host, self.__username, self.__key, gateway, sshOptions)
+        return ["ssh"] + poolOptions + sshOptions + [self.__username + "@" + self.__host, command]
+
     @staticmethod
     def debugOutput(logger, scope, result):
         logger.debug("[%s] SSH return code: %i" % (scope, result[0]))
@@ -451,6 +652,18 @@ class ScaleToolsTest(ScaleTest.ScaleTestBase):
         self.assertEqual(result[0], 0)
         self.assertEqual(result[1], "Hello World")
 
+    def test_sshStream(self):
+        tester = Ssh(host="localhost", username=getpass.getuser(), key="~/.ssh/id_rsa")
+        result = tester.handleSshStream("seq 100000", lambda stream: stream.read(2))
+        self.assertEqual(result[:2], (0, b"1\n"))
+
+        def failingConsumer(stream):
+            raise ValueError(stream.read())
+
+        result = tester.handleSshStream("echo 'Error' >&2; exit 3", failingConsumer)
+        self.assertEqual(result, (3, None, "Error"))
+        self.assertRaises(ValueError, tester.handleSshStream, "echo 'Hello World'", failingConsumer)
+
     def test_shell(self):
         logging.debug("=======Testing Shell=======")
         tester = Shell.executeCommand(command="echo 'Hello World'")
@@ -459,3 +672,82 @@ class ScaleToolsTest(ScaleTest.ScaleTestBase):
         tester = Shell.executeCommand(command="eo'")
         self.assertNotEqual(tester[0], 0)
         self.assertIsNot(tester[2], "")
+
+
+class SshConnectionPoolTest(ScaleTest.ScaleTestBase):
+    # records its arguments, creates/checks/removes the control socket (a plain file) like OpenSSH
+    fakeSsh = """#!/bin/sh
+echo "$@" >> "$(dirname "$0")/calls"
+for arg in "$@"; do
+    case "$arg" in "-o ControlPath="*) path="${arg#-o ControlPath=}";; esac
+done
+case "$*" in
+    *"-O check"*) test -e "$path" && ! test -e "$(dirname "$0")/dead"; exit $?;;
+    *"-O exit"*) rm -f "$path"; exit 0;;
+    *"ControlMaster=yes"*) test -e "$(dirname "$0")/fail" && exit 255; touch "$path"; exit 0;;
+esac
+"""
+
+    def setUp(self):
+        self.binDir = tempfile.mkdtemp()
+        self.controlDir = os.path.join(self.binDir, "control")
+        with open(os.path.join(self.binDir, "ssh"), "w") as file_:
+            file_.write(self.fakeSsh)
+        os.chmod(os.path.join(self.binDir, "ssh"), 0o755)
+        self.path = os.environ["PATH"]
+        os.environ["PATH"] = self.binDir + os.pathsep + self.path
+
+    def tearDown(self):
+        SshConnectionPool.disable()
+        os.environ["PATH"] = self.path
+        shutil.rmtree(self.binDir)
+
+    def calls(self):
+        try:
+            with open(os.path.join(self.binDir, "calls")) as file_:
+                return file_.read().splitlines()
+        except IOError:
+            return []
+
+    def test_controlPath(self):
+        SshConnectionPool.enable(controlDir=self.controlDir)
+        path = SshConnectionPool.controlPath("host", "user", "key")
+        self.assertEqual(os.path.dirname(path), self.controlDir)
+        self.assertEqual(len(os.path.basename(path)), 20)
+        self.assertEqual(path, SshConnectionPool.controlPath("host", "user", "key"))
+        self.assertNotEqual(path, SshConnectionPool.controlPath("host", "user", "key", gateway="gateway"))
+
+    def test_getOptions(self):
+        logging.debug("=======Testing SSH connection pool=======")
+        self.assertEqual(SshConnectionPool.getOptions("host", "user", "key"), [])
+
+        SshConnectionPool.enable(idleTimeout=120, controlDir=self.controlDir)
+        path = SshConnectionPool.controlPath("host", "user", "key")
+        options = ["-o ControlMaster=no", "-o ControlPath=" + path]
+        self.assertEqual(SshConnectionPool.getOptions("host", "user", "key", sshOptions=["-o ConnectTimeout=3"]),
+                         options)
+        self.assertEqual(self.calls(), ["-f -N -o ControlMaster=yes -o ControlPath=%s -o ControlPersist=120 "
+                                        "-o ConnectTimeout=3 user@host" % path])
+        # master running and recently checked: no ssh call
+        self.assertEqual(SshConnectionPool.getOptions("host", "user", "key"), options)
+        self.assertEqual(len(self.calls()), 1)
+
+        # dead master: health check fails, the socket is removed and the master restarted
+        SshConnectionPool.checkInterval = 0
+        open(os.path.join(self.binDir, "dead"), "w").close()
+        self.assertEqual(SshConnectionPool.getOptions("host", "user", "key"), options)
+        self.assertEqual(self.calls()[1], "-O check -o ControlPath=%s user@host" % path)
+        self.assertTrue(self.calls()[2].startswith("-f -N -o ControlMaster=yes"))
+        os.remove(os.path.join(self.binDir, "dead"))
+
+        # master can't be started: plain connections
+        open(os.path.join(self.binDir, "fail"), "w").close()
+        SshConnectionPool.checkInterval = 60
+        self.assertEqual(SshConnectionPool.getOptions("other", "user", "key"), [])
+        calls = len(self.calls())
+        self.assertEqual(SshConnectionPool.getOptions("other", "user", "key"), [])
+        self.assertEqual(len(self.calls()), calls)
+
+        SshConnectionPool.closeAll()
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.calls()[-1], "-O exit -o ControlPath=%s localhost" % path)
@@ -32,10 +32,12 @@ import sys
 import argparse
 import configparser
 import os
+import signal
 
 from Core.Core import ScaleCoreFactory
 from Core import Config
 from Util.Daemon import DaemonBase
+from Util.Logging import CsvStats, JsonLinesStatsSink, JsonLog, MachineRegistryLogger
 
 ###
 # Unit tests:
@@ -44,7 +46,7 @@ from Core import CoreTest, EventTest, AdapterTest
 from SiteAdapter import SiteTest
 from RequirementAdapter import RequirementTest
 from IntegrationAdapter import IntegrationTest
-from Util import ScaleTools
+from Util import Moab, PythonTools, RateLimit, ScaleTools
 
 # Optional modules with unit-tests
 try:
@@ -71,6 +73,9 @@ class ScaleMain(object):
         ts.addTests(unittest.defaultTestLoader.loadTestsFromModule(EventTest))
         ts.addTests(unittest.defaultTestLoader.loadTestsFromModule(IntegrationTest))
         ts.addTests(unittest.defaultTestLoader.loadTestsFromModule(RequirementTest))
+        ts.addTests(unittest.defaultTestLoader.loadTestsFromModule(PythonTools))
+        ts.addTests(unittest.defaultTestLoader.loadTestsFromModule(Moab))
+        ts.addTests(unittest.defaultTestLoader.loadTestsFromModule(RateLimit))
         ts.addTests(unittest.defaultTestLoader.loadTestsFromModule(ScaleTools))
         ts.addTests(unittest.defaultTestLoader.loadTestsFromModule(HTCondor))
 
@@ -125,6 +130,33 @@ class ScaleMain(object):
                 logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s", "%Y-%m-%d %H:%M:%S"))
             logger.addHandler(file_handler)
 
+        if config.has_option(Config.GeneralSection, Config.GeneralMonitoringLogFormat) is True:
+            log_format = config.get(Config.GeneralSection, Config.GeneralMonitoringLogFormat)
+            if log_format == "jsonl":
+                max_bytes = 0
+                if config.has_option(Config.GeneralSection, Config.GeneralMonitoringLogMaxBytes) is True:
+                    max_bytes = config.getint(Config.GeneralSection, Config.GeneralMonitoringLogMaxBytes)
+                JsonLog.enableJsonLines(maxBytes=max_bytes)
+            elif log_format != "json":
+                logger.error("Unknown monitoring log format %s, using json." % log_format)
+
+        if config.has_option(Config.GeneralSection, Config.GeneralStatsFormat) is True:
+            stats_format = config.get(Config.GeneralSection, Config.GeneralStatsFormat)
+            if stats_format == "jsonl":
+                CsvStats.setSink(JsonLinesStatsSink())
+            elif stats_format != "csv":
+                logger.error("Unknown statistics format %s, using csv." % stats_format)
+        if config.has_option(Config.GeneralSection, Config.GeneralStatsBufferSize) is True:
+            CsvStats.setLimits(maxItems=config.getint(Config.GeneralSection, Config.GeneralStatsBufferSize))
+        if config.has_option(Config.GeneralSection, Config.GeneralStatsFlushInterval) is True:
+            CsvStats.setLimits(flushInterval=config.getint(Config.GeneralSection, Config.GeneralStatsFlushInterval))
+        if config.has_option(Config.GeneralSection, Config.GeneralStatusHistoryFormat) is True:
+            history_format = config.get(Config.GeneralSection, Config.GeneralStatusHistoryFormat)
+            if history_format == "legacy":
+                MachineRegistryLogger.legacyHistory = True
+            elif history_format != "compact":
+                logger.error("Unknown status history format %s, using compact." % history_format)
+
     def run(self, config_file_name, debug=False, iterations=None):
 
         self.logger.info("Loading config %s." % config_file_name)
@@ -145,8 +177,17 @@ class ScaleMain(object):
             self.logger.info("----------------------------------")
 
         scaleCore.init()
+
+        # finish the current management cycle on SIGTERM (daemon stop) and Ctrl+C
+        def stopHandler(signum, frame):
+            self.logger.info("Signal %d received, stopping after the current management cycle." % signum)
+            scaleCore.stop()
+
+        signal.signal(signal.SIGTERM, stopHandler)
+        signal.signal(signal.SIGINT, stopHandler)
+
         # Run the server's main loop
-        scaleCore.startManage()
+        scaleCore.run()
 
 
 class MyDaemon(DaemonBase):